@@ -0,0 +1,317 @@
+"""Offline micro-benchmarks of the training and evaluation hot paths.
+
+Example::
+
+    python benchmarks/bench_hot_paths.py --save_baseline     # store the numbers of this machine
+    python benchmarks/bench_hot_paths.py                     # compare against them
+    python benchmarks/bench_hot_paths.py --only noisy_delta aggregation_int8
+
+Inputs are synthetic tensors shaped like FC100 meta-training episodes
+(``--ways`` classes with ``--shots`` + ``--queries`` 32x32 images each),
+nothing is downloaded and everything runs on the CPU. Every benchmark runs in
+a fresh process. Its memory is measured on one more call after the timed
+ones: the peak of the live tensors allocated by that call, from the memory
+events of ``torch.profiler``, plus the peak of the Python heap over the call,
+which covers NumPy arrays, from ``tracemalloc``. A benchmark regresses when its
+median time or its peak memory exceeds the baseline by more than
+``--tolerance``; the script then exits with status 1.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.profiler import ProfilerActivity, profile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(fn):
+    """Register ``fn(cfg)``, which builds the inputs and returns the callable to time."""
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def model_args(**kwargs):
+    args = dict(dataset='FC100', use_transform_layer=1, induct_rnn_dim=128, induct_att_dim=64)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def synthetic_images(num_classes, per_class, size, seed=0):
+    rng = np.random.RandomState(seed)
+    y = np.repeat(np.arange(num_classes), per_class)
+    X = rng.randint(0, 256, (len(y), size, size, 3), dtype=np.uint8)
+    return X, y
+
+
+@benchmark
+def episode_sampling(cfg):
+    from main_image import sample_episode
+    X, y = synthetic_images(60, cfg.client_images // 60, cfg.image_size)
+    return lambda: sample_episode(X, y, list(range(60)), cfg.ways, cfg.shots, cfg.queries)
+
+
+@benchmark
+def augmentation(cfg):
+    from main_image import episode_transform
+    X, _ = synthetic_images(cfg.ways, cfg.shots + cfg.queries, cfg.image_size)
+    transform = episode_transform('FC100', train=True)
+    return lambda: torch.stack([transform(x) for x in X], 0)
+
+
+@benchmark
+def resnet12_dp_forward_backward(cfg):
+    from opacus import GradSampleModule
+    from model import resnet12
+    model = GradSampleModule(resnet12(avg_pool=True, drop_rate=0.1, dropblock_size=2))
+    x = torch.randn(cfg.dp_batch, 3, cfg.image_size, cfg.image_size)
+
+    def run():
+        model(x).pow(2).sum().backward()
+        model.zero_grad(set_to_none=True)
+    return run
+
+
+@benchmark
+def inner_loop(cfg):
+    from dp_utils import inner_loop_copy, wrap_dp_submodules
+    from main_image import fine_tune_few_classify
+    from model import ModelFed_Adp
+    net = ModelFed_Adp('resnet12', 256, cfg.ways, 60, None, model_args())
+    # the client model of train_net_few_shot_new, the copy drops the per-sample hooks
+    wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=True))
+    x = torch.randn(cfg.ways * cfg.shots, 3, cfg.image_size, cfg.image_size)
+    labels = torch.arange(cfg.ways).repeat_interleave(cfg.shots)
+    return lambda: fine_tune_few_classify(inner_loop_copy(net), x, labels, cfg.fine_tune_steps, 0.1)
+
+
+@benchmark
+def infonce(cfg):
+    from main_image import InforNCE_Loss
+    anchor = torch.randn(cfg.shots, cfg.ways, 640, requires_grad=True)
+    sample = torch.randn(cfg.queries, cfg.ways, 640, requires_grad=True)
+
+    def run():
+        loss = sum(InforNCE_Loss(anchor[j % cfg.shots], sample[(j + 1) % cfg.queries], tau=0.5)[0]
+                   for j in range(cfg.queries))
+        loss.backward()
+    return run
+
+
+@benchmark
+def dropblock(cfg):
+    from model import DropBlock
+    block = DropBlock(block_size=2).train()
+    x = torch.randn(cfg.ways * (cfg.shots + cfg.queries), 160, cfg.image_size // 2, cfg.image_size // 2)
+    return lambda: block(x, gamma=0.025)
+
+
+@benchmark
+def mha_grad_sampler(cfg):
+    from opacus import GradSampleModule
+    from opacus_custom_samplers import convert_mha_to_cached
+    layer = convert_mha_to_cached(nn.TransformerEncoderLayer(d_model=640, nhead=4, batch_first=True))
+    model = GradSampleModule(layer)
+    # ModelFed_Adp feeds the transformer the features of an episode as one sequence
+    x = torch.randn(1, cfg.ways * (cfg.shots + cfg.queries), 640)
+
+    def run():
+        model(x).pow(2).sum().backward()
+        model.zero_grad(set_to_none=True)
+    return run
+
+
+def model_update(seed=0):
+    from model import ModelFed_Adp
+    torch.manual_seed(seed)
+    state = ModelFed_Adp('resnet12', 256, 20, 60, None, model_args()).state_dict()
+    return state, OrderedDict((k, v + 1e-3 * torch.randn_like(v) if v.is_floating_point() else v)
+                              for k, v in state.items())
+
+
+@benchmark
+def noisy_delta(cfg):
+    from dp_utils import compute_noisy_delta
+    global_params, local_params = model_update()
+    return lambda: compute_noisy_delta(global_params, local_params, 1.0, 1.0)
+
+
+@benchmark
+def aggregation_int8(cfg):
+    from compression import UpdateCompressor, aggregate_updates
+    from dp_utils import compute_noisy_delta
+    global_params, local_params = model_update()
+    delta, _ = compute_noisy_delta(global_params, local_params, 1.0, 1.0)
+    compressor = UpdateCompressor('int8', error_feedback=False)
+    uploads = [compressor.compress(i, delta) for i in range(cfg.clients)]
+    return lambda: aggregate_updates(uploads, [1.0 / cfg.clients] * cfg.clients)
+
+
+@benchmark
+def logistic_regression_eval(cfg):
+    from eval_utils import build_test_episode_bank, meta_test_features
+    N, K, Q = 5, 5, 15
+    y_test = np.repeat(np.arange(20), 100)
+    bank = build_test_episode_bank(y_test, N, Q, ks=[K], num_episodes=cfg.eval_episodes)[K]
+    features = np.random.RandomState(0).randn(len(y_test), 640).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    rows = np.arange(len(y_test))
+    return lambda: meta_test_features(features, rows, bank, N, Q)
+
+
+@benchmark
+def lstmatt_forward(cfg):
+    from model import LSTMAtt
+    net = LSTMAtt(nn.Embedding(20000, 300), 256, cfg.ways, 20, model_args(dataset='huffpost'))
+    batch = cfg.ways * (cfg.shots + cfg.queries)
+    data = torch.randint(0, 20000, (batch, net.max_text_len + 1))
+    data[:, net.max_text_len] = torch.randint(5, net.max_text_len + 1, (batch,))
+    return lambda: net(data, all_classify=True)
+
+
+def run_benchmark(name, cfg):
+    """Time ``BENCHMARKS[name]`` in the current process."""
+    torch.manual_seed(0)
+    np.random.seed(0)
+    torch.set_num_threads(cfg.threads)
+    fn = BENCHMARKS[name](cfg)
+    for _ in range(cfg.warmup):
+        fn()
+    times = []
+    for _ in range(cfg.repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e3
+    return {
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'peak_mb': peak_memory(fn) / 2**20,
+    }
+
+
+def peak_memory(fn):
+    """Bytes of the tensors and Python objects live at the peak of one call of ``fn``.
+
+    The two peaks are taken separately and added, so this is an upper bound
+    when they do not coincide.
+    """
+    tracemalloc.start()
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    live = tensor_peak = 0
+    events = [e for e in prof.profiler.kineto_results.events() if e.name() == '[memory]']
+    for event in sorted(events, key=lambda e: e.start_ns()):
+        # frees have negative sizes
+        live += event.nbytes()
+        tensor_peak = max(tensor_peak, live)
+    return tensor_peak + python_peak
+
+
+def _run_isolated(name, cfg):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(run_benchmark, name, cfg).result()
+
+
+def compare(results, baseline, tolerance):
+    """Names of the benchmarks slower or larger than ``baseline`` by more than ``tolerance``."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['median_ms'] > base['median_ms'] * (1 + tolerance)
+        # 1 MB of slack keeps allocator noise on small benchmarks from being flagged
+        larger = result['peak_mb'] > base['peak_mb'] * (1 + tolerance) + 1.0
+        if slower or larger:
+            regressions.append(name)
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=None, help='benchmarks to run')
+    parser.add_argument('--ways', type=int, default=20, help='classes of a meta-training episode')
+    parser.add_argument('--shots', type=int, default=2, help='support images per class')
+    parser.add_argument('--queries', type=int, default=2, help='query images per class')
+    parser.add_argument('--dp_batch', type=int, default=8,
+                        help='images per step of the resnet12 per-sample gradient benchmark (about 50 MB each)')
+    parser.add_argument('--image_size', type=int, default=32, help='height and width of the images')
+    parser.add_argument('--client_images', type=int, default=3600, help='training images of a client')
+    parser.add_argument('--fine_tune_steps', type=int, default=5, help='steps of the inner loop')
+    parser.add_argument('--clients', type=int, default=10, help='updates aggregated per round')
+    parser.add_argument('--eval_episodes', type=int, default=10, help='episodes of the logistic-regression evaluation')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed calls before the timed ones')
+    parser.add_argument('--threads', type=int, default=1, help='intra-op CPU threads')
+    parser.add_argument('--inline', action='store_true', help='run all benchmarks in this process')
+    parser.add_argument('--baseline', type=str, default=os.path.join(ROOT, 'benchmarks', 'baseline.json'),
+                        help='stored results to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='overwrite the baseline with these results')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown or memory growth')
+    parser.add_argument('--output', type=str, default=None, help='also write the results to this JSON file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    names = args.only or list(BENCHMARKS)
+    config_keys = ('ways', 'shots', 'queries', 'dp_batch', 'image_size', 'client_images', 'fine_tune_steps', 'clients',
+                   'eval_episodes', 'threads')
+    config = {k: getattr(args, k) for k in config_keys}
+    cfg = SimpleNamespace(repeat=args.repeat, warmup=args.warmup, **config)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored.get('config') == config:
+            baseline = stored['results']
+        else:
+            print('Baseline {} was recorded with {}, not comparing.'.format(args.baseline, stored.get('config')))
+
+    results = OrderedDict()
+    print('{:<30} {:>11} {:>11} {:>9} {:>9}'.format('benchmark', 'median ms', 'p95 ms', 'peak MB', 'vs base'))
+    for name in names:
+        results[name] = run_benchmark(name, cfg) if args.inline else _run_isolated(name, cfg)
+        result, base = results[name], baseline.get(name)
+        ratio = '{:.2f}x'.format(result['median_ms'] / base['median_ms']) if base else '-'
+        flag = '  REGRESSION' if compare({name: result}, baseline, args.tolerance) else ''
+        print('{:<30} {:>11.2f} {:>11.2f} {:>9.1f} {:>9}{}'.format(
+            name, result['median_ms'], result['p95_ms'], result['peak_mb'], ratio, flag))
+
+    payload = {'config': config, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(payload, f, indent=2)
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                stored = json.load(f)
+            # keep the benchmarks that were not rerun
+            if stored.get('config') == config:
+                stored['results'].update(results)
+                payload['results'] = stored['results']
+        with open(args.baseline, 'w') as f:
+            json.dump(payload, f, indent=2)
+        print('Baseline written to {}'.format(args.baseline))
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
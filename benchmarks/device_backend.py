@@ -0,0 +1,86 @@
+"""Compare the CPU and GPU backends on the same synthetic meta-training step.
+
+Example::
+
+    python benchmarks/device_backend.py --devices cpu cuda:0 --threads 1 4 8
+
+Every configuration runs the all-classify forward/backward of ModelFed_Adp on
+an ``N * (K + Q)`` episode of random images followed by the few-shot forward,
+which is the bulk of a client's inner loop.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import ModelFed_Adp
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', nargs='+', default=['cpu', 'cuda:0'], help='devices to compare')
+    parser.add_argument('--threads', nargs='+', type=int, default=[0], help='intra-op CPU threads to try (0: torch default)')
+    parser.add_argument('--dataset', type=str, default='FC100', help='FC100 (32x32) or miniImageNet (84x84)')
+    parser.add_argument('--N', type=int, default=20, help='ways of the synthetic episode')
+    parser.add_argument('--K', type=int, default=2, help='shots of the synthetic episode')
+    parser.add_argument('--Q', type=int, default=2, help='queries of the synthetic episode')
+    parser.add_argument('--out_dim', type=int, default=256)
+    parser.add_argument('--total_classes', type=int, default=60)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--iters', type=int, default=10)
+    return parser.parse_args()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_step(net, x, y):
+    _, _, out_all = net(x, all_classify=True)
+    F.cross_entropy(out_all, y).backward()
+    net(x)
+    net.zero_grad(set_to_none=True)
+
+
+def bench(args, device, num_threads):
+    if device.type == 'cpu' and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(0)
+    size = 32 if args.dataset == 'FC100' else 84
+    net = ModelFed_Adp('resnet12', args.out_dim, args.N, args.total_classes, None, args).to(device)
+    net.train()
+    n = args.N * (args.K + args.Q)
+    x = torch.randn(n, 3, size, size, device=device)
+    y = torch.randint(0, args.total_classes, (n,), device=device)
+
+    for _ in range(args.warmup):
+        run_step(net, x, y)
+    times = []
+    for _ in range(args.iters):
+        synchronize(device)
+        start = time.perf_counter()
+        run_step(net, x, y)
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return np.median(times), np.percentile(times, 95)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    args.use_transform_layer = 1
+    print('{:<10} {:>8} {:>12} {:>12}'.format('device', 'threads', 'median (ms)', 'p95 (ms)'))
+    for name in args.devices:
+        device = torch.device(name)
+        if device.type == 'cuda' and not torch.cuda.is_available():
+            print('{:<10} skipped, CUDA is not available'.format(name))
+            continue
+        for num_threads in (args.threads if device.type == 'cpu' else [0]):
+            median, p95 = bench(args, device, num_threads)
+            print('{:<10} {:>8} {:>12.1f} {:>12.1f}'.format(
+                name, num_threads or torch.get_num_threads(), median * 1000, p95 * 1000))
@@ -0,0 +1,229 @@
+import math
+
+import torch
+
+
+def flatten_update(update):
+    """Return ``update`` (a dict of tensors) as one flat tensor.
+
+    Deltas from :func:`dp_utils.compute_noisy_delta` are consecutive views of
+    a single buffer; that buffer is returned as is instead of being copied.
+    """
+    values = list(update.values())
+    base = values[0]._base
+    if base is not None and base.dim() == 1 and base.numel() == sum(v.numel() for v in values):
+        offset = 0
+        for v in values:
+            if v._base is not base or v.storage_offset() != base.storage_offset() + offset or not v.is_contiguous():
+                break
+            offset += v.numel()
+        else:
+            return base
+    return torch.cat([v.reshape(-1) for v in values])
+
+
+def unflatten_update(flat, keys, shapes):
+    """Split ``flat`` back into a dict of views with the given keys and shapes."""
+    update = {}
+    offset = 0
+    for k, shape in zip(keys, shapes):
+        n = math.prod(shape)
+        update[k] = flat[offset:offset + n].view(shape)
+        offset += n
+    return update
+
+
+class CompressedUpdate(object):
+    """Payload of one compressed update, as it would travel over the network.
+
+    ``method`` is ``'none'`` (dense values), ``'int8'``/``'int4'`` (stochastic
+    block quantisation with one scale per block) or ``'topk'`` (indices and
+    values of the largest entries).
+    """
+
+    def __init__(self, method, keys, shapes, numel, dtype, payload, block_size=None):
+        self.method = method
+        self.keys = keys
+        self.shapes = shapes
+        self.numel = numel
+        self.dtype = dtype
+        self.payload = payload
+        self.block_size = block_size
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.payload.values())
+
+    @property
+    def dense_nbytes(self):
+        return self.numel * torch.finfo(self.dtype).bits // 8
+
+    def add_to(self, out, alpha=1.0, chunk_blocks=1024):
+        """``out += alpha * decompress(self)`` on a flat buffer.
+
+        Quantised payloads are dequantised ``chunk_blocks`` blocks at a time
+        and sparse ones are scattered with ``index_add_``, so no dense copy of
+        the client update is ever built.
+        """
+        if self.method == 'none':
+            out.add_(self.payload['values'], alpha=alpha)
+        elif self.method == 'topk':
+            out.index_add_(0, self.payload['indices'].long(), self.payload['values'], alpha=alpha)
+        else:
+            chunk = chunk_blocks * self.block_size
+            for start in range(0, self.numel, chunk):
+                end = min(start + chunk, self.numel)
+                out[start:end].add_(self._dequantize(start, end), alpha=alpha)
+        return out
+
+    def decompress(self):
+        flat = torch.zeros(self.numel, dtype=self.dtype, device=next(iter(self.payload.values())).device)
+        return unflatten_update(self.add_to(flat), self.keys, self.shapes)
+
+    def _dequantize(self, start, end):
+        first_block, last_block = start // self.block_size, -(-end // self.block_size)
+        if self.method == 'int8':
+            q = self.payload['values'][start:end].to(self.dtype)
+        else:
+            packed = self.payload['values'][start // 2:-(-end // 2)]
+            q = torch.stack([(packed & 0x0F), (packed >> 4)], dim=1).reshape(-1)[:end - start].to(self.dtype) - 8
+        scales = self.payload['scales'][first_block:last_block].repeat_interleave(self.block_size)
+        return q * scales[:end - start]
+
+
+class UpdateCompressor(object):
+    """Client-side compression of flat updates with per-client error feedback.
+
+    Parameters
+    ----------
+    method : str, optional
+        ``'none'``, ``'int8'``, ``'int4'`` or ``'topk'``.
+    topk_ratio : float, optional
+        Fraction of entries kept by ``'topk'``.
+    error_feedback : bool, optional
+        Keep what compression dropped from a client's update and add it to
+        that client's next update.
+    block_size : int, optional
+        Number of entries sharing one quantisation scale.
+    """
+
+    METHODS = ('none', 'int8', 'int4', 'topk')
+
+    def __init__(self, method='none', topk_ratio=0.01, error_feedback=True, block_size=256):
+        if method not in self.METHODS:
+            raise ValueError("Unknown compression method {}, expected one of {}".format(method, self.METHODS))
+        self.method = method
+        self.topk_ratio = topk_ratio
+        self.error_feedback = error_feedback and method != 'none'
+        self.block_size = block_size
+        self.residuals = {}
+
+    def compress(self, client_id, update):
+        keys = list(update.keys())
+        shapes = [tuple(v.shape) for v in update.values()]
+        flat = flatten_update(update)
+        owns_flat = False
+        if self.error_feedback and client_id in self.residuals:
+            flat = flat + self.residuals[client_id]
+            owns_flat = True
+
+        if self.method == 'none':
+            payload = {'values': flat}
+        elif self.method == 'topk':
+            k = max(1, int(self.topk_ratio * flat.numel()))
+            indices = torch.topk(flat.abs(), k, sorted=False).indices
+            payload = {'indices': indices.to(torch.int32), 'values': flat[indices]}
+        else:
+            payload = self._quantize(flat, 127 if self.method == 'int8' else 7)
+
+        compressed = CompressedUpdate(self.method, keys, shapes, flat.numel(), flat.dtype, payload,
+                                      block_size=self.block_size)
+        if self.error_feedback:
+            # residual = flat - decompress(compressed); the caller's buffer is left alone
+            residual = flat if owns_flat else flat.clone()
+            self.residuals[client_id] = compressed.add_to(residual, alpha=-1.0)
+        return compressed
+
+    def _quantize(self, flat, levels):
+        numel = flat.numel()
+        num_blocks = -(-numel // self.block_size)
+        padded = torch.nn.functional.pad(flat, (0, num_blocks * self.block_size - numel)).view(num_blocks, -1)
+        scales = padded.abs().amax(dim=1) / levels
+        scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+        # stochastic rounding keeps the quantiser unbiased
+        q = torch.floor(padded / scales[:, None] + torch.rand_like(padded)).clamp_(-levels, levels)
+        q = q.view(-1)[:numel]
+        if levels == 127:
+            values = q.to(torch.int8)
+        else:
+            nibbles = (q + 8).to(torch.uint8)
+            if numel % 2:
+                nibbles = torch.cat([nibbles, nibbles.new_full((1,), 8)])
+            nibbles = nibbles.view(-1, 2)
+            values = nibbles[:, 0] | (nibbles[:, 1] << 4)
+        return {'values': values, 'scales': scales}
+
+
+def aggregate_updates(updates, weights):
+    """Weighted sum of compressed updates into one flat buffer.
+
+    Returns a dict of views into that buffer, keyed like the client updates.
+    """
+    updates = list(updates)
+    first = updates[0]
+    device = next(iter(first.payload.values())).device
+    flat = torch.zeros(first.numel, dtype=first.dtype, device=device)
+    for update, weight in zip(updates, weights):
+        update.add_to(flat, alpha=weight)
+    return unflatten_update(flat, first.keys, first.shapes)
+
+
+class BroadcastEncoder(object):
+    """Delta-encode the global model against each client's last received copy.
+
+    The server mirrors what every client holds. A sync sends the compressed
+    difference between the current global weights and that mirror and applies
+    the same decoded difference to the mirror, so whatever compression left
+    out is sent again with the next diff. Clients that have never been synced,
+    or whose copy is more than ``max_staleness`` versions old, get a full copy.
+
+    Parameters
+    ----------
+    keys : list of str
+        Floating-point entries of the global state dict that are broadcast.
+    method, topk_ratio, block_size
+        Compression of the diffs, see :class:`UpdateCompressor`.
+    max_staleness : int, optional
+        Largest version gap still served with a diff.
+    """
+
+    def __init__(self, keys, method='none', topk_ratio=0.01, block_size=256, max_staleness=5):
+        self.keys = list(keys)
+        self.compressor = UpdateCompressor(method, topk_ratio=topk_ratio, error_feedback=False, block_size=block_size)
+        self.max_staleness = max_staleness
+        self.mirrors = {}
+        self.versions = {}
+
+    def sync(self, client_id, global_params, version):
+        """Bring ``client_id`` to ``version`` of ``global_params``.
+
+        Returns
+        -------
+        params : dict
+            The weights the client now holds for ``keys``.
+        nbytes : int
+            Bytes sent to the client.
+        """
+        target = torch.cat([global_params[k].reshape(-1) for k in self.keys])
+        shapes = [tuple(global_params[k].shape) for k in self.keys]
+        mirror = self.mirrors.get(client_id)
+        stale = mirror is None or version - self.versions[client_id] > self.max_staleness
+        if stale or self.compressor.method == 'none':
+            self.mirrors[client_id] = mirror = target
+            nbytes = target.numel() * target.element_size()
+        else:
+            diff = self.compressor.compress(client_id, {'diff': target.sub_(mirror)})
+            diff.add_to(mirror)
+            nbytes = diff.nbytes
+        self.versions[client_id] = version
+        return unflatten_update(mirror, self.keys, shapes), nbytes
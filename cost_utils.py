@@ -0,0 +1,137 @@
+import csv
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+
+import torch
+
+
+class CostTracker(object):
+    """Per-round communication and compute costs of every client.
+
+    Time is measured with laps: :meth:`lap` charges the time since the
+    previous lap of the same client to a phase, so a sequence of steps is
+    timed by one call after each of them. Bytes are whatever the caller
+    reports for the payloads it actually sends. :meth:`end_round` writes one
+    row per client and one ``'server'`` row, to a CSV file if ``path`` ends in
+    ``.csv`` and to JSON lines otherwise.
+
+    ``peak_rss_mb`` is the peak resident set size during the round. Where the
+    kernel does not let the process reset its high-water mark (outside Linux,
+    or without write access to ``/proc/self/clear_refs``) it falls back to the
+    peak over the lifetime of the process.
+
+    Parameters
+    ----------
+    path : str, optional
+        Output file, appended to. Without a path the tracker is disabled and
+        every method returns immediately.
+    device : str or torch.device, optional
+        CUDA laps synchronise with this device so that asynchronous kernels
+        are charged to the phase that launched them.
+    """
+
+    PHASES = ('sampling', 'forward', 'inner_loop', 'dp_step', 'eval', 'broadcast', 'upload', 'aggregation')
+    FIELDS = (['round', 'client', 'download_bytes', 'upload_bytes'] + ['{}_s'.format(p) for p in PHASES]
+              + ['round_s', 'peak_cuda_mb', 'peak_rss_mb'])
+
+    def __init__(self, path=None, device=None):
+        self.path = path
+        self.enabled = path is not None
+        self.device = torch.device(device) if device is not None else None
+        self._cuda = self.enabled and self.device is not None and self.device.type == 'cuda' and torch.cuda.is_available()
+        self.round = None
+        self._rows = {}
+        self._last = {}
+        self._round_start = None
+
+    def start_round(self, round):
+        if not self.enabled:
+            return
+        self.round = round
+        self._rows = defaultdict(lambda: defaultdict(int))
+        self._last = {}
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        _reset_peak_rss()
+        self._round_start = self._now()
+
+    def lap(self, client, phase=None):
+        """Charge the time since the last lap of ``client`` to ``phase``.
+
+        Without ``phase`` the clock of ``client`` is only restarted.
+        """
+        if not self.enabled:
+            return
+        now = self._now()
+        if phase is not None and client in self._last:
+            self._rows[client][phase + '_s'] += now - self._last[client]
+        self._last[client] = now
+
+    def add_bytes(self, client, download=0, upload=0):
+        if not self.enabled:
+            return
+        self._rows[client]['download_bytes'] += download
+        self._rows[client]['upload_bytes'] += upload
+
+    def end_round(self):
+        """Write the rows of the current round and return them."""
+        if not self.enabled:
+            return []
+        server = self._rows['server']
+        server['round_s'] = self._now() - self._round_start
+        if self._cuda:
+            server['peak_cuda_mb'] = torch.cuda.max_memory_allocated(self.device) / 2**20
+        server['peak_rss_mb'] = _peak_rss_mb()
+
+        rows = []
+        for client in sorted((c for c in self._rows if c != 'server'), key=str) + ['server']:
+            row = dict.fromkeys(self.FIELDS, 0)
+            row.update(self._rows[client])
+            row.update(round=self.round, client=client)
+            rows.append(row)
+        self._write(rows)
+        return rows
+
+    def _now(self):
+        if self._cuda:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _write(self, rows):
+        if self.path.endswith('.csv'):
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(self.path, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process, returning whether it worked."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak RSS in MB since the last :func:`_reset_peak_rss`."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and never resets
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
@@ -178,7 +178,8 @@ def _load_json(path):
 
             item = {
                 'label': int(row['label']),
-                'text': row['text'][:500]  # truncate the text to 500 tokens
+                'text': row['text'][:500],  # truncate the text to 500 tokens
+                'doc_id': len(data)  # line in the data file
             }
 
             text_len.append(len(row['text']))
@@ -267,6 +268,8 @@ def _data_to_nparray(data, vocab, vocab_size, max_text_len=None):
     '''
     doc_label = np.array([x['label'] for x in data], dtype=np.int64)
 
+    doc_id = np.array([x['doc_id'] for x in data], dtype=np.int64)
+
     raw = np.array([e['text'] for e in data], dtype=object)
 
     # compute the max text length
@@ -294,13 +297,14 @@ def _data_to_nparray(data, vocab, vocab_size, max_text_len=None):
 
     # vocab_size = vocab.vectors.size()[0]
 
-    text_len, text, doc_label, raw = _del_by_idx(
-        [text_len, text, doc_label, raw], del_idx, 0)
+    text_len, text, doc_label, doc_id, raw = _del_by_idx(
+        [text_len, text, doc_label, doc_id, raw], del_idx, 0)
 
     new_data = {
         'text': text,
         'text_len': text_len,
         'label': doc_label,
+        'doc_id': doc_id,
         'raw': raw,
         'vocab_size': vocab_size,
     }
@@ -314,6 +318,8 @@ def data_to_nparray(data, stoi, vocab_size, max_text_len=None):
     '''
     doc_label = np.array([x['label'] for x in data], dtype=np.int64)
 
+    doc_id = np.array([x['doc_id'] for x in data], dtype=np.int64)
+
     raw = np.array([e['text'] for e in data], dtype=object)
 
     # compute the max text length
@@ -348,6 +354,7 @@ def data_to_nparray(data, stoi, vocab_size, max_text_len=None):
         'text': text,
         'text_len': text_len,
         'label': doc_label,
+        'doc_id': doc_id,
         'raw': raw,
         'vocab_size': vocab_size,
     }
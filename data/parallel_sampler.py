@@ -1,6 +1,8 @@
 import time
 import datetime
-from multiprocessing import Process, Queue, cpu_count
+from math import comb
+from multiprocessing import Lock, Process, Queue, cpu_count
+from multiprocessing.sharedctypes import RawArray
 
 import torch
 import numpy as np
@@ -10,6 +12,10 @@ from transformers import BertModel
 import data.utils as utils
 import data.stats as stats
 
+# every 5-way task over huffpost's 20 training classes has its own source
+# classes, C(20, 5) = 15504 of them; smaller class sets are capped below
+DEFAULT_STATS_CACHE_SIZE = 15504
+
 
 class ParallelSampler():
     def __init__(self, data, args, num_episodes=None):
@@ -27,6 +33,27 @@ class ParallelSampler():
             self.idx_list.append(
                     np.squeeze(np.argwhere(self.data['label'] == y)))
 
+        self.stats_names = []
+        if self.args.embedding in ['idf', 'meta', 'meta_mlp']:
+            self.stats_names.append('idf')
+        if self.args.embedding in ['iwf', 'meta', 'meta_mlp']:
+            self.stats_names.append('iwf')
+
+        self.stats_cache = None
+        if 'is_train' in self.data and self.stats_names:
+            # build the per-class doc-term counts once, before the workers fork
+            stats.class_term_counts(self.data)
+
+            # the statistics only depend on the sampled ways, and there are
+            # no more than C(num_classes, way) different sets of them
+            cache_size = min(getattr(self.args, 'stats_cache_size',
+                                     DEFAULT_STATS_CACHE_SIZE),
+                             comb(self.num_classes, self.args.way))
+            if cache_size > 0:
+                self.stats_cache = SharedStatsCache(
+                        cache_size, self.num_classes, self.data['vocab_size'],
+                        self.stats_names)
+
         self.count = 0
         self.done_queue = Queue()
 
@@ -46,8 +73,9 @@ class ParallelSampler():
             support, query = self.done_queue.get()
 
             # convert to torch.tensor
-            support = utils.to_tensor(support, self.args.cuda, ['raw'])
-            query = utils.to_tensor(query, self.args.cuda, ['raw'])
+            # document ids stay on the host for the bert feature store
+            support = utils.to_tensor(support, self.args.cuda, ['raw', 'doc_id'])
+            query = utils.to_tensor(query, self.args.cuda, ['raw', 'doc_id'])
 
             if self.args.meta_w_target:
                 if self.args.meta_target_entropy:
@@ -66,6 +94,26 @@ class ParallelSampler():
 
             yield support, query
 
+        if self.stats_cache is not None:
+            hits, misses = self.stats_cache.counts()
+            utils.tprint('idf/iwf cache: {} hits, {} misses, hit rate {:.1%}'.format(
+                hits, misses, hits / max(1, hits + misses)))
+
+    def source_stats(self, source_classes):
+        '''
+            idf and/or iwf over the source classes, as needed by the embedding
+        '''
+        values = {}
+        if 'idf' in self.stats_names:
+            # compute inverse document frequency over the meta-train set
+            values['idf'] = stats.get_idf(self.data, source_classes)
+
+        if 'iwf' in self.stats_names:
+            # compute SIF over the meta-train set
+            values['iwf'] = stats.get_iwf(self.data, source_classes)
+
+        return values
+
     def worker(self, done_queue):
         '''
             Generate one task (support and query).
@@ -109,17 +157,23 @@ class ParallelSampler():
             query = utils.select_subset(self.data, {}, ['text', 'text_len', 'label'],
                                    query_idx, max_query_len)
 
-            if self.args.embedding in ['idf', 'meta', 'meta_mlp']:
-                # compute inverse document frequency over the meta-train set
-                idf = stats.get_idf(self.data, source_classes)
-                support['idf'] = idf
-                query['idf'] = idf
+            if 'doc_id' in self.data:
+                support = utils.select_subset(
+                        self.data, support, ['doc_id'], support_idx)
+                query = utils.select_subset(
+                        self.data, query, ['doc_id'], query_idx)
 
-            if self.args.embedding in ['iwf', 'meta', 'meta_mlp']:
-                # compute SIF over the meta-train set
-                iwf = stats.get_iwf(self.data, source_classes)
-                support['iwf'] = iwf
-                query['iwf'] = iwf
+            if self.stats_cache is not None:
+                source_mask = np.ones(self.num_classes, dtype=np.int8)
+                source_mask[sampled_classes] = 0
+                values = self.stats_cache.get(
+                        source_mask, lambda: self.source_stats(source_classes))
+            else:
+                values = self.source_stats(source_classes)
+
+            for name, value in values.items():
+                support[name] = value
+                query[name] = value
 
             if 'pos' in self.args.auxiliary:
                support = utils.select_subset(
@@ -137,3 +191,107 @@ class ParallelSampler():
             self.p_list[i].terminate()
 
         del self.done_queue
+
+
+class SharedStatsCache():
+    '''
+        Bounded LRU cache of the idf/iwf of a set of source classes. The
+        entries live in shared memory, so all the workers of a ParallelSampler
+        see what any of them computed. Create it before the workers start.
+    '''
+    def __init__(self, capacity, num_classes, vocab_size, names):
+        '''
+            @param capacity: number of source class sets kept
+            @param num_classes: length of the source class masks
+            @param vocab_size: length of every statistic
+            @param names: the statistics of an entry, e.g. ['idf', 'iwf']
+        '''
+        self.capacity = capacity
+        self.num_classes = num_classes
+        self.vocab_size = vocab_size
+        self.names = list(names)
+
+        self.lock = Lock()
+        self.raw = {
+            # source classes of every entry, as a mask over all classes
+            'masks': RawArray('b', capacity * num_classes),
+            # clock of the last use of every entry, 0 for an empty one
+            'last_used': RawArray('q', capacity),
+            # clock, hits, misses
+            'counters': RawArray('q', 3),
+        }
+        for name in self.names:
+            self.raw[name] = RawArray('f', capacity * vocab_size)
+
+        self._make_views()
+
+    def _make_views(self):
+        self.masks = np.frombuffer(self.raw['masks'], dtype=np.int8).reshape(
+                self.capacity, self.num_classes)
+        self.last_used = np.frombuffer(self.raw['last_used'], dtype=np.int64)
+        self.counters = np.frombuffer(self.raw['counters'], dtype=np.int64)
+        self.values = {
+                name: np.frombuffer(self.raw[name], dtype=np.float32).reshape(
+                    self.capacity, self.vocab_size, 1)
+                for name in self.names}
+
+    def __getstate__(self):
+        # numpy views would be pickled as copies, rebuild them in the worker
+        state = dict(self.__dict__)
+        for key in ['masks', 'last_used', 'counters', 'values']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def _find(self, mask):
+        slots = np.flatnonzero(
+                (self.last_used > 0) & np.all(self.masks == mask, axis=1))
+        return slots[0] if len(slots) > 0 else None
+
+    def _touch(self, slot):
+        self.counters[0] += 1
+        self.last_used[slot] = self.counters[0]
+
+    def get(self, mask, compute):
+        '''
+            @param mask: num_classes np array, 1 for the source classes
+            @param compute: called on a miss, returns a dict of the statistics,
+            each a vocab_size * 1 np array
+
+            @return: dict of the statistics
+        '''
+        with self.lock:
+            slot = self._find(mask)
+            if slot is not None:
+                self._touch(slot)
+                self.counters[1] += 1
+                # copied, the entry may be evicted once the lock is released
+                return {name: self.values[name][slot].copy()
+                        for name in self.names}
+            self.counters[2] += 1
+
+        # computed without the lock, the other workers keep sampling
+        values = compute()
+
+        with self.lock:
+            # another worker may have added the same entry meanwhile
+            slot = self._find(mask)
+            if slot is None:
+                # least recently used, empty entries first
+                slot = int(np.argmin(self.last_used))
+                self.masks[slot] = mask
+                for name in self.names:
+                    self.values[name][slot] = values[name]
+            self._touch(slot)
+
+        return values
+
+    def counts(self):
+        '''
+            @return hits, misses: over all workers so far
+        '''
+        with self.lock:
+            return int(self.counters[1]), int(self.counters[2])
@@ -1,11 +1,11 @@
 import os
-from collections import defaultdict
 from tqdm import tqdm
 from termcolor import colored
 import torch.nn.functional as F
 import torch.nn as nn
 import torch
 import numpy as np
+import scipy.sparse as sp
 from math import isnan
 
 
@@ -28,6 +28,48 @@ def _subset_selection(data, classes):
             }
 
 
+def class_term_counts(data):
+    '''
+        Per-class statistics of the sparse document-term matrix, computed
+        during the first run and cached in data:
+        'stat_classes': sorted class labels, one row of the matrices below each
+        'n_d': classes * vocab_size csr, number of documents containing a token
+        'n_t': classes * vocab_size csr, number of occurrences of a token
+    '''
+    if 'n_t' not in data:
+        text = data['text']
+        n_docs, width = text.shape
+
+        # documents * vocab_size term counts, duplicates are summed by csr
+        doc_term = sp.csr_matrix(
+                (np.ones(text.size, dtype=np.float32),
+                 (np.repeat(np.arange(n_docs), width), text.ravel())),
+                shape=(n_docs, data['vocab_size']))
+        doc_term.sum_duplicates()
+
+        # classes * documents indicator, to sum the rows of each class
+        classes, doc_class = np.unique(data['label'], return_inverse=True)
+        class_doc = sp.csr_matrix(
+                (np.ones(n_docs, dtype=np.float32), (doc_class, np.arange(n_docs))),
+                shape=(len(classes), n_docs))
+
+        data['stat_classes'] = classes
+        data['n_t'] = class_doc @ doc_term
+        data['n_d'] = class_doc @ (doc_term > 0).astype(np.float32)
+
+    return data['stat_classes'], data['n_d'], data['n_t']
+
+
+def _class_sum(stat_classes, counts, classes):
+    '''
+        Sum the rows of counts of the given classes (all if None)
+        @return: vocab_size np array
+    '''
+    if classes is not None:
+        counts = counts[np.searchsorted(stat_classes, classes)]
+    return np.asarray(counts.sum(axis=0), dtype=np.float32).ravel()
+
+
 def _compute_idf(data, classes=None):
     '''
         Compute idf over the train data
@@ -35,25 +77,8 @@ def _compute_idf(data, classes=None):
     '''
     data_len = len(data['label'])
 
-    if 'n_d' not in data:
-        # finding documents belong to each class label
-        unique_text = defaultdict(list)
-        for i in range(data_len):
-            unique_text[data['label'][i]].append(np.unique(data['text'][i,:]))
-
-        # computing num of occurrences for each class label
-        data['n_d'] = {}
-        for key, value in unique_text.items():
-            total_text = np.concatenate(value)
-            idx, counts = np.unique(total_text, return_counts=True)
-            data['n_d'][key] = (idx, counts)
-
-    if classes is None:
-        classes = np.unique(data['label'])
-
-    n_t = np.zeros(data['vocab_size'], dtype=np.float32)
-    for key in classes:
-        n_t[data['n_d'][key][0]] += data['n_d'][key][1]
+    stat_classes, n_d, _ = class_term_counts(data)
+    n_t = _class_sum(stat_classes, n_d, classes)
 
     idf = np.log(data_len / (1.0 + n_t))
     idf[idf<0] = 0
@@ -67,28 +92,8 @@ def _compute_iwf(data, classes=None):
         Compute sif features over the train data
         Compute the statistics during the first run
     '''
-    data_len = len(data['label'])
-
-    if 'n_t' not in data:
-        # finding documents belong to each class label
-        data['n_t'] = {}
-        for i in range(data_len):
-            idx, counts = np.unique(data['text'][i,:], return_counts=True)
-            if data['label'][i] not in data['n_t']:
-                data['n_t'][data['label'][i]] = np.zeros(
-                        data['vocab_size'], dtype=np.float32)
-
-            data['n_t'][data['label'][i]][idx] += counts
-
-
-    if classes is None:
-        classes = np.unique(data['label'])
-
-    n_tokens = np.zeros((len(classes), data['vocab_size']), dtype=np.float32)
-    for i, key in enumerate(classes):
-        n_tokens[i,:] = data['n_t'][key]
-
-    n_tokens_sum = np.sum(n_tokens, axis=0, keepdims=True)
+    stat_classes, _, n_t = class_term_counts(data)
+    n_tokens_sum = _class_sum(stat_classes, n_t, classes)[None, :]
     n_total = np.sum(n_tokens_sum)
 
     p_t = n_tokens_sum / n_total
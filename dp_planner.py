@@ -0,0 +1,145 @@
+"""Pick ``--noise_multiplier`` from a privacy budget instead of by trial runs.
+
+Example::
+
+    python dp_planner.py --target_eps 1 4 8 --dp_delta 1e-5 --comm_round 100 \
+        --sample_fraction 0.1 0.5 --num_train_tasks 50 --N 20 --K 2 --Q 2 --client_data_size 500
+
+For every configuration the smallest noise multiplier whose projected epsilon
+stays within the target is found by bisection over the same RDP curves as
+``dp_utils.RDPAccountant``. The projection covers the client-level noise on
+the updates (one subsampled Gaussian step per round) and, if
+``--client_data_size`` is given, the local DP-SGD steps of a client that takes
+part in ``--dp_sgd_rounds`` rounds (every round by default, the worst case).
+Both mechanisms share the noise multiplier, as in ``main_image.py``.
+"""
+import argparse
+import itertools
+
+import numpy as np
+
+from dp_utils import DEFAULT_RDP_ORDERS, epsilon_per_order, subsampled_gaussian_rdp
+
+
+def round_rdp(noise_mult, sample_fraction, num_train_tasks=0, episode_size=0, client_data_size=0,
+              orders=DEFAULT_RDP_ORDERS):
+    """RDP per order that one round adds to every mechanism.
+
+    Returns
+    -------
+    dict
+        ``'client_delta'`` and, if ``client_data_size`` is set, ``'dp_sgd'``,
+        each an array over ``orders``.
+    """
+    rdp = {'client_delta': subsampled_gaussian_rdp(sample_fraction, noise_mult, orders)}
+    if client_data_size and num_train_tasks:
+        rdp['dp_sgd'] = num_train_tasks * subsampled_gaussian_rdp(min(1.0, episode_size / client_data_size), noise_mult,
+                                                                  orders)
+    return rdp
+
+
+def _epsilon(rdp, orders, delta):
+    # best order along the last axis; orders that overflow give nan
+    with np.errstate(invalid='ignore'):
+        return np.maximum(np.nanmin(epsilon_per_order(rdp, orders, delta), axis=-1), 0.0)
+
+
+def _rounds(mechanism, comm_round, dp_sgd_rounds):
+    if mechanism == 'dp_sgd' and dp_sgd_rounds is not None:
+        return np.minimum(comm_round, dp_sgd_rounds)
+    return comm_round
+
+
+def epsilon_curves(noise_mult, delta, comm_round, sample_fraction, num_train_tasks=0, episode_size=0,
+                   client_data_size=0, dp_sgd_rounds=None, orders=DEFAULT_RDP_ORDERS):
+    """Projected epsilon after every round.
+
+    Returns
+    -------
+    dict
+        ``'client_delta'`` and, if ``client_data_size`` is set, ``'dp_sgd'``,
+        each an array of length ``comm_round`` with the epsilon spent after
+        rounds ``1..comm_round``.
+    """
+    rounds = np.arange(1, comm_round + 1)
+    rdp = round_rdp(noise_mult, sample_fraction, num_train_tasks, episode_size, client_data_size, orders)
+    return {mechanism: _epsilon(_rounds(mechanism, rounds, dp_sgd_rounds)[:, None] * per_round[None, :], orders, delta)
+            for mechanism, per_round in rdp.items()}
+
+
+def plan_noise_multiplier(target_eps, delta, comm_round, sample_fraction, tol=1e-3, max_noise=1e4, num_train_tasks=0,
+                          episode_size=0, client_data_size=0, dp_sgd_rounds=None, orders=DEFAULT_RDP_ORDERS):
+    """Smallest noise multiplier whose final epsilon is at most ``target_eps``.
+
+    The remaining arguments are those of :func:`epsilon_curves`. Every
+    candidate costs one RDP vector per mechanism, the epsilon is only
+    evaluated after the last round.
+
+    Raises
+    ------
+    ValueError
+        If even ``max_noise`` does not meet the target.
+    """
+    def final_eps(noise_mult):
+        rdp = round_rdp(noise_mult, sample_fraction, num_train_tasks, episode_size, client_data_size, orders)
+        return max(_epsilon(_rounds(mechanism, comm_round, dp_sgd_rounds) * per_round, orders, delta)
+                   for mechanism, per_round in rdp.items())
+
+    hi = 1.0
+    while final_eps(hi) > target_eps:
+        hi *= 2
+        if hi > max_noise:
+            raise ValueError('target epsilon {} is not reachable with a noise multiplier up to {}'.format(
+                target_eps, max_noise))
+    lo = 0.0
+    while hi - lo > tol * hi:
+        mid = (lo + hi) / 2
+        if final_eps(mid) > target_eps:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target_eps', nargs='+', type=float, default=[8.0], help='epsilon budgets to plan for')
+    parser.add_argument('--dp_delta', type=float, default=1e-5, help='delta for DP accounting')
+    parser.add_argument('--comm_round', nargs='+', type=int, default=[50], help='number of communication rounds')
+    parser.add_argument('--sample_fraction', nargs='+', type=float, default=[1.0],
+                        help='fraction of clients sampled in each round')
+    parser.add_argument('--num_train_tasks', type=int, default=50, help='DP-SGD steps of a client per round')
+    parser.add_argument('--N', type=int, default=20, help='ways of a meta-training episode')
+    parser.add_argument('--K', type=int, default=2, help='shots of a meta-training episode')
+    parser.add_argument('--Q', type=int, default=2, help='queries of a meta-training episode')
+    parser.add_argument('--client_data_size', type=int, default=0,
+                        help='training examples per client, 0 leaves the DP-SGD steps out of the plan')
+    parser.add_argument('--dp_sgd_rounds', type=int, default=None,
+                        help='rounds a single client trains in (default: every round)')
+    parser.add_argument('--curve_every', type=int, default=0,
+                        help='print the projected epsilon every this many rounds (0: summary only)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    kwargs = dict(num_train_tasks=args.num_train_tasks, episode_size=args.N * (args.K + args.Q),
+                  client_data_size=args.client_data_size, dp_sgd_rounds=args.dp_sgd_rounds)
+    print('{:>10} {:>8} {:>10} {:>16} {:>14} {:>10}'.format(
+        'target_eps', 'rounds', 'fraction', 'noise_multiplier', 'client eps', 'DP-SGD eps'))
+    for target_eps, comm_round, sample_fraction in itertools.product(args.target_eps, args.comm_round, args.sample_fraction):
+        try:
+            noise_mult = plan_noise_multiplier(target_eps, args.dp_delta, comm_round, sample_fraction, **kwargs)
+        except ValueError:
+            print('{:>10g} {:>8} {:>10g} {:>16}'.format(target_eps, comm_round, sample_fraction, 'unreachable'))
+            continue
+        curves = epsilon_curves(noise_mult, args.dp_delta, comm_round, sample_fraction, **kwargs)
+        dp_sgd = curves['dp_sgd'][-1] if 'dp_sgd' in curves else float('nan')
+        print('{:>10g} {:>8} {:>10g} {:>16.4f} {:>14.4f} {:>10.4f}'.format(
+            target_eps, comm_round, sample_fraction, noise_mult, curves['client_delta'][-1], dp_sgd))
+        if args.curve_every:
+            for r in range(args.curve_every, comm_round + 1, args.curve_every):
+                line = '    round {:>5}: client eps {:.4f}'.format(r, curves['client_delta'][r - 1])
+                if 'dp_sgd' in curves:
+                    line += ', DP-SGD eps {:.4f}'.format(curves['dp_sgd'][r - 1])
+                print(line)
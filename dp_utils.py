@@ -1,16 +1,50 @@
+import copy
 import math
+from collections import OrderedDict
+
+import numpy as np
 import torch
+import torch.nn as nn
+from scipy.special import binom, gammaln, log_ndtr, logsumexp
+
+from opacus_custom_samplers import convert_mha_to_cached
+from opacus import GradSampleModule
 
 
-def compute_noisy_delta(global_params, local_params, clip_norm, noise_mult):
+def compute_noisy_delta(global_params, local_params, clip_norm, noise_mult, generator=None, return_stats=False):
     """Compute clipped and noised updates for differential privacy.
 
     Parameters whose names begin with ``"transform_layer."`` or are equal to
     ``"few_classify.weight"`` or ``"few_classify.bias"`` are skipped so that
     personalized components and client-specific classifiers are never
     aggregated or shared.
+
+    The delta is written once into a single flat buffer; the norm, the
+    clipping and the noise are then applied in place on that buffer, with one
+    draw from the random generator, and without synchronising with the device.
+
+    Parameters
+    ----------
+    global_params, local_params : dict
+        State dicts of the broadcast model and of the trained client model.
+    clip_norm : float
+        Maximum L2 norm of the whole update.
+    noise_mult : float
+        Standard deviation of the Gaussian noise in units of ``clip_norm``.
+    generator : torch.Generator, optional
+        Random generator used for the noise.
+    return_stats : bool, optional
+        Also return diagnostics: the unclipped and clipped norms and the first
+        values of the update before noise, all as tensors.
+
+    Returns
+    -------
+    delta : dict
+        Views into the flat buffer, one per aggregated parameter.
+    stats : dict or None
+        Diagnostics if ``return_stats`` is set, otherwise ``None``.
     """
-    delta = {}
+    keys = []
     for k in global_params:
         if (
             k.startswith("transform_layer.")
@@ -21,60 +55,269 @@ def compute_noisy_delta(global_params, local_params, clip_norm, noise_mult):
         if not torch.is_floating_point(global_params[k]):
             # integer buffers like num_batches_tracked are left unchanged
             continue
-        delta[k] = local_params[k] - global_params[k]
+        keys.append(k)
 
-    if not delta:
-        return {}, {}
+    if not keys:
+        return {}, None
 
-    vec = torch.cat([v.view(-1) for v in delta.values()])
-    norm = torch.norm(vec)
+    first = global_params[keys[0]]
+    flat = torch.empty(sum(global_params[k].numel() for k in keys), dtype=first.dtype, device=first.device)
+    delta = {}
+    offset = 0
+    for k in keys:
+        n = global_params[k].numel()
+        out = flat[offset:offset + n]
+        torch.sub(local_params[k].reshape(-1), global_params[k].reshape(-1), out=out)
+        delta[k] = out.view(global_params[k].shape)
+        offset += n
 
-    print(f"DEBUG: Unclipped Delta Norm = {norm.item()}")
+    norm = torch.linalg.vector_norm(flat)
+    scale = (clip_norm / (norm + 1e-12)).clamp(max=1.0)
+    flat.mul_(scale)
 
-    scale = min(1.0, clip_norm / (norm + 1e-12))
+    stats = None
+    if return_stats:
+        stats = {'norm': norm, 'clipped_norm': norm * scale, 'sample_before_noise': flat[:3].clone()}
 
-    print(f"DEBUG: Clipped Norm = {norm.item() * scale: .4f}")
+    if noise_mult > 0:
+        noise = torch.randn(flat.shape, generator=generator, dtype=flat.dtype, device=flat.device)
+        flat.add_(noise, alpha=clip_norm * noise_mult)
 
-    for k in delta:
-        delta[k] = delta[k] * scale
+    return delta, stats
 
-    delta_before_noise = {k: v.clone() for k, v in delta.items()}
 
-    if noise_mult > 0:
-        std = clip_norm * noise_mult
-        for k in delta:
-            delta[k] += torch.normal(0, std, size=delta[k].size(), device=delta[k].device)
+def wrap_dp_submodules(container, indices):
+    """Attach Opacus per-sample gradient hooks to selected children only.
+
+    Each ``container[i]`` for ``i`` in ``indices`` is wrapped in its own
+    ``GradSampleModule``; the remaining children are left untouched so no hooks
+    run and no ``grad_sample`` is allocated for parameters that are not part of
+    the loss.
+
+    Parameters
+    ----------
+    container : torch.nn.Sequential
+        Module whose children are wrapped in place.
+    indices : iterable of int
+        Children that contribute to the loss.
+
+    Returns
+    -------
+    list of torch.nn.Parameter
+        Trainable parameters of the wrapped children, to be handed to the
+        ``DPOptimizer``.
+    """
+    params = []
+    for i in indices:
+        if not isinstance(container[i], GradSampleModule):
+            container[i] = GradSampleModule(convert_mha_to_cached(container[i]))
+        params.extend(p for p in container[i].parameters() if p.requires_grad)
+    return params
+
+
+def disable_grad_sample(module):
+    """Switch off the per-sample hooks of every ``GradSampleModule`` below ``module``.
+
+    Meant for throw-away copies of a wrapped model (e.g. the ``deepcopy`` used
+    for the few-shot fine-tuning) that are trained without DP: their hooks
+    would only cost time, and the activations copied from the original are
+    dropped as well.
+    """
+    for m in module.modules():
+        if isinstance(m, GradSampleModule):
+            m.disable_hooks()
+        if hasattr(m, 'activations'):
+            del m.activations
+    return module
+
+
+def inner_loop_copy(net):
+    """Copy of ``net`` for the inner loop, sharing the word embeddings.
+
+    The inner loop only adapts ``few_classify`` and the gradients that reach
+    the copy are dropped, so the embedding matrix of a text model is shared
+    frozen rather than copied every episode.
+    """
+    memo = {}
+    if hasattr(net, 'ebd'):
+        for p in net.ebd.parameters():
+            memo[id(p)] = nn.Parameter(p.detach(), requires_grad=False)
+    return disable_grad_sample(copy.deepcopy(net, memo))
+
+
+def strip_grad_sample_prefix(state_dict):
+    """Return ``state_dict`` with the ``_module.`` level added by ``GradSampleModule`` removed.
+
+    This maps the keys of a wrapped client model back onto the keys of the
+    plain global model.
+    """
+    return OrderedDict((k.replace('_module.', ''), v) for k, v in state_dict.items())
+
+
+# fractional orders below 11 give the tightest epsilon for large budgets
+DEFAULT_RDP_ORDERS = np.unique(np.concatenate([1 + np.arange(1, 101) / 10.0, np.arange(2, 257)]))
+
 
-    return delta, delta_before_noise
+def _log_sub(a, b):
+    # log(exp(a) - exp(b)) for a >= b
+    if b == -np.inf:
+        return a
+    return a + math.log1p(-math.exp(b - a)) if b < a else -np.inf
 
 
-def compute_epsilon(num_steps, noise_mult, delta, accountant=None, sampling_rate=1.0):
-    """Return an ``epsilon`` estimate for the Gaussian mechanism.
+def _log_a_fractional(sample_rate, noise_mult, alpha):
+    # Mironov et al. (2019), section 3.3: two series in erfc that converge
+    # quickly; summed until their terms drop below exp(-30)
+    log_a0, log_a1 = -np.inf, -np.inf
+    z0 = noise_mult ** 2 * math.log(1 / sample_rate - 1) + 0.5
+    i = 0
+    while True:
+        coef = binom(alpha, i)
+        log_coef = math.log(abs(coef))
+        j = alpha - i
+        log_t0 = log_coef + i * math.log(sample_rate) + j * math.log1p(-sample_rate)
+        log_t1 = log_coef + j * math.log(sample_rate) + i * math.log1p(-sample_rate)
+        # log(erfc(x) / 2) = log_ndtr(-sqrt(2) x)
+        log_e0 = log_ndtr(-(i - z0) / noise_mult)
+        log_e1 = log_ndtr(-(z0 - j) / noise_mult)
+        log_s0 = log_t0 + (i * i - i) / (2 * noise_mult ** 2) + log_e0
+        log_s1 = log_t1 + (j * j - j) / (2 * noise_mult ** 2) + log_e1
+        if coef > 0:
+            log_a0, log_a1 = np.logaddexp(log_a0, log_s0), np.logaddexp(log_a1, log_s1)
+        else:
+            log_a0, log_a1 = _log_sub(log_a0, log_s0), _log_sub(log_a1, log_s1)
+        i += 1
+        if max(log_s0, log_s1) < -30:
+            return np.logaddexp(log_a0, log_a1)
+
+
+def subsampled_gaussian_rdp(sample_rate, noise_mult, orders=DEFAULT_RDP_ORDERS):
+    """RDP of one step of the Poisson-subsampled Gaussian mechanism.
+
+    Uses the exact binomial expansion for integer orders (Mironov et al.,
+    "R\u00E9nyi Differential Privacy of the Sampled Gaussian Mechanism", 2019),
+    evaluated for all orders at once in log space, and the erfc series of the
+    same paper for fractional orders.
 
     Parameters
     ----------
-    num_steps : int
-        Total number of noisy updates that have been applied.
+    sample_rate : float
+        Probability that a given record (or client) takes part in the step.
     noise_mult : float
-        Noise multiplier used when generating the updates.
-    delta : float
-        Target ``delta`` parameter of differential privacy.
-    accountant : str, optional
-        If set to ``"rdp"`` an approximate R\u00E9nyi DP accountant is used for
-        composition. Otherwise a basic strong composition bound is used.
-    sampling_rate : float, optional
-        Probability that a given client participates in a round. This is only
-        used when ``accountant='rdp'``.
+        Ratio of the noise standard deviation to the sensitivity.
+    orders : array_like of float, optional
+        R\u00E9nyi orders, all larger than 1.
+
+    Returns
+    -------
+    numpy.ndarray
+        RDP value for every order.
     """
+    orders = np.asarray(orders, dtype=float)
     if noise_mult == 0:
-        return float('inf')
+        return np.full(len(orders), np.inf)
+    if sample_rate == 0:
+        return np.zeros(len(orders))
+    if sample_rate == 1:
+        return orders / (2 * noise_mult ** 2)
+
+    rdp = np.empty(len(orders))
+    integer = orders == np.round(orders)
+    if integer.any():
+        alpha = orders[integer][:, None]
+        k = np.arange(alpha.max() + 1, dtype=float)[None, :]
+        log_terms = (gammaln(alpha + 1) - gammaln(k + 1) - gammaln(np.maximum(alpha - k, 0) + 1)
+                     + (alpha - k) * np.log1p(-sample_rate) + k * np.log(sample_rate)
+                     + (k * k - k) / (2 * noise_mult ** 2))
+        log_terms = np.where(k <= alpha, log_terms, -np.inf)
+        rdp[integer] = logsumexp(log_terms, axis=1)
+    for i in np.flatnonzero(~integer):
+        rdp[i] = _log_a_fractional(sample_rate, noise_mult, orders[i])
+    return rdp / (orders - 1)
+
+
+def rdp_to_epsilon(rdp, orders, delta):
+    """Convert an RDP curve to ``(epsilon, best_order)`` for a given ``delta``.
+
+    Uses the conversion of Balle et al. (2020), which is tighter than the
+    classic ``rdp + log(1/delta) / (order - 1)``.
+    """
+    rdp = np.asarray(rdp, dtype=float)
+    if not np.isfinite(rdp).any():
+        return float('inf'), None
+    eps = epsilon_per_order(rdp, orders, delta)
+    idx = int(np.nanargmin(eps))
+    return max(float(eps[idx]), 0.0), float(orders[idx])
+
+
+def epsilon_per_order(rdp, orders, delta):
+    """``epsilon`` implied by every order of ``rdp``; broadcasts over leading axes."""
+    orders = np.asarray(orders, dtype=float)
+    return np.asarray(rdp, dtype=float) - (np.log(delta) + np.log(orders)) / (orders - 1) + np.log((orders - 1) / orders)
+
+
+class RDPAccountant(object):
+    """Stateful R\u00E9nyi DP accountant composing named mechanisms incrementally.
+
+    Every mechanism (e.g. ``'client_delta'`` for the noised client updates or
+    ``'dp_sgd/<client>'`` for the local DP-SGD steps of one client) keeps its
+    own running RDP curve. A step adds the cached per-step curve of its
+    ``(sample_rate, noise_mult)`` pair, so recording a step and querying
+    ``epsilon`` both cost O(len(orders)).
+
+    Parameters
+    ----------
+    orders : array_like of float, optional
+        R\u00E9nyi orders to track, all larger than 1.
+    """
+
+    def __init__(self, orders=None):
+        self.orders = np.asarray(DEFAULT_RDP_ORDERS if orders is None else orders, dtype=float)
+        self._rdp = {}
+        self._steps = {}
+        self._step_cache = {}
+
+    def _step_rdp(self, noise_mult, sample_rate):
+        key = (float(noise_mult), float(sample_rate))
+        if key not in self._step_cache:
+            self._step_cache[key] = subsampled_gaussian_rdp(sample_rate, noise_mult, self.orders)
+        return self._step_cache[key]
+
+    def step(self, mechanism, noise_mult, sample_rate, num_steps=1):
+        """Record ``num_steps`` invocations of ``mechanism``."""
+        rdp = num_steps * self._step_rdp(noise_mult, sample_rate)
+        if mechanism in self._rdp:
+            self._rdp[mechanism] = self._rdp[mechanism] + rdp
+        else:
+            self._rdp[mechanism] = rdp
+        self._steps[mechanism] = self._steps.get(mechanism, 0) + num_steps
+
+    def mechanisms(self, prefix=''):
+        return [m for m in self._rdp if m.startswith(prefix)]
+
+    def steps(self, mechanism):
+        return self._steps.get(mechanism, 0)
+
+    def get_epsilon(self, delta, mechanism):
+        """``epsilon`` spent so far by ``mechanism`` (0 if it never ran)."""
+        if mechanism not in self._rdp:
+            return 0.0
+        return rdp_to_epsilon(self._rdp[mechanism], self.orders, delta)[0]
+
+    def get_max_epsilon(self, delta, prefix):
+        """Largest ``epsilon`` over the mechanisms whose name starts with ``prefix``."""
+        return max([self.get_epsilon(delta, m) for m in self.mechanisms(prefix)], default=0.0)
 
-    if accountant == 'rdp':
-        orders = [1 + x / 10.0 for x in range(1, 100)] + list(range(12, 64))
-        rdp = []
-        for order in orders:
-            rdp.append(num_steps * (sampling_rate ** 2) * order / (2 * noise_mult ** 2))
-        eps = min(r - math.log(delta) / (o - 1) for r, o in zip(rdp, orders))
-        return eps
+    def state_dict(self):
+        # plain Python types so that ``torch.load(weights_only=True)`` accepts it
+        return {
+            'orders': self.orders.tolist(),
+            'rdp': {m: np.asarray(r, dtype=float).tolist() for m, r in self._rdp.items()},
+            'steps': dict(self._steps),
+        }
 
-    return math.sqrt(2 * num_steps * math.log(1 / delta)) / noise_mult
+    def load_state_dict(self, state_dict):
+        self.orders = np.asarray(state_dict['orders'], dtype=float)
+        self._rdp = {m: np.asarray(r, dtype=float) for m, r in state_dict['rdp'].items()}
+        self._steps = dict(state_dict['steps'])
+        self._step_cache = {}
@@ -1,5 +1,8 @@
+import os
 import datetime
+import hashlib
 
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import BertModel
@@ -11,12 +14,14 @@ class CXTEBD(nn.Module):
         embeddings.
     '''
     def __init__(self, pretrained_model_name_or_path=None, cache_dir=None,
-                 finetune_ebd=False, return_seq=False):
+                 finetune_ebd=False, return_seq=False, feature_store=None):
         '''
             pretrained_model_name_or_path, cache_dir: check huggingface's codebase for details
             finetune_ebd: finetuning bert representation or not during
             meta-training
             return_seq: return a sequence of bert representations, or [cls]
+            feature_store: directory of the precomputed representations, see
+            build_store
         '''
         super(CXTEBD, self).__init__()
 
@@ -24,6 +29,10 @@ class CXTEBD(nn.Module):
 
         self.return_seq = return_seq
 
+        self.model_name = str(pretrained_model_name_or_path)
+        self.feature_store = feature_store
+        self.store = None
+
         print("{}, Loading pretrained bert".format(
             datetime.datetime.now().strftime('%02y/%02m/%02d %H:%M:%S')), flush=True)
 
@@ -62,13 +71,128 @@ class CXTEBD(nn.Module):
             # return [cls], dim: batch, ebd_dim
             return last_layer[:,0,:]
 
+    def build_store(self, *datasets, batch_size=64):
+        '''
+            Encode the documents once with the frozen bert and serve them
+            from a memory-mapped file in self.feature_store afterwards, so
+            that episodes no longer run bert. The file is keyed by the model
+            name and a hash of the documents, ids and bert ids, and reused by
+            later runs that encode the same corpus.
+
+            @param datasets: dicts of np arrays with keys 'doc_id', 'text'
+            (bert ids) and 'text_len', e.g. train, val and test data
+            @param batch_size: documents per bert forward
+        '''
+        if self.finetune_ebd:
+            raise ValueError('the bert representations change when finetune_ebd is set')
+
+        doc_id = np.concatenate([d['doc_id'] for d in datasets])
+        order = np.argsort(doc_id, kind='stable')
+        doc_id = doc_id[order]
+        if np.any(doc_id[1:] == doc_id[:-1]):
+            raise ValueError('document ids are not unique')
+        width = max(d['text'].shape[1] for d in datasets)
+        text = np.concatenate([np.pad(d['text'], ((0, 0), (0, width - d['text'].shape[1])))
+                               for d in datasets])[order]
+        text_len = np.concatenate([d['text_len'] for d in datasets])[order]
+
+        # the same ids in another corpus, or another tokenization, must not
+        # hit the features of this one
+        digest = hashlib.sha1()
+        for array in (doc_id, text, text_len):
+            digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        name = '{}-{}-{}-{}'.format(os.path.basename(os.path.normpath(self.model_name)),
+                                    'seq' if self.return_seq else 'cls', width, digest.hexdigest()[:16])
+        path = os.path.join(self.feature_store, name)
+        if os.path.exists(path + '.npy'):
+            store = BertFeatureStore(path)
+            if np.array_equal(store.ids, doc_id) and store.features.shape[-1] == self.ebd_dim:
+                self.store = store
+                return path
+
+        print("{}, Encoding {} documents into {}".format(
+            datetime.datetime.now().strftime('%02y/%02m/%02d %H:%M:%S'),
+            len(doc_id), path + '.npy'), flush=True)
+
+        os.makedirs(self.feature_store, exist_ok=True)
+        shape = (len(doc_id), width, self.ebd_dim) if self.return_seq else (len(doc_id), self.ebd_dim)
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+
+        device = next(self.model.parameters()).device
+        training = self.model.training
+        # no dropout, the stored representation is the one of the frozen model
+        self.model.eval()
+        # documents of similar length share a batch, which is cut to its longest one
+        by_len = np.argsort(text_len, kind='stable')
+        with torch.no_grad():
+            for start in range(0, len(by_len), batch_size):
+                rows = by_len[start:start + batch_size]
+                max_len = int(text_len[rows].max())
+                out = self.get_bert(torch.from_numpy(text[rows, :max_len]).to(device),
+                                    torch.from_numpy(text_len[rows]).to(device))
+                if self.return_seq:
+                    features[rows, :max_len] = out.cpu().numpy()
+                else:
+                    features[rows] = out.cpu().numpy()
+        self.model.train(training)
+
+        features.flush()
+        del features
+        np.save(path + '.ids.npy', doc_id)
+        # the features are renamed last, an interrupted run is not reused
+        os.replace(tmp_path, path + '.npy')
+
+        self.store = BertFeatureStore(path)
+        return path
+
     def forward(self, data, weights=None):
         '''
             @param data: key 'ebd' = batch_size * max_text_len * embedding_dim
             @return output: batch_size * max_text_len * embedding_dim
         '''
-        if self.finetune_ebd:
+        if self.store is not None:
+            # precomputed by build_store
+            return self.store.lookup(data['doc_id'], data['text'].size(-1)).to(data['text'].device)
+        elif self.finetune_ebd:
             return self.get_bert(data['text'], data['text_len'])
         else:
             with torch.no_grad():
                 return self.get_bert(data['text'], data['text_len'])
+
+
+class BertFeatureStore():
+    '''
+        Bert representations of a corpus in a memory-mapped file, looked up
+        by document id. Written by CXTEBD.build_store.
+    '''
+    def __init__(self, path):
+        '''
+            @param path: file name without the '.npy' suffix
+        '''
+        # sorted document ids, the i-th one is stored in row i
+        self.ids = np.load(path + '.ids.npy')
+        self.features = np.load(path + '.npy', mmap_mode='r')
+
+    def __deepcopy__(self, memo):
+        # read-only, copies of the model (e.g. for the inner loop) share the mapping
+        return self
+
+    def lookup(self, doc_id, max_len=None):
+        '''
+            @param doc_id: batch_size, np array or tensor on the cpu
+            @param max_len: cut a sequence of representations to max_len
+
+            @return: batch_size * ebd_dim, or batch_size * max_len * ebd_dim
+        '''
+        doc_id = np.asarray(doc_id)
+        rows = np.minimum(np.searchsorted(self.ids, doc_id), len(self.ids) - 1)
+        if np.any(self.ids[rows] != doc_id):
+            raise KeyError('documents {} are not in the feature store'.format(
+                doc_id[self.ids[rows] != doc_id].tolist()))
+
+        features = self.features[rows]
+        if max_len is not None and features.ndim == 3:
+            features = features[:, :max_len]
+
+        return torch.from_numpy(np.ascontiguousarray(features))
@@ -11,7 +11,12 @@ from embedding.meta import META
 from embedding.lstmatt import LSTMAtt
 
 
-def get_embedding(vocab, args):
+def get_embedding(vocab, args, datasets=()):
+    '''
+        @param datasets: with args.bert_feature_store, the data dicts (e.g.
+        train, val and test) whose bert representations are precomputed
+        into the feature store, see CXTEBD.build_store
+    '''
     print("{}, Building embedding".format(
         datetime.datetime.now().strftime('%02y/%02m/%02d %H:%M:%S')), flush=True)
 
@@ -20,7 +25,10 @@ def get_embedding(vocab, args):
         ebd = CXTEBD(args.pretrained_bert,
                      cache_dir=args.bert_cache_dir,
                      finetune_ebd=args.finetune_ebd,
-                     return_seq=(args.embedding!='ebd'))
+                     return_seq=(args.embedding!='ebd'),
+                     feature_store=args.bert_feature_store)
+        if args.bert_feature_store is not None and datasets:
+            ebd.build_store(*datasets, batch_size=args.bert_feature_batch_size)
     else:
         ebd = WORDEBD(vocab, args.finetune_ebd)
 
@@ -36,6 +44,8 @@ def get_embedding(vocab, args):
         model = LSTMAtt(ebd, args)
     elif args.embedding == 'ebd' and args.bert:
         model = ebd  # using bert representation directly
+    elif args.embedding == 'seq' and args.bert:
+        model = ebd  # the sequence of bert representations, e.g. for model.LSTMAtt
 
     print("{}, Building embedding".format(
         datetime.datetime.now().strftime('%02y/%02m/%02d %H:%M:%S')), flush=True)
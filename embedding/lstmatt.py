@@ -42,8 +42,7 @@ class LSTMAtt(nn.Module):
         att = att.view(batch_size, max_text_len, 1)  # unnormalized
 
         # create mask
-        idxes = torch.arange(max_text_len, out=torch.cuda.LongTensor(max_text_len,
-                                 device=text_len.device)).unsqueeze(0)
+        idxes = torch.arange(max_text_len, device=text_len.device).unsqueeze(0)
         mask = (idxes < text_len.unsqueeze(1)).bool()
         att[~mask] = float('-inf')
 
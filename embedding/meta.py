@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -16,80 +17,38 @@ class RNN(nn.Module):
                 bidirectional=bidirectional, dropout=dropout)
         self.rnn.flatten_parameters()
 
-    def _sort_tensor(self, input, lengths):
-        '''
-        pack_padded_sequence  requires the length of seq be in descending order
-        to work.
-        Returns the sorted tensor, the sorted seq length, and the
-        indices for inverting the order.
-
-        Input:
-                input: batch_size, seq_len, *
-                lengths: batch_size
-        Output:
-                sorted_tensor: batch_size-num_zero, seq_len, *
-                sorted_len:    batch_size-num_zero
-                sorted_order:  batch_size
-                num_zero
-        '''
-        sorted_lengths, sorted_order = lengths.sort(0, descending=True)
-        sorted_input = input[sorted_order]
-        _, invert_order  = sorted_order.sort(0, descending=False)
-
-        # Calculate the num. of sequences that have len 0
-        nonzero_idx = sorted_lengths.nonzero()
-        num_nonzero = nonzero_idx.size()[0]
-        num_zero = sorted_lengths.size()[0] - num_nonzero
-
-        # temporarily remove seq with len zero
-        sorted_input = sorted_input[:num_nonzero]
-        sorted_lengths = sorted_lengths[:num_nonzero]
-
-        return sorted_input, sorted_lengths, invert_order, num_zero
-
-    def _unsort_tensor(self, input, invert_order, num_zero):
-        '''
-        Recover the origin order
-
-        Input:
-                input:        batch_size-num_zero, seq_len, hidden_dim
-                invert_order: batch_size
-                num_zero
-        Output:
-                out:   batch_size, seq_len, *
-        '''
-        if num_zero == 0:
-            input = input[invert_order]
-
-        else:
-            dim0, dim1, dim2 = input.size()
-            zero = torch.zeros((num_zero, dim1, dim2), device=input.device,
-                    dtype=input.dtype)
-            input = torch.cat((input, zero), dim=0)
-            input = input[invert_order]
-
-        return input
-
     def forward(self, text, text_len):
         '''
         Input: text, text_len
             text       Variable  batch_size * max_text_len * input_dim
-            text_len   Tensor    batch_size
+            text_len   Tensor    batch_size, preferably on the host: lengths
+                                 on the device cost a sync to read
 
         Output: text
-            text       Variable  batch_size * max_text_len * output_dim
+            text       Variable  batch_size * longest text * output_dim,
+                                 zero for texts of length 0
         '''
-        # Go through the rnn
-        # Sort the word tensor according to the sentence length, and pack them together
-        sort_text, sort_len, invert_order, num_zero = self._sort_tensor(input=text, lengths=text_len)
-        text = pack_padded_sequence(sort_text, lengths=sort_len.cpu().numpy(), batch_first=True)
-
-        # Run through the word level RNN
-        text, _ = self.rnn(text)         # batch_size, max_doc_len, args.word_hidden_size
-
-        # Unpack the output, and invert the sorting
-        text = pad_packed_sequence(text, batch_first=True)[0] # batch_size, max_doc_len, rnn_size
-        text = self._unsort_tensor(text, invert_order, num_zero) # batch_size, max_doc_len, rnn_size
+        if text_len.device.type != 'cpu':
+            text_len = text_len.cpu()
+        lengths = text_len.numpy()
+        # packing rejects empty sequences, run them as one token and zero them below
+        empty = lengths == 0
+        if empty.any():
+            lengths = np.maximum(lengths, 1)
+
+        # sort on the host: with enforce_sorted=False, pad_packed_sequence
+        # would read the device-side sort order back
+        order = np.argsort(-lengths, kind='stable')
+        sorted_order = torch.from_numpy(order).to(text.device, non_blocking=True)
+        invert_order = torch.from_numpy(np.argsort(order)).to(text.device, non_blocking=True)
+        text = pack_padded_sequence(text.index_select(0, sorted_order), lengths=torch.from_numpy(lengths[order]),
+                                    batch_first=True)
+        text, _ = self.rnn(text)
+        text = pad_packed_sequence(text, batch_first=True)[0]  # batch_size, max_doc_len, rnn_size
+        text = text.index_select(0, invert_order)
+
+        if empty.any():
+            text = text.masked_fill(torch.from_numpy(empty).to(text.device).view(-1, 1, 1), 0)
 
         return text
 
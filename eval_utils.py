@@ -0,0 +1,284 @@
+import copy
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from dp_utils import strip_grad_sample_prefix
+from lora import is_lora_key, strip_lora_prefix
+
+
+def is_private_key(key):
+    """Return ``True`` for state-dict entries that stay on the client.
+
+    The few-shot classifier, the transformer and the per-client transform
+    layer are never overwritten by the global model.
+    """
+    return key.startswith('few_classify.') or 'transformer' in key or 'transform_layer' in key
+
+
+def load_global_weights(net, global_w):
+    """Overwrite the shared entries of ``net`` with the global weights, keeping the private ones."""
+    net_para = net.state_dict()
+    for key, global_key in zip(list(net_para), strip_lora_prefix(strip_grad_sample_prefix(net_para))):
+        if not is_private_key(key) and not is_lora_key(key):
+            net_para[key] = global_w[global_key]
+    net.load_state_dict(net_para)
+
+
+def build_test_episode_bank(y_test, N, Q, ks=(1, 5), num_episodes=100, seed=1, classes=None):
+    """Pre-sample a fixed bank of meta-test episodes.
+
+    The bank is drawn once with a private ``RandomState`` so that building or
+    replaying it never touches the global NumPy RNG used during training, and
+    every round and every client is evaluated on exactly the same episodes.
+
+    Parameters
+    ----------
+    y_test : array_like
+        Labels of the meta-test pool; episodes index rows of this array.
+    N, Q : int
+        Number of ways and number of queries per class.
+    ks : iterable of int, optional
+        Shot counts to build episodes for.
+    num_episodes : int, optional
+        Number of episodes stored for every ``k``.
+    seed : int, optional
+        Seed of the private generator.
+    classes : iterable, optional
+        Candidate classes. Defaults to the classes present in ``y_test``.
+
+    Returns
+    -------
+    dict
+        Maps every ``k`` to a dict of integer arrays: ``classes`` with shape
+        ``(num_episodes, N)``, ``support`` with shape ``(num_episodes, N * k)``
+        and ``query`` with shape ``(num_episodes, N * Q)``. Support and query
+        rows are laid out class-major so that they line up with the
+        ``support_labels`` and ``query_labels`` used by the test path.
+    """
+    rng = np.random.RandomState(seed)
+    y_test = np.asarray(y_test)
+    if classes is None:
+        classes = np.unique(y_test)
+    rows_per_class = {c: np.flatnonzero(y_test == c) for c in classes}
+    index_dtype = np.int32 if len(y_test) <= np.iinfo(np.int32).max else np.int64
+
+    bank = {}
+    for k in ks:
+        eligible = np.array([c for c in classes if len(rows_per_class[c]) >= k + Q])
+        if len(eligible) < N:
+            raise ValueError("Only {} test classes have at least {} samples, cannot build {}-way episodes."
+                             .format(len(eligible), k + Q, N))
+
+        episode_classes = np.empty((num_episodes, N), dtype=np.int32)
+        support = np.empty((num_episodes, N, k), dtype=index_dtype)
+        query = np.empty((num_episodes, N, Q), dtype=index_dtype)
+        for e in range(num_episodes):
+            chosen = rng.choice(len(eligible), N, replace=False)
+            episode_classes[e] = eligible[chosen]
+            for i, c in enumerate(eligible[chosen]):
+                rows = rows_per_class[c]
+                picked = rows[rng.choice(len(rows), k + Q, replace=False)]
+                support[e, i] = picked[:k]
+                query[e, i] = picked[k:]
+
+        bank[k] = {
+            'classes': episode_classes,
+            'support': support.reshape(num_episodes, N * k),
+            'query': query.reshape(num_episodes, N * Q),
+        }
+    return bank
+
+
+class RunningAccuracy(object):
+    """Streaming mean and 95% confidence interval of episode accuracies.
+
+    Uses Welford's update so the estimate can be queried after every episode
+    without keeping the individual accuracies around.
+    """
+
+    def __init__(self, z=1.96):
+        self.z = z
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, acc):
+        self.count += 1
+        diff = acc - self.mean
+        self.mean += diff / self.count
+        self._m2 += diff * (acc - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return float('inf')
+        return self._m2 / (self.count - 1)
+
+    def half_width(self):
+        """Half-width of the normal-approximation confidence interval."""
+        if self.count < 2:
+            return float('inf')
+        return self.z * np.sqrt(self.variance() / self.count)
+
+    def converged(self, tol, min_count=2):
+        """Return ``True`` once the interval half-width has dropped below ``tol``."""
+        return tol > 0 and self.count >= max(min_count, 2) and self.half_width() < tol
+
+
+def meta_test_features(features, rows, episodes, N, Q, ci_tol=0.0, min_tasks=10):
+    """Logistic-regression meta-test on precomputed features.
+
+    Parameters
+    ----------
+    features : numpy.ndarray
+        l2-normalised embeddings of the pool rows listed in ``rows``.
+    rows : numpy.ndarray
+        Sorted pool row ids, ``features[i]`` belongs to row ``rows[i]``.
+    episodes : dict
+        One entry of the bank returned by :func:`build_test_episode_bank`.
+    N, Q : int
+        Number of ways and number of queries per class.
+    ci_tol, min_tasks : float, int, optional
+        Early-stopping rule, see :meth:`RunningAccuracy.converged`.
+
+    Returns
+    -------
+    accs, max_values, indices, running_acc
+        Per-episode accuracies, predicted-class probabilities and predictions
+        of every query, and the running accuracy statistics.
+    """
+    return meta_test_groups([features], rows, episodes, N, Q, ci_tol, min_tasks)[0]
+
+
+def meta_test_groups(features, rows, episodes, N, Q, ci_tol=0.0, min_tasks=10):
+    """:func:`meta_test_features` of several feature sets on the same episodes.
+
+    All sets stop at the same episode: once every one of them has converged,
+    or at the end of the bank. Their results therefore cover the same
+    episodes and line up.
+
+    Parameters
+    ----------
+    features : list of numpy.ndarray
+        One feature array per set, see :func:`meta_test_features`.
+    rows, episodes, N, Q, ci_tol, min_tasks
+        See :func:`meta_test_features`.
+
+    Returns
+    -------
+    list of tuple
+        ``(accs, max_values, indices, running_acc)`` of every set.
+    """
+    num_episodes, num_support = episodes['support'].shape
+    support_labels = np.repeat(np.arange(N), num_support // N)
+    query_labels = np.repeat(np.arange(N), Q)
+
+    results = [([], [], [], RunningAccuracy()) for _ in features]
+    for e in range(num_episodes):
+        support_rows = np.searchsorted(rows, episodes['support'][e])
+        query_rows = np.searchsorted(rows, episodes['query'][e])
+        for group_features, (accs, max_values, indices, running_acc) in zip(features, results):
+            clf = LogisticRegression(penalty='l2', random_state=0, C=1.0, solver='lbfgs', max_iter=1000)
+            clf.fit(group_features[support_rows], support_labels)
+            prob = clf.predict_proba(group_features[query_rows])
+
+            acc = float(np.mean(np.argmax(prob, -1) == query_labels))
+            accs.append(acc)
+            max_values.append(prob.max(-1))
+            indices.append(prob.argmax(-1))
+            running_acc.update(acc)
+        if all(result[3].converged(ci_tol, min_tasks) for result in results):
+            break
+
+    return [(accs, np.concatenate(max_values), np.concatenate(indices), running_acc)
+            for accs, max_values, indices, running_acc in results]
+
+
+class NetSnapshot(object):
+    """Frozen copy of the global model and every client's private head.
+
+    A single template network is copied and only the private entries (see
+    :func:`is_private_key`) are stored per client. Indexing the snapshot loads
+    the requested client's head into the template, which makes it usable as the
+    ``nets`` mapping of the evaluation code while training moves on.
+
+    The shared weights are those of the first client unless ``global_w`` is
+    given. A lossy broadcast leaves every client with its own approximation
+    of the global model, so pass the exact global weights in that case. A
+    copy of them is kept as ``global_w``, the weights the evaluation measured.
+    """
+
+    def __init__(self, nets, global_w=None):
+        self._template = copy.deepcopy(next(iter(nets.values())))
+        self.global_w = None
+        if global_w is not None:
+            load_global_weights(self._template, global_w)
+            self.global_w = OrderedDict((k, v.detach().clone()) for k, v in global_w.items())
+        self._private = {
+            net_id: {k: v.detach().clone() for k, v in net.state_dict().items() if is_private_key(k)}
+            for net_id, net in nets.items()
+        }
+
+    def __getitem__(self, net_id):
+        self._template.load_state_dict(self._private[net_id], strict=False)
+        return self._template
+
+    def __iter__(self):
+        return iter(self._private)
+
+    def __len__(self):
+        return len(self._private)
+
+    def keys(self):
+        return self._private.keys()
+
+    def items(self):
+        for net_id in self._private:
+            yield net_id, self[net_id]
+
+
+class EvalScheduler(object):
+    """Decide which rounds are evaluated and optionally run them in the background.
+
+    Parameters
+    ----------
+    every : int, optional
+        Evaluate every ``every`` rounds (round 0 included). ``0`` disables the
+        periodic evaluation.
+    asynchronous : bool, optional
+        Run submitted evaluations on a single background worker instead of
+        blocking the round loop. Callers should then pass a snapshot of the
+        models (see :class:`NetSnapshot`) since training keeps mutating them.
+    """
+
+    def __init__(self, every=1, asynchronous=False):
+        self.every = every
+        self.asynchronous = asynchronous
+        self._executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self._pending = []
+
+    def due(self, round):
+        return self.every > 0 and round % self.every == 0
+
+    def submit(self, round, fn, *args, **kwargs):
+        """Evaluate ``fn(*args, **kwargs)`` on behalf of ``round``."""
+        if self._executor is not None:
+            future = self._executor.submit(fn, *args, **kwargs)
+        else:
+            future = Future()
+            future.set_result(fn(*args, **kwargs))
+        self._pending.append((round, future))
+
+    def collect(self, wait=False):
+        """Return ``(round, result)`` for finished evaluations, in round order."""
+        finished = []
+        while self._pending and (wait or self._pending[0][1].done()):
+            round, future = self._pending.pop(0)
+            finished.append((round, future.result()))
+        return finished
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,192 @@
+import math
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from opacus.layers import DPLSTM
+
+
+class LoRAConv2d(nn.Module):
+    """Frozen ``nn.Conv2d`` plus a trainable low-rank update.
+
+    The update is a ``rank``-channel convolution with the geometry of ``base``
+    (``down``) followed by a 1x1 convolution back to the output channels
+    (``up``), so ``up(down(x))`` equals a convolution with the weight returned
+    by :meth:`merged_delta`. Both are plain layers and get their per-sample
+    gradients from Opacus' own samplers. ``down`` stays frozen at its seeded
+    initialisation and only ``up`` is trained.
+    """
+
+    def __init__(self, base, rank=4, alpha=None):
+        super(LoRAConv2d, self).__init__()
+        self.base = base
+        rank = min(rank, base.out_channels, base.in_channels * math.prod(base.kernel_size))
+        self.down = nn.Conv2d(base.in_channels, rank, base.kernel_size, stride=base.stride, padding=base.padding,
+                              dilation=base.dilation, bias=False).to(base.weight.device)
+        self.up = nn.Conv2d(rank, base.out_channels, 1, bias=False).to(base.weight.device)
+        self.down.weight.requires_grad_(False)
+        self.scaling = (rank if alpha is None else alpha) / rank
+        self.reset_adapter()
+
+    def forward(self, x):
+        return self.base(x) + self.up(self.down(x)) * self.scaling
+
+    def reset_adapter(self, generator=None):
+        _reset_factors(self.down.weight, self.up.weight, generator)
+
+    def merged_delta(self):
+        """Weight update of ``base`` equivalent to the adapter."""
+        delta = self.up.weight.flatten(1) @ self.down.weight.flatten(1)
+        return delta.view_as(self.base.weight) * self.scaling
+
+
+class LoRALinear(nn.Module):
+    """Frozen ``nn.Linear`` plus a low-rank update ``up(down(x))`` of which only ``up`` is trained."""
+
+    def __init__(self, base, rank=4, alpha=None):
+        super(LoRALinear, self).__init__()
+        self.base = base
+        rank = min(rank, base.in_features, base.out_features)
+        self.down = nn.Linear(base.in_features, rank, bias=False).to(base.weight.device)
+        self.up = nn.Linear(rank, base.out_features, bias=False).to(base.weight.device)
+        self.down.weight.requires_grad_(False)
+        self.scaling = (rank if alpha is None else alpha) / rank
+        self.reset_adapter()
+
+    def forward(self, x):
+        return self.base(x) + self.up(self.down(x)) * self.scaling
+
+    def reset_adapter(self, generator=None):
+        _reset_factors(self.down.weight, self.up.weight, generator)
+
+    def merged_delta(self):
+        return (self.up.weight @ self.down.weight) * self.scaling
+
+
+def _reset_factors(down, up, generator=None):
+    # same bound as the default nn.Linear/nn.Conv2d init, ``up`` starts at
+    # zero so a fresh adapter leaves the base layer unchanged
+    bound = 1.0 / math.sqrt(down[0].numel())
+    with torch.no_grad():
+        down.copy_(torch.rand(down.shape, generator=generator) * (2 * bound) - bound)
+        up.zero_()
+
+
+def add_lora_adapters(container, indices, rank=4, alpha=None):
+    """Freeze selected children and attach adapters to their conv and linear layers.
+
+    Each ``container[i]`` for ``i`` in ``indices`` is frozen and every
+    ``nn.Conv2d``/``nn.Linear`` in it (or the child itself) is replaced in
+    place by its adapter. Grouped convolutions and the projections inside
+    ``nn.MultiheadAttention``, which reads their weights directly, and in
+    Opacus' ``DPLSTM``, which runs them once per time step, stay frozen
+    without an adapter, and so do the affine parameters of normalisation
+    layers.
+
+    Only the ``up`` factors are trained. With ``down`` fixed by the seed of
+    :func:`reset_lora_adapters`, a weighted average of the clients' ``up``
+    factors merges into exactly the weighted average of their updates
+    ``up @ down``.
+
+    Parameters
+    ----------
+    container : torch.nn.Sequential
+        Module whose children are adapted in place.
+    indices : iterable of int
+        Children to freeze and adapt.
+    rank : int, optional
+        Rank of the updates, capped by the layer sizes.
+    alpha : float, optional
+        The update is scaled by ``alpha / rank``; defaults to ``rank``.
+    """
+    for i in indices:
+        for p in container[i].parameters():
+            p.requires_grad_(False)
+        container[i] = _with_adapters(container[i], rank, alpha)
+    return container
+
+
+def _with_adapters(module, rank, alpha):
+    if isinstance(module, nn.Conv2d) and module.groups == 1 and module.padding_mode == 'zeros':
+        return LoRAConv2d(module, rank, alpha)
+    if isinstance(module, nn.Linear):
+        return LoRALinear(module, rank, alpha)
+    if not isinstance(module, (nn.MultiheadAttention, DPLSTM, LoRAConv2d, LoRALinear)):
+        for name, child in module.named_children():
+            setattr(module, name, _with_adapters(child, rank, alpha))
+    return module
+
+
+def lora_modules(module):
+    """``(name, adapter)`` pairs below ``module``, named like the plain model.
+
+    The ``_module.`` level of Opacus wrappers is dropped, so the names of a
+    client model and of an unwrapped copy agree.
+    """
+    for name, m in module.named_modules():
+        if isinstance(m, (LoRAConv2d, LoRALinear)):
+            yield '.'.join(part for part in name.split('.') if part != '_module'), m
+
+
+def is_lora_key(key):
+    """Return ``True`` for state-dict entries of adapter factors."""
+    return '.down.' in key or '.up.' in key
+
+
+def strip_lora_prefix(state_dict):
+    """Map the keys of a model with adapters onto the keys of the plain model.
+
+    Base weights lose their ``base.`` level; adapter factors keep their keys,
+    which do not exist in the plain model (see :func:`is_lora_key`).
+    """
+    return OrderedDict((k.replace('.base.', '.'), v) for k, v in state_dict.items())
+
+
+def reset_lora_adapters(module, seed):
+    """Re-initialise every adapter from ``seed``.
+
+    Models that are reset with the same seed start from identical factors, so
+    the server can rebuild a client's factors from the uploaded difference.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    for _, m in lora_modules(module):
+        m.reset_adapter(generator)
+    return module
+
+
+def lora_factors(module):
+    """Trained adapter factors (``up``) of ``module`` as a dict of detached tensors.
+
+    The frozen ``down`` factors are left out, they follow from the seed. The
+    tensors share storage with the parameters, so changing them in place
+    changes the adapters.
+    """
+    factors = OrderedDict()
+    for name, m in lora_modules(module):
+        factors[name + '.up.weight'] = m.up.weight.detach()
+    return factors
+
+
+def merge_lora_adapters(module, state_dict):
+    """Add every adapter's :meth:`merged_delta` to its base weight in ``state_dict``.
+
+    ``state_dict`` is keyed like the plain model, e.g. the global model.
+    """
+    with torch.no_grad():
+        for name, m in lora_modules(module):
+            state_dict[name + '.weight'] += m.merged_delta()
+    return state_dict
+
+
+def lora_buffers(module):
+    """Floating-point buffers of ``module``, e.g. BatchNorm running statistics, keyed like the plain model.
+
+    Training moves them although the base weights are frozen, so they are
+    uploaded and averaged along with the factors. Integer buffers such as
+    ``num_batches_tracked`` are left out.
+    """
+    buffers = OrderedDict()
+    for name, buf in module.named_buffers():
+        if torch.is_floating_point(buf):
+            buffers['.'.join(part for part in name.split('.') if part != '_module')] = buf.detach()
+    return buffers
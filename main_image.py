@@ -17,14 +17,24 @@ from PIL import Image
 
 from model import *
 from utils import *
-from dp_utils import compute_noisy_delta, compute_epsilon
+from dp_utils import compute_noisy_delta, inner_loop_copy, strip_grad_sample_prefix, wrap_dp_submodules, RDPAccountant
+from compression import BroadcastEncoder, UpdateCompressor, aggregate_updates
+from cost_utils import CostTracker
+from lora import add_lora_adapters, lora_buffers, lora_factors, merge_lora_adapters, reset_lora_adapters
+from profiling import PhaseProfiler, SyncCounter, host_side_step
+from synthetic import SYNTHETIC_DATASETS, synthetic_classes, synthetic_config
+from eval_utils import build_test_episode_bank, is_private_key, load_global_weights, meta_test_groups, EvalScheduler, NetSnapshot, RunningAccuracy
 import opacus_custom_samplers  # register custom Opacus samplers
-from opacus import GradSampleModule
 from opacus.optimizers import DPOptimizer
 import warnings
 
 warnings.filterwarnings('ignore')
 
+# timer tree and record_function ranges, reconfigured in __main__ once the arguments are known
+profiler = PhaseProfiler()
+# host reads of tensor values per episode, enabled with --sync_debug
+sync_counter = SyncCounter()
+
 fine_id_coarse_id = {0: 4, 1: 1, 2: 14, 3: 8, 4: 0, 5: 6, 6: 7, 7: 7, 8: 18, 9: 3, 10: 3, 11: 14, 12: 9, 13: 18, 14: 7, 15: 11, 16: 3, 17: 9, 18: 7, 19: 11, 20: 6, 21: 11, 22: 5, 23: 10, 24: 7, 25: 6, 26: 13, 27: 15, 28: 3, 29: 15, 30: 0, 31: 11, 32: 1, 33: 10, 34: 12, 35: 14, 36: 16, 37: 9, 38: 11, 39: 5, 40: 5, 41: 19, 42: 8, 43: 8, 44: 15, 45: 13, 46: 14, 47: 17, 48: 18, 49: 10, 50: 16, 51: 4, 52: 17, 53: 4, 54: 2, 55: 0, 56: 17, 57: 4, 58: 18, 59: 17, 60: 10, 61: 3, 62: 2, 63: 12, 64: 12, 65: 16, 66: 12, 67: 1, 68: 9, 69: 19, 70: 2, 71: 10, 72: 0, 73: 1, 74: 16, 75: 12, 76: 9, 77: 13, 78: 15, 79: 13, 80: 16, 81: 19, 82: 2, 83: 4, 84: 6, 85: 19, 86: 5, 87: 5, 88: 8, 89: 19, 90: 18, 91: 1, 92: 2, 93: 15, 94: 6, 95: 0, 96: 17, 97: 8, 98: 14, 99: 13}
 
 coarse_id_fine_id = {0: [4, 30, 55, 72, 95], 1: [1, 32, 67, 73, 91], 2: [54, 62, 70, 82, 92], 3: [9, 10, 16, 28, 61], 4: [0, 51, 53, 57, 83], 5: [22, 39, 40, 86, 87], 6: [5, 20, 25, 84, 94], 7: [6, 7, 14, 18, 24], 8: [3, 42, 43, 88, 97], 9: [12, 17, 37, 68, 76], 10: [23, 33, 49, 60, 71], 11: [15, 19, 21, 31, 38], 12: [34, 63, 64, 66, 75], 13: [26, 45, 77, 79, 99], 14: [2, 11, 35, 46, 98], 15: [27, 29, 44, 78, 93], 16: [36, 50, 65, 74, 80], 17: [47, 52, 56, 59, 96], 18: [8, 13, 48, 58, 90], 19: [41, 69, 81, 85, 89]}
@@ -101,7 +111,7 @@ def InforNCE_Loss(anchor, sample, tau, all_negative=False, temperature_matrix=No
 
     assert anchor.shape[0] == sample.shape[0]
 
-    pos_mask = torch.eye(anchor.shape[0], dtype=torch.float).cuda()
+    pos_mask = torch.eye(anchor.shape[0], dtype=torch.float, device=anchor.device)
     neg_mask = 1. - pos_mask
     sim = _similarity(anchor, sample / temperature_matrix if temperature_matrix != None else sample) / tau
     exp_sim = torch.exp(sim) * (pos_mask + neg_mask)
@@ -138,6 +148,12 @@ def get_args():
     parser.add_argument('--num_train_tasks', type=int, default=50, help='number of meta-training tasks (5)')
     parser.add_argument('--num_test_tasks', type=int, default=10, help='number of meta-test tasks')
     parser.add_argument('--num_true_test_ratio', type=int, default=10, help='number of meta-test tasks (10)')
+    parser.add_argument('--eval_ci_tol', type=float, default=0.0,
+                        help='stop meta-testing once the 95%% CI half-width of the accuracy is below this (0 disables)')
+    parser.add_argument('--eval_min_tasks', type=int, default=10, help='minimum number of meta-test tasks before stopping early')
+    parser.add_argument('--eval_every', type=int, default=1, help='evaluate the global model every N rounds (0 disables)')
+    parser.add_argument('--eval_async', type=int, default=0, help='evaluate a model snapshot in a background worker')
+    parser.add_argument('--eval_final', type=int, default=1, help='evaluate the final global model after the last round')
     parser.add_argument('--fine_tune_steps', type=int, default=5, help='number of meta-learning steps (5)')
     parser.add_argument('--fine_tune_lr', type=float, default=0.1, help='number of meta-learning lr (0.05)')
     parser.add_argument('--meta_lr', type=float, default=0.1/100, help='number of meta-learning lr (0.05)')
@@ -174,6 +190,8 @@ def get_args():
     parser.add_argument('--beta', type=float, default=1,  #0.5
                         help='The parameter for the dirichlet distribution for data partitioning')
     parser.add_argument('--device', type=str, default='cuda:0', help='The device to run the program')
+    parser.add_argument('--num_threads', type=int, default=0, help='intra-op CPU threads of this process (0: CPUs in its affinity mask)')
+    parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op CPU threads of this process (0: torch default)')
     parser.add_argument('--log_file_name', type=str, default=None, help='The log file name')
 
     parser.add_argument('--mu', type=float, default=1, help='the mu parameter for fedprox or moon')
@@ -186,6 +204,8 @@ def get_args():
     parser.add_argument('--load_model_file', type=str, default=None, help='the model to load as global model')
     parser.add_argument('--load_pool_file', type=str, default=None, help='the old model pool path to load')
     parser.add_argument('--load_model_round', type=int, default=None, help='how many rounds have executed for the loaded model')
+    parser.add_argument('--load_accountant_file', type=str, default=None,
+                        help='privacy accountant state saved with the loaded model')
     parser.add_argument('--load_first_net', type=int, default=1, help='whether load the first net as old net or not')
     parser.add_argument('--normal_model', type=int, default=0, help='use normal model or aggregate model')
     parser.add_argument('--loss', type=str, default='contrastive')
@@ -196,6 +216,41 @@ def get_args():
     parser.add_argument('--clip_norm', type=float, default=1.0, help='max L2 norm for client update')
     parser.add_argument('--noise_multiplier', type=float, default=0.0, help='noise multiplier for DP')
     parser.add_argument('--dp_delta', type=float, default=1e-5, help='delta for DP accounting')
+    parser.add_argument('--compress', type=str, default='none', choices=UpdateCompressor.METHODS,
+                        help='compression of the client uploads')
+    parser.add_argument('--topk_ratio', type=float, default=0.01, help='fraction of entries uploaded by --compress topk')
+    parser.add_argument('--broadcast_compress', type=str, default='none', choices=UpdateCompressor.METHODS,
+                        help='compression of the diff between the global model and a client\'s last copy')
+    parser.add_argument('--max_staleness', type=int, default=5,
+                        help='clients whose copy is older than this many rounds get the full model')
+    parser.add_argument('--error_feedback', type=int, default=1,
+                        help='carry what compression dropped over to the client\'s next upload')
+    parser.add_argument('--dp_stats_prob', type=float, default=0.0,
+                        help='probability of printing the norms of a client update (0 disables the diagnostics)')
+    parser.add_argument('--profile_rounds', type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                        help='capture rounds FIRST..LAST with torch.profiler and export a Chrome trace')
+    parser.add_argument('--profile_dir', type=str, default=None, help='directory of the Chrome traces (default: logdir/traces)')
+    parser.add_argument('--sync_free', type=int, default=0,
+                        help='keep meta-training metrics on the device and read them once per client and round')
+    parser.add_argument('--sync_debug', type=int, default=0, help='log the number of host syncs per episode every round')
+    parser.add_argument('--cost_log', type=str, default=None,
+                        help='append per-round bytes, phase timings and peak memory of every client to this .csv or .jsonl file')
+    parser.add_argument('--lora_rank', type=int, default=0,
+                        help='freeze the shared backbone and train, noise and upload rank-r adapters only (0: full backbone)')
+    parser.add_argument('--lora_alpha', type=float, default=None, help='adapters are scaled by lora_alpha / lora_rank (default: 1)')
+    parser.add_argument('--sparse_ebd', type=int, default=0,
+                        help='with --finetune_ebd: sparse embedding gradients, SparseAdam, and uploads of the used rows only')
+    parser.add_argument('--length_buckets', type=int, default=1,
+                        help='text model: encode the documents of a batch in this many groups of similar length')
+    parser.add_argument('--syn_classes', type=int, default=100, help='classes of the synthetic datasets')
+    parser.add_argument('--syn_test_classes', type=int, default=20, help='synthetic classes held out for meta-testing')
+    parser.add_argument('--syn_samples_per_class', type=int, default=600, help='examples of every synthetic class')
+    parser.add_argument('--syn_image_size', type=int, default=32, help='height and width of synthetic images')
+    parser.add_argument('--syn_seq_len', type=int, default=44, help='maximum length of synthetic documents')
+    parser.add_argument('--syn_vocab_size', type=int, default=20000, help='vocabulary size of synthetic documents')
+    parser.add_argument('--syn_seed', type=int, default=0, help='seed of the synthetic data, independent of init_seed')
+    parser.add_argument('--syn_memmap_dir', type=str, default=None,
+                        help='generate synthetic data once into a memory-mapped .npy file in this directory')
     args = parser.parse_args()
     return args
 
@@ -220,6 +275,8 @@ def init_nets(net_configs, n_parties, args, device='cpu'):
                                  76, 77, 78])
     elif args.dataset=='huffpost':
         total_classes=20
+    elif args.dataset in SYNTHETIC_DATASETS:
+        total_classes = args.syn_classes - args.syn_test_classes
 
     elif args.dataset == 'tinyimagenet':
         n_classes = 200
@@ -240,14 +297,16 @@ def init_nets(net_configs, n_parties, args, device='cpu'):
         if args.dataset=='20newsgroup':
             ebd=WORDEBD(args.finetune_ebd)
         for net_i in range(n_parties):
-            if args.dataset=='FC100' or args.dataset=='miniImageNet':
+            if args.dataset=='FC100' or args.dataset=='miniImageNet' or args.dataset=='synthetic':
                 net = ModelFed_Adp(args.model, args.out_dim, n_classes, total_classes, net_configs, args)
+            elif args.dataset=='synthetic_text':
+                net = LSTMAtt(WORDEBD(args.finetune_ebd, vocab_size=args.syn_vocab_size, sparse=bool(args.sparse_ebd)),
+                              args.out_dim, n_classes,
+                              total_classes, args)
             else:
-                net = LSTMAtt(WORDEBD(args.finetune_ebd), args.out_dim, n_classes, total_classes,args)
-            if device == 'cpu':
-                net.to(device)
-            else:
-                net = net.cuda()
+                net = LSTMAtt(WORDEBD(args.finetune_ebd, sparse=bool(args.sparse_ebd)), args.out_dim, n_classes,
+                              total_classes, args)
+            net.to(device)
             nets[net_i] = net
 
             
@@ -260,8 +319,119 @@ def init_nets(net_configs, n_parties, args, device='cpu'):
     return nets, model_meta_data, layer_type
 
 
+def meta_train_shape(args):
+    """Ways, shots and queries of a meta-training episode, ``(N, K, Q)``."""
+    if args.dataset=='fewrel' :
+        N = args.N*3
+        K = 2
+        Q = 2
+    elif args.dataset=='huffpost':
+        N = args.N
+        K = 5#args.K
+        Q = args.Q
+    elif args.dataset=='FC100':
+        N = args.N*4
+        K = 2
+        Q = 2
+    elif args.dataset=='miniImageNet' or args.dataset=='synthetic':
+        N = args.N*4
+        K = 2
+        Q = 2
+    else:
+        N = args.N
+        K = 5#args.K
+        Q = args.Q
+    return N, K, Q
+
+
+def episode_transform(dataset, train=True, image_size=32):
+    """Per-image transform of meta-training (augmenting) or meta-test episodes.
+
+    ``image_size`` is only used by the synthetic dataset, which is augmented
+    and normalised like FC100.
+    """
+    small = dataset == 'FC100' or dataset == 'synthetic'
+    if not train:
+        return transform_test(normalize=normalize_fc100 if small else normalize_mini)
+    if small:
+        crop_size = image_size if dataset == 'synthetic' else 32
+        #X_transform = transform_train(normalize=normalize_fc100, crop_size=32, padding=4)
+        return transforms.Compose([
+            lambda x: Image.fromarray(x),
+            transforms.RandomCrop(crop_size, padding=crop_size // 8),
+            transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
+            transforms.RandomHorizontalFlip(),
+            lambda x: np.asarray(x),
+            transforms.ToTensor(),
+            normalize_fc100
+        ])
+    else:
+        #X_transform = transform_train(normalize=normalize_mini, crop_size=84)
+        return transforms.Compose([
+            lambda x: Image.fromarray(x),
+                        #transforms.ToPILImage(),
+            transforms.RandomCrop(84, padding=8),
+            transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
+            transforms.RandomHorizontalFlip(),
+            lambda x: np.asarray(x),
+            transforms.ToTensor(),
+            normalize_mini
+        ])
+
+
+def sample_episode(X, y, class_dict, N, K, Q):
+    """Draw an N-way episode with K support and Q query examples per class.
+
+    Classes are redrawn until every one of them has ``K + Q`` examples.
+    Returns the drawn classes and the support and query examples, grouped by
+    class in the order of the classes.
+    """
+    min_size=0
+    while min_size<K+Q:
+        X_class=[]
+        classes = np.random.choice(class_dict, N, replace=False).tolist()
+        for i in classes:
+            X_class.append(X[y==i])
+        min_size=min([one.shape[0] for one in X_class])
+
+    X_sup=[]
+    X_query=[]
+    for X_class_i in X_class:
+        sample_idx=np.random.choice(list(range(X_class_i.shape[0])), K+Q, replace=False).tolist()
+        X_sup.append(X_class_i[sample_idx[:K]])
+        X_query.append(X_class_i[sample_idx[K:]])
+    return classes, np.concatenate(X_sup, 0), np.concatenate(X_query, 0)
+
+
+def fine_tune_few_classify(net, X_sup, support_labels, steps, lr):
+    """Adapt the few-shot head of ``net`` to the support set with ``steps`` gradient steps.
+
+    The adapted weights stay functions of the original ones, so a loss on
+    the adapted ``net`` backpropagates through the inner loop.
+    """
+    loss_ce = nn.CrossEntropyLoss()
+    for j in range(steps):
+        X_out_sup, X_transformer_out_sup, out = net(X_sup)
+        loss = loss_ce(out, support_labels)
+
+        net_para = net.state_dict()
+        param_require_grad = {}
+        for key, param in net.named_parameters():
+            if key == 'few_classify.weight' or key == 'few_classify.bias':
+                if param.requires_grad:
+                    param_require_grad[key] = param
+        grad = torch.autograd.grad(loss, param_require_grad.values(), allow_unused=True)
+        for key, grad_ in zip(param_require_grad.keys(), grad):
+            if grad_ == None: continue
+            net_para[key] = net_para[key] - lr * grad_
+        # only the adapted parameters changed
+        net.load_state_dict({key: net_para[key] for key in param_require_grad}, strict=False)
+    return net
+
+
 def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_train_client,y_train_client, X_test, y_test,
-                                        device='cpu', test_only=False, test_only_k=0):
+                                        device='cpu', test_only=False, test_only_k=0, test_bank=None, accountant=None,
+                                        cost=None):
     #net = nn.DataParallel(net)
     #net=nn.parallel.DistributedDataParallel(net)
     #net.cuda()
@@ -270,30 +440,44 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
     #logger.info('n_training: %d' % X_train_client.shape[0])
     #logger.info('n_test: %d' % X_test.shape[0])
     
-    if not isinstance(net.shared, GradSampleModule):
-        net.shared = GradSampleModule(net.shared)
+    # loss_all only flows through the all_classify forward of ``net`` (the
+    # transformer term comes from the fine-tuned copy), so only those children
+    # get per-sample gradients, clipping and noise
+    dp_params = wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=True))
+    cost = cost if cost is not None else CostTracker()
 
+    # Adam reads its step counts, which stay on the host
     if args_optimizer == 'adam':
-        base_opt = optim.Adam(net.shared.parameters(), lr=lr, weight_decay=args.reg)
+        base_opt = host_side_step(optim.Adam(dp_params, lr=lr, weight_decay=args.reg))
     elif args_optimizer == 'amsgrad':
-        base_opt = optim.Adam(
-            filter(lambda p: p.requires_grad, net.shared.parameters()),
+        base_opt = host_side_step(optim.Adam(
+            dp_params,
             lr=lr,
             weight_decay=args.reg,
             amsgrad=True,
-        )
+        ))
     elif args_optimizer == 'sgd':
         base_opt = optim.SGD(
-            filter(lambda p: p.requires_grad, net.shared.parameters()),
+            dp_params,
             lr=lr,
             momentum=0.9,
             weight_decay=args.reg,
         )
+    # meta-training losses of --sync_free, read once after the last episode
+    losses = []
+
+    N, K, Q = meta_train_shape(args)
     dp_optimizer = DPOptimizer(
         base_opt,
+        expected_batch_size=N * (K + Q),
         noise_multiplier=args.noise_multiplier,
         max_grad_norm=args.clip_norm,
     )
+    if accountant is not None and not test_only:
+        # each DP-SGD step uses one episode of N*(K+Q) examples of the client's data
+        sample_rate = min(1.0, N * (K + Q) / len(X_train_client))
+        dp_optimizer.attach_step_hook(
+            lambda opt: accountant.step('dp_sgd/{}'.format(net_id), opt.noise_multiplier, sample_rate))
 
     transform_params = list(net.transform_layer.parameters())
     optimizer_transform = (
@@ -304,62 +488,27 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
     optimizer_few = optim.SGD(
         net.few_classify.parameters(), lr=lr, momentum=0.9, weight_decay=args.reg
     )
+    # fine-tuned word embeddings with sparse gradients, updated row by row
+    ebd_params = [p for p in net.ebd.parameters() if p.requires_grad] if hasattr(net, 'ebd') else []
+    optimizer_ebd = host_side_step(optim.SparseAdam(ebd_params, lr=lr)) if ebd_params and args.sparse_ebd else None
     loss_ce = nn.CrossEntropyLoss()
     loss_mse = nn.MSELoss()
 
     def train_epoch(epoch, mode='train'):
-        nonlocal dp_optimizer, optimizer_transform, optimizer_few
+        nonlocal dp_optimizer, optimizer_transform, optimizer_few, optimizer_ebd
+        cost.lap(net_id)
+        profiler.step('construction')
 
         if mode == 'train':
-
-            if args.dataset=='fewrel' :
-                N=args.N*3
-                K=2
-                Q=2
-            elif args.dataset=='huffpost':
-                N = args.N
-                K = 5#args.K
-                Q = args.Q
-            elif args.dataset=='FC100':
-                N=args.N*4
-                K=2
-                Q=2
-            elif args.dataset=='miniImageNet':
-                N=args.N*4
-                K=2
-                Q=2
-            else:
-                N = args.N
-                K = 5#args.K
-                Q = args.Q
+            N, K, Q = meta_train_shape(args)
             net.train()
             dp_optimizer.zero_grad()
             if optimizer_transform:
                 optimizer_transform.zero_grad()
             optimizer_few.zero_grad()
-            if args.dataset == 'FC100':
-                #X_transform = transform_train(normalize=normalize_fc100, crop_size=32, padding=4)
-                X_transform=    transforms.Compose([
-                    lambda x: Image.fromarray(x),
-                    transforms.RandomCrop(32, padding=4),
-                    transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
-                    transforms.RandomHorizontalFlip(),
-                    lambda x: np.asarray(x),
-                    transforms.ToTensor(),
-                    normalize_fc100
-                ])
-            else:
-                #X_transform = transform_train(normalize=normalize_mini, crop_size=84)
-                X_transform=    transforms.Compose([
-                    lambda x: Image.fromarray(x),
-                                #transforms.ToPILImage(),
-                    transforms.RandomCrop(84, padding=8),
-                    transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
-                    transforms.RandomHorizontalFlip(),
-                    lambda x: np.asarray(x),
-                    transforms.ToTensor(),
-                    normalize_mini
-                ])
+            if optimizer_ebd:
+                optimizer_ebd.zero_grad()
+            X_transform = episode_transform(args.dataset, train=True, image_size=args.syn_image_size)
 
         else:
             N=args.N
@@ -367,10 +516,7 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
             Q=args.Q
             #N=args.N*2
             net.eval()
-            if args.dataset == 'FC100':
-                X_transform = transform_test(normalize=normalize_fc100)
-            else:
-                X_transform = transform_test(normalize=normalize_mini)
+            X_transform = episode_transform(args.dataset, train=False)
 
         if test_only==True:
             K=test_only_k
@@ -381,9 +527,11 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
         query_labels = torch.zeros(N * Q, dtype=torch.long)
         for i in range(N):
             query_labels[i * Q:(i + 1) * Q] = i
-        if args.device != 'cpu':
-            support_labels = support_labels.cuda()
-            query_labels = query_labels.cuda()
+        # host copies for the sklearn evaluator
+        support_labels_np = support_labels.numpy()
+        query_labels_np = query_labels.numpy()
+        support_labels = support_labels.to(device)
+        query_labels = query_labels.to(device)
 
         if mode == 'train':
             if args.dataset=='FC100':
@@ -400,6 +548,8 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
                                  76, 77, 78]
             elif args.dataset=='huffpost':
                 class_dict=list(range(20))
+            elif args.dataset in SYNTHETIC_DATASETS:
+                class_dict = synthetic_classes(args.syn_classes, args.syn_test_classes)[0]
 
             X=X_train_client
             y=y_train_client
@@ -416,60 +566,48 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
                 class_dict = [23, 29, 42, 47, 51, 54, 55, 60, 65, 79]
             elif args.dataset=='huffpost':
                 class_dict=list(range(25, 41))
+            elif args.dataset in SYNTHETIC_DATASETS:
+                class_dict = synthetic_classes(args.syn_classes, args.syn_test_classes)[1]
 
             X=X_test
             y=y_test
 
-        min_size=0
-        while min_size<K+Q:
-            X_class=[]
-            classes = np.random.choice(class_dict, N, replace=False).tolist()
-            for i in classes:
-                X_class.append(X[y==i])      
-            min_size=min([one.shape[0] for one in X_class])
-
-        X_total_sup=[]
-        X_total_query=[]
-        y_sup=[]
-        y_query=[]
-        transformed_class_list=[]
-        for class_, X_class_i in zip(classes, X_class):
-            sample_idx=np.random.choice(list(range(X_class_i.shape[0])), K+Q, replace=False).tolist()
-            X_total_sup.append(X_class_i[sample_idx[:K]])
-            X_total_query.append(X_class_i[sample_idx[K:]])
+        if mode == 'test' and test_bank is not None:
+            # replay the precomputed episode instead of sampling a new one
+            episodes = test_bank[K]
+            episode_id = epoch % episodes['support'].shape[0]
+            X_total_sup = X[episodes['support'][episode_id]]
+            X_total_query = X[episodes['query'][episode_id]]
+        else:
+            classes, X_total_sup, X_total_query = sample_episode(X, y, class_dict, N, K, Q)
             if mode=='train':
-                if args.dataset=='FC100' or args.dataset=='20newsgroup' or args.dataset=='fewrel' or args.dataset=='huffpost':
-                    transformed_class_list.append(fine_split_train_map[class_])
-                    y_sup.append(torch.ones(K)*fine_split_train_map[class_])
-                    y_query.append(torch.ones(Q) * fine_split_train_map[class_])
-                elif args.dataset=='miniImageNet':
-                    transformed_class_list.append(class_)
-                    y_sup.append(torch.ones(K)*class_)
-                    y_query.append(torch.ones(Q) * class_)
-
-
-
-
-                y_total = torch.cat([torch.cat(y_sup, 0), torch.cat(y_query, 0)], 0).long().cuda()
-        #y_total=torch.tensor(np.concatenate([np.concatenate(y_sup, 0),np.concatenate(y_query, 0)],0)).cuda()
-        
-        X_total_sup=np.concatenate(X_total_sup, 0)
-        X_total_query=np.concatenate(X_total_query,0)
-
-
-        if args.dataset=='FC100' or args.dataset=='miniImageNet':
-            X_total_transformed_sup=[]
-            X_total_transformed_query=[]
-            for i in range(X_total_sup.shape[0]):
-                X_total_transformed_sup.append(X_transform(X_total_sup[i]))
-            X_total_sup=torch.stack(X_total_transformed_sup,0).cuda()
-
-            for i in range(X_total_query.shape[0]):
-                X_total_transformed_query.append(X_transform(X_total_query[i]))
-            X_total_query=torch.stack(X_total_transformed_query,0).cuda()
+                y_sup=[]
+                y_query=[]
+                for class_ in classes:
+                    if args.dataset=='FC100' or args.dataset=='20newsgroup' or args.dataset=='fewrel' or args.dataset=='huffpost':
+                        y_sup.append(torch.ones(K)*fine_split_train_map[class_])
+                        y_query.append(torch.ones(Q) * fine_split_train_map[class_])
+                    elif args.dataset=='miniImageNet' or args.dataset in SYNTHETIC_DATASETS:
+                        # train classes are already 0..total_classes-1
+                        y_sup.append(torch.ones(K)*class_)
+                        y_query.append(torch.ones(Q) * class_)
+                y_total = torch.cat([torch.cat(y_sup, 0), torch.cat(y_query, 0)], 0).long().to(device)
+
+
+        profiler.step('augmentation')
+        if args.dataset=='FC100' or args.dataset=='miniImageNet' or args.dataset=='synthetic':
+            # host-side augmentation: its reads of CPU tensors never wait for the device
+            with sync_counter.paused():
+                X_total_transformed_sup = [X_transform(x) for x in X_total_sup]
+                X_total_transformed_query = [X_transform(x) for x in X_total_query]
+            X_total_sup=torch.stack(X_total_transformed_sup,0).to(device)
+            X_total_query=torch.stack(X_total_transformed_query,0).to(device)
         else:
-            X_total_sup=torch.tensor(X_total_sup).cuda()
-            X_total_query=torch.tensor(X_total_query).cuda()
+            # embed only up to the longest document of the episode
+            X_total_sup, X_total_query = trim_text_batch(X_total_sup, X_total_query)
+            # left on the host, the text model moves the token ids and packs with host lengths
+            X_total_sup=torch.tensor(X_total_sup)
+            X_total_query=torch.tensor(X_total_query)
 
 
 
@@ -478,12 +616,16 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
         #_,_,out_all=net_new(torch.cat([X_total_sup, X_total_query],0), all_classify=True)
 
             #print(out[:3])
+        cost.lap(net_id, 'sampling')
         if mode == 'train':
+            profiler.step('forward')
             loss_all=0
             # all_classify update
             X_out_all, x_all, out_all = net(torch.cat([X_total_sup, X_total_query], 0), all_classify=True)
             out_sup=X_out_all[:N*K].reshape([N,K,-1]).transpose(0,1)
             out_query=X_out_all[N*K:].reshape([N,Q,-1]).transpose(0,1)
+            cost.lap(net_id, 'forward')
+            profiler.step('inner_loop')
 
 
 
@@ -492,29 +634,8 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
 
 
             if args.fine_tune_steps>0:
-                net_new = copy.deepcopy(net)
-
-                for j in range(args.fine_tune_steps):
-                    X_out_sup, X_transformer_out_sup, out = net_new(X_total_sup)
-                    loss = loss_ce(out, support_labels)
-                    #loss+=loss_ce(out, out_sup_on_N_class)
-                    #loss+=loss_mse(out_sup_on_N_class.softmax(-1),out.softmax(-1))
-
-                    net_para = net_new.state_dict()
-                    param_require_grad = {}
-                    for key, param in net_new.named_parameters():
-                        if key == 'few_classify.weight' or key == 'few_classify.bias':
-                            # if key !='all_classify.weight' and key !='all_classify.bias':
-                            if param.requires_grad:
-                                param_require_grad[key] = param
-                    grad = torch.autograd.grad(loss, param_require_grad.values(), allow_unused=True)
-                    for key, grad_ in zip(param_require_grad.keys(), grad):
-                        if grad_ == None: continue
-                        net_para[key] = net_para[key] - args.fine_tune_lr * grad_
-                    # net_para = list(
-                    #                map(lambda p: p[1] - fine_tune_lr * p[0], zip(grad, net_para)))
-                    # net_para={key:value for key, value in zip(net.state_dict().keys(),net.state_dict().values())}
-                    net_new.load_state_dict(net_para)
+                net_new = fine_tune_few_classify(inner_loop_copy(net), X_total_sup, support_labels, args.fine_tune_steps,
+                                                 args.fine_tune_lr)
 
                 X_out_query, _, out = net_new(X_total_query)
                 X_out_sup, X_transformer_out_sup, _ = net_new(X_total_sup)
@@ -527,36 +648,48 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
                                                              tau=0.5)
                     loss_all += contras_loss / Q * 0.1
                 loss_all += loss_ce(out_all, y_total)
+                cost.lap(net_id, 'inner_loop')
+                profiler.step('outer_backward')
                 loss_all.backward()
+                profiler.step('dp_step')
                 dp_optimizer.step()
                 if optimizer_transform:
                     optimizer_transform.step()
                 optimizer_few.step()
+                if optimizer_ebd:
+                    optimizer_ebd.step()
+                cost.lap(net_id, 'dp_step')
+                profiler.step('metrics')
                 ############################
 
-                X_out_all, x_all, out_all = net(torch.cat([X_total_sup, X_total_query], 0), all_classify=True)
+                # metrics only, keep it out of the per-sample gradient hooks
+                with torch.no_grad():
+                    X_out_all, x_all, out_all = net(torch.cat([X_total_sup, X_total_query], 0), all_classify=True)
                 del net_new, X_out_query, out
+                cost.lap(net_id, 'forward')
 
-            if np.random.rand() < 0.005:
-                print('loss: {:.4f}'.format(loss_all.item()))
-
-
-            acc_train = (torch.argmax(out_all, -1) == y_total).float().mean().item()
+            acc_train = (torch.argmax(out_all, -1) == y_total).float().mean()
+            if args.sync_free:
+                losses.append(loss_all.detach())
+            else:
+                if np.random.rand() < 0.005:
+                    print('loss: {:.4f}'.format(loss_all.item()))
+                acc_train = acc_train.item()
 
             del X_out_all,  out_all
             return acc_train
 
         else:
+            profiler.step('evaluation')
             use_logistic=True
 
             if use_logistic:
                 with torch.no_grad():
                     X_out_all, x_all, out_all = net(torch.cat([X_total_sup, X_total_query], 0))
-                    X_out_sup=X_out_all[:N*K]
-                    X_out_query=X_out_all[N*K:]
-
-                    support_features = l2_normalize(X_out_sup.detach().cpu()).numpy()
-                    query_features = l2_normalize(X_out_query.detach().cpu()).numpy()
+                    # a single transfer of the support and query features
+                    features = l2_normalize(X_out_all).cpu().numpy()
+                    support_features = features[:N*K]
+                    query_features = features[N*K:]
 
                     # ---- PATCH START ---------------------------------
                     # Replace any NaN / ±Inf that may have been produced by l2_normalize
@@ -571,17 +704,17 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
                                              random_state=0,
                                              C=1.0,
                                              solver='lbfgs',
-                                             max_iter=1000,
-                                             multi_class='multinomial')
-                    clf.fit(support_features, support_labels.detach().cpu().numpy())
+                                             max_iter=1000)
+                    clf.fit(support_features, support_labels_np)
 
                     query_ys_pred = clf.predict(query_features)
 
-                    out=torch.tensor(clf.predict_proba(query_features)).cuda()
+                    out=torch.tensor(clf.predict_proba(query_features)).to(device)
 
-                    acc_train = (torch.argmax(out, -1) == query_labels).float().mean().item()
+                    acc_train = float(np.mean(query_ys_pred == query_labels_np))
                     max_value, index=torch.max(out,-1)
 
+                    cost.lap(net_id, 'eval')
                     #del net_new, X_out_sup, X_out_query, out, param_require_grad, grad
                     if test_only:
                         return acc_train, max_value, index
@@ -608,15 +741,21 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
         best_acc = 0
         accs_train=[]
         for epoch in range(args.num_train_tasks):
-            accs_train.append(train_epoch(epoch))
-            if np.random.rand() < 0.05:
+            with profiler.range('episode'), sync_counter.episode('train'):
+                accs_train.append(train_epoch(epoch))
+            if not args.sync_free and np.random.rand() < 0.05:
                 logger.info("Meta-train_Accuracy: {:.4f}".format(np.mean(accs_train)))
                 print("Meta-train_Accuracy: {:.4f}".format(np.mean(accs_train)))
+        if args.sync_free and losses:
+            acc_train, loss_train = torch.stack([torch.stack(accs_train).mean(), torch.stack(losses).mean()]).tolist()
+            logger.info("Meta-train_Accuracy: {:.4f} loss: {:.4f}".format(acc_train, loss_train))
+            print("Meta-train_Accuracy: {:.4f} loss: {:.4f}".format(acc_train, loss_train))
 
 
         accs=[]
         for epoch_test in range(args.num_test_tasks):
-            accs.append(train_epoch(epoch_test, mode='test'))
+            with profiler.range('test_episode'), sync_counter.episode('test'):
+                accs.append(train_epoch(epoch_test, mode='test'))
     else:
         accs=[]
         max_values=[]
@@ -629,12 +768,24 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
         #    accs_train.append(train_epoch(epoch))
         #########################################
 
-        for epoch_test in range(args.num_test_tasks*args.num_true_test_ratio):
-            acc, max_value, index=train_epoch(epoch_test, mode='test')
+        running_acc = RunningAccuracy()
+        max_test_tasks = args.num_test_tasks*args.num_true_test_ratio
+        for epoch_test in range(max_test_tasks):
+            with profiler.range('test_episode'), sync_counter.episode('test'):
+                acc, max_value, index=train_epoch(epoch_test, mode='test')
             accs.append(acc)
             max_values.append(max_value)
             indices.append(index)
+            running_acc.update(acc)
             del acc, max_value, index
+            # stop early once the accuracy estimate is tight enough
+            if running_acc.converged(args.eval_ci_tol, args.eval_min_tasks):
+                break
+
+        logger.info('Meta-test k={}: {}/{} episodes, acc {:.4f} +- {:.4f}'.format(
+            test_only_k, running_acc.count, max_test_tasks, running_acc.mean, running_acc.half_width()))
+        print('Meta-test k={}: {}/{} episodes, acc {:.4f} +- {:.4f}'.format(
+            test_only_k, running_acc.count, max_test_tasks, running_acc.mean, running_acc.half_width()))
 
         return np.mean(accs), torch.cat(max_values,0), torch.cat(indices,0)
 
@@ -645,12 +796,95 @@ def train_net_few_shot_new(net_id, net, n_epoch, lr, args_optimizer, args, X_tra
     return  np.mean(accs)
 
 
-def local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_test, y_test, device="cpu", test_only=False, test_only_k=0):
+def preprocess_test_batch(args, X):
+    if args.dataset == 'FC100' or args.dataset == 'miniImageNet' or args.dataset == 'synthetic':
+        X_transform = episode_transform(args.dataset, train=False)
+        return torch.stack([X_transform(x) for x in X], 0)
+    return torch.tensor(trim_text_batch(X)[0])
+
+
+def evaluate_clients_few_shot(nets, args, X_test, test_bank, k, device="cpu", chunk_size=256):
+    """Meta-test every client on the episode bank with a single pass over the test pool.
+
+    All clients must share the backbone (the global model, see
+    :class:`NetSnapshot`), so every pool row used by the bank is embedded
+    once and the episodes only index the cached features. Clients whose private transform layers coincide share their
+    features; the remaining transform layers are stacked into one backbone batch of at most ``chunk_size`` images.
+    The logistic-regression evaluator only reads the backbone embedding, the
+    private transformer and few-shot head do not enter the metric.
+
+    Returns the accuracy of every client and, per client, the predicted-class
+    probability and prediction of every query of the evaluated episodes.
+    """
+    episodes = test_bank[k]
+    rows = np.unique(np.concatenate([episodes['support'].ravel(), episodes['query'].ravel()]))
+
+    groups = {}
+    for net_id, net in nets.items():
+        signature = tuple(p.detach().cpu().numpy().tobytes() for p in net.transform_layer.parameters())
+        groups.setdefault(signature, []).append(net_id)
+    groups = list(groups.values())
+
+    net = nets[groups[0][0]]
+    # one backbone pass for all groups needs the transform layer in front of it
+    batched = isinstance(net, ModelFed_Adp)
+    if batched:
+        transform_layers = [copy.deepcopy(nets[group[0]].transform_layer).eval() for group in groups]
+        backbone = net.shared[0]
+        backbone.eval()
+
+    features = [[] for _ in groups]
+    with torch.no_grad():
+        if batched:
+            step = max(1, chunk_size // len(transform_layers))
+            for start in range(0, len(rows), step):
+                x = preprocess_test_batch(args, X_test[rows[start:start + step]]).to(device)
+                h = backbone(torch.cat([layer(x) for layer in transform_layers], 0))
+                h = l2_normalize(h.reshape(h.shape[0], -1)).reshape(len(groups), x.shape[0], -1).cpu()
+                for g in range(len(groups)):
+                    features[g].append(h[g])
+        else:
+            for g, group in enumerate(groups):
+                net = nets[group[0]]
+                net.eval()
+                for start in range(0, len(rows), chunk_size):
+                    x = preprocess_test_batch(args, X_test[rows[start:start + chunk_size]]).to(device)
+                    features[g].append(l2_normalize(net(x)[0]).cpu())
+
+    # zero vectors occasionally sneak through and break scikit-learn
+    features = [np.nan_to_num(torch.cat(f, 0).numpy(), nan=0.0, posinf=0.0, neginf=0.0) for f in features]
+    # all groups stop at the same episode, so their results line up
+    results = meta_test_groups(features, rows, episodes, args.N, args.Q, args.eval_ci_tol, args.eval_min_tasks)
+
+    acc_per_client = {}
+    max_value_per_client = {}
+    index_per_client = {}
+    for group, (accs, max_values, indices, running_acc) in zip(groups, results):
+        logger.info('Meta-test k={} clients {}: {}/{} episodes, acc {:.4f} +- {:.4f}'.format(
+            k, group, running_acc.count, len(episodes['support']), running_acc.mean, running_acc.half_width()))
+        for net_id in group:
+            acc_per_client[net_id] = np.mean(accs)
+            max_value_per_client[net_id] = torch.from_numpy(max_values)
+            index_per_client[net_id] = torch.from_numpy(indices)
+
+    acc_list = [acc_per_client[net_id] for net_id in nets.keys()]
+    logger.info(' | '.join(['{:.4f}'.format(acc) for acc in acc_list]) + ' | mean {:.4f}'.format(np.mean(acc_list)))
+    print(' | '.join(['{:.4f}'.format(acc) for acc in acc_list]) + ' | mean {:.4f}'.format(np.mean(acc_list)))
+
+    max_value_all_clients = [max_value_per_client[net_id] for net_id in nets.keys()]
+    indices_all_clients = [index_per_client[net_id] for net_id in nets.keys()]
+    return acc_list, max_value_all_clients, indices_all_clients
+
+
+def local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_test, y_test, device="cpu", test_only=False, test_only_k=0, test_bank=None, accountant=None, cost=None):
     avg_acc = 0.0
     acc_list = []
     max_value_all_clients=[]
     indices_all_clients=[]
 
+    if test_only and test_bank is not None:
+        return evaluate_clients_few_shot(nets, args, X_test, test_bank, test_only_k, device=device)
+
     for net_id, net in nets.items():
         print(net_id)
 
@@ -676,24 +910,18 @@ def local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_te
 
 
         if test_only==False:
-            testacc = train_net_few_shot_new(net_id, net, n_epoch, args.lr, args.optimizer, args, X_train_client,y_train_client,X_test, y_test,
-                                        device=device, test_only=False)
+            with profiler.range('client {}'.format(net_id)):
+                testacc = train_net_few_shot_new(net_id, net, n_epoch, args.lr, args.optimizer, args, X_train_client,y_train_client,X_test, y_test,
+                                            device=device, test_only=False, test_bank=test_bank, accountant=accountant,
+                                            cost=cost)
         else:
             #np.random.seed(1)
             testacc, max_values, indices=train_net_few_shot_new(net_id, net, n_epoch, args.lr, args.optimizer, args, X_train_client,y_train_client,X_test, y_test,
-                                        device=device, test_only=True, test_only_k=test_only_k)
+                                        device=device, test_only=True, test_only_k=test_only_k, test_bank=test_bank)
             max_value_all_clients.append(max_values)
             indices_all_clients.append(indices)
             #np.random.seed(int(time.time()))
 
-            acc_list.append(testacc)
-
-            logger.info(' | '.join(['{:.4f}'.format(acc) for acc in acc_list]))
-            print(' | '.join(['{:.4f}'.format(acc) for acc in acc_list]))
-
-            max_value_all_clients = torch.stack(max_value_all_clients, 0)
-            indices_all_clients = torch.stack(indices_all_clients, 0)
-            return acc_list, max_value_all_clients, indices_all_clients
 
         #logger.info("net {} final test acc {:.4f}" .format(net_id, testacc))
 
@@ -708,8 +936,7 @@ def local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_te
     print(' | '.join(['{:.4f}'.format(acc) for acc in acc_list]))
 
     if test_only:
-        max_value_all_clients=torch.stack(max_value_all_clients,0)
-        indices_all_clients=torch.stack(indices_all_clients,0)
+        # one tensor per client, early stopping (--eval_ci_tol) may end the clients at different episodes
         return acc_list, max_value_all_clients, indices_all_clients
 
     avg_acc /= args.n_parties
@@ -720,25 +947,40 @@ def local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_te
     return nets
 
 
+def evaluate_global_model(nets, args, net_dataidx_map, X_train, y_train, X_test, y_test, device="cpu", test_bank=None):
+    """Meta-test the broadcast global model with 1 and 5 shots, returns ``{k: accuracy}``."""
+    accs = {}
+    for k in [1, 5]:
+        acc_list, _, _ = local_train_net_few_shot(nets, args, net_dataidx_map, X_train, y_train, X_test, y_test,
+                                                  device=device, test_only=True, test_only_k=k, test_bank=test_bank)
+        accs[k] = max(acc_list)
+    return accs
+
+
+def report_global_accuracy(round, accs, best_acc, best_acc_5):
+    if accs[1] > best_acc:
+        best_acc = accs[1]
+    print('>> Round {} Global 1 Model Test accuracy: {:.4f} Best Acc: {:.4f}'.format(round, accs[1], best_acc))
+    logger.info('>> Round {} Global 1 Model Test accuracy: {:.4f} Best Acc: {:.4f} '.format(round, accs[1], best_acc))
+    if accs[5] > best_acc_5:
+        best_acc_5 = accs[5]
+    print('>> Round {} Global 5 Model Test accuracy: {:.4f} Best Acc: {:.4f}'.format(round, accs[5], best_acc_5))
+    logger.info('>> Round {} Global 5 Model Test accuracy: {:.4f} Best Acc: {:.4f} '.format(round, accs[5], best_acc_5))
+    return best_acc, best_acc_5
+
+
+def save_best_model(args, global_w, local_w, accountant):
+    mkdirs(args.modeldir+'fedavg/')
+    torch.save(global_w, args.modeldir+'fedavg/'+'globalmodel'+args.log_file_name+'.pth')
+    torch.save(local_w, args.modeldir+'fedavg/'+'localmodel0'+args.log_file_name+'.pth')
+    torch.save(accountant.state_dict(), args.modeldir+'fedavg/'+'accountant'+args.log_file_name+'.pth')
+
+
 if __name__ == '__main__':
     args = get_args()
     print(args)
 
-    # Debug
-    import torch, time
-
-    print(torch.cuda.is_available())  # True
-    print(torch.cuda.current_device())  # 0
-    print(torch.cuda.get_device_name(0))  # GeForce RTX 3070
-    start = time.time()
-    dummy = torch.rand(4096, 4096, device='cuda') @ torch.rand(4096, 4096, device='cuda')
-    torch.cuda.synchronize()
-    print("GEMM time:", time.time() - start, "s")  # should be < 0.2 s
-
-    if torch.cuda.is_available():
-        print(f"Running on GPU {torch.cuda.current_device()}:",
-              torch.cuda.get_device_name(0))
-    # Debug End
+    device = setup_device(args)
 
     if args.dataset=='FC100':
         fine_split_train_map={class_:i for i,class_ in enumerate(fine_split['train'])}
@@ -761,7 +1003,6 @@ if __name__ == '__main__':
         argument_path = args.log_file_name + '.json'
     with open(os.path.join(args.logdir, argument_path), 'w') as f:
         json.dump(str(args), f)
-    device = torch.device(args.device)
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
 
@@ -773,17 +1014,10 @@ if __name__ == '__main__':
         format='%(asctime)s %(levelname)-8s %(message)s',
         datefmt='%m-%d %H:%M', level=logging.DEBUG, filemode='w')
 
-    test_task_sample_seed=1
-    np.random.seed(test_task_sample_seed)
-    test_classes=[]
-    test_index=[]
-    for i in range(args.num_test_tasks):
-        test_classes.append(np.random.choice(fine_split['test'], args.N, replace=False).tolist())
-        test_index.append(np.random.rand(args.N, args.K+args.Q))
-
-
-
     logger = logging.getLogger()
+    profiler = PhaseProfiler(trace_dir=args.profile_dir or os.path.join(args.logdir, 'traces'),
+                             trace_rounds=args.profile_rounds)
+    sync_counter = SyncCounter(enabled=bool(args.sync_debug))
     logger.setLevel(logging.DEBUG)
     logger.info(device)
 
@@ -800,10 +1034,17 @@ if __name__ == '__main__':
 
     logger.info("Partitioning data")
     X_train, y_train, X_test, y_test, net_dataidx_map, traindata_cls_counts = partition_data(
-        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta)
+        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta,
+        synthetic=synthetic_config(args))
 
     print(X_train.shape)
     print(X_test.shape)
+
+    # fixed meta-test episodes, replayed every round for every client
+    test_task_sample_seed=1
+    test_bank = build_test_episode_bank(y_test, args.N, args.Q, ks=sorted({1, 5, args.K}),
+                                        num_episodes=args.num_test_tasks*args.num_true_test_ratio,
+                                        seed=test_task_sample_seed)
     N=args.N
     K=args.K
     Q=args.Q
@@ -814,9 +1055,8 @@ if __name__ == '__main__':
     query_labels=torch.zeros(N*Q,dtype=torch.long)
     for i in range(N):
         query_labels[i * Q:(i + 1) * Q] = i
-    if args.device!='cpu':
-        support_labels=support_labels.cuda()
-        query_labels=query_labels.cuda()
+    support_labels=support_labels.to(device)
+    query_labels=query_labels.to(device)
     
     
     n_party_per_round = int(args.n_parties * args.sample_fraction)
@@ -833,9 +1073,9 @@ if __name__ == '__main__':
 
 
     logger.info("Initializing nets")
-    nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.n_parties, args, device='gpu')
+    nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.n_parties, args, device=device)
 
-    global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 1, args, device='gpu')
+    global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 1, args, device=device)
     global_model = global_models[0]
     n_comm_rounds = args.comm_round
     if args.load_model_file and args.alg != 'plot_visual':
@@ -852,7 +1092,33 @@ if __name__ == '__main__':
         best_acc_5=0
         best_confident_acc=0
 
-        dp_steps = 0
+        accountant = RDPAccountant()
+        if args.load_accountant_file:
+            accountant.load_state_dict(torch.load(args.load_accountant_file))
+        # the global weights each pending evaluation measures
+        eval_weights = {}
+        eval_scheduler = EvalScheduler(every=args.eval_every, asynchronous=args.eval_async)
+        compressor = UpdateCompressor(args.compress, topk_ratio=args.topk_ratio, error_feedback=args.error_feedback)
+        broadcaster = BroadcastEncoder(
+            [k for k, v in global_model.state_dict().items() if torch.is_floating_point(v) and not is_private_key(k)],
+            method=args.broadcast_compress, topk_ratio=args.topk_ratio, max_staleness=args.max_staleness)
+        cost = CostTracker(args.cost_log, device=device)
+        # with sparse embeddings, clients upload only the embedding rows they looked up
+        sparse_ebd_key = None
+        if args.finetune_ebd and args.sparse_ebd:
+            if args.noise_multiplier > 0:
+                # the set of rows would reveal the client's vocabulary, it is not covered by the noise
+                logger.info('--sparse_ebd: DP noise is on, the word embeddings are uploaded in full')
+            else:
+                sparse_ebd_key = 'ebd.embedding_layer.weight'
+        lora_server = None
+        if args.lora_rank > 0:
+            for net in nets.values():
+                add_lora_adapters(net.shared, net.dp_shared_indices(all_classify=True), args.lora_rank, args.lora_alpha)
+            # the server rebuilds the averaged factors on its own copy and folds them into the global weights
+            lora_server = copy.deepcopy(global_model)
+            add_lora_adapters(lora_server.shared, lora_server.dp_shared_indices(all_classify=True),
+                              args.lora_rank, args.lora_alpha)
         for round in range(n_comm_rounds):
             #logger.info("in comm round:" + str(round))
             party_list_this_round = party_list_rounds[round]
@@ -866,81 +1132,124 @@ if __name__ == '__main__':
             total_data_points = sum(len(net_dataidx_map[r]) for r in range(args.n_parties))
             fed_avg_freqs = {r: len(net_dataidx_map[r]) / total_data_points for r in range(args.n_parties)}
             
+            cost.start_round(round)
+            profiler.start_round(round)
+            profiler.step('broadcast')
+            downlink_bytes = 0
+            start_w = {}
+            if lora_server is not None:
+                # every client of the round starts from the same adapters, the server knows them from the seed
+                lora_seed = np.random.randint(2**31)
+                lora_start = {k: v.clone() for k, v in lora_factors(reset_lora_adapters(lora_server, lora_seed)).items()}
             for net_id, net in nets_this_round.items():
+                cost.lap(net_id)
                 if use_minus:
                     net_para = net.state_dict()
                     for key in net_para:
                         net_para[key]=(global_w[key]*total_data_points-net_para[key]*len(net_dataidx_map[net_id]))/(total_data_points+1e-9-len(net_dataidx_map[net_id]))    
                     net.load_state_dict(net_para)
                 else:
-                    net_para = net.state_dict()
-                    for key in net_para:
-                        if (
-                            key != 'few_classify.weight'
-                            and key != 'few_classify.bias'
-                            and 'transformer' not in key
-                            and 'transform_layer' not in key
-                        ):
-                            net_para[key] = global_w[key]
-                    net.load_state_dict(net_para)
-
-            for k in [1,5]:
-                global_acc, max_value_all_clients, indices_all_clients=local_train_net_few_shot(nets_this_round, args, net_dataidx_map, X_train, y_train, X_test, y_test, device=device, test_only=True, test_only_k=k)
-                global_acc = max(global_acc)
-                if k==1:
-                    if global_acc > best_acc:
-                        best_acc = global_acc
-                    print('>> Global 1 Model Test accuracy: {:.4f} Best Acc: {:.4f}'.format(global_acc, best_acc))
-                    logger.info(
-                        '>> Global 1 Model Test accuracy: {:.4f} Best Acc: {:.4f} '.format(global_acc, best_acc))
-                elif k==5:
-                    if global_acc > best_acc_5:
-                        best_acc_5 = global_acc
-                    print('>> Global 5 Model Test accuracy: {:.4f} Best Acc: {:.4f}'.format(global_acc, best_acc_5))
-                    logger.info(
-                        '>> Global 5 Model Test accuracy: {:.4f} Best Acc: {:.4f} '.format(global_acc, best_acc_5))
-
-
-            local_train_net_few_shot(nets_this_round, args, net_dataidx_map, X_train, y_train, X_test, y_test, device=device)
-
-            deltas = {}
+                    client_w, nbytes = broadcaster.sync(net_id, global_w, round)
+                    downlink_bytes += nbytes
+                    cost.add_bytes(net_id, download=nbytes)
+                    # clients train from, and upload deltas against, the copy they actually hold
+                    start_w[net_id] = {**global_w, **client_w}
+                    load_global_weights(net, start_w[net_id])
+                if lora_server is not None:
+                    reset_lora_adapters(net, lora_seed)
+                cost.lap(net_id, 'broadcast')
+            print('>> Round {} download: {:.2f} MB'.format(round, downlink_bytes / 2**20))
+            logger.info('>> Round {} download: {:.2f} MB'.format(round, downlink_bytes / 2**20))
+
+            cost.lap('server')
+            profiler.step('evaluation')
+            if eval_scheduler.due(round):
+                # a snapshot lets the background worker evaluate while this round trains; after a lossy
+                # broadcast the clients hold different backbones, so the snapshot takes the exact global one
+                if args.eval_async or args.broadcast_compress != 'none':
+                    eval_nets = NetSnapshot(nets_this_round, global_w)
+                    eval_weights[round] = eval_nets.global_w
+                else:
+                    # evaluated right away, before the aggregation below changes global_w
+                    eval_nets = nets_this_round
+                    eval_weights[round] = global_w
+                eval_scheduler.submit(round, evaluate_global_model, eval_nets, args, net_dataidx_map, X_train, y_train,
+                                      X_test, y_test, device=device, test_bank=test_bank)
+            for eval_round, round_accs in eval_scheduler.collect():
+                best_acc, best_acc_5 = report_global_accuracy(eval_round, round_accs, best_acc, best_acc_5)
+                # checkpoint the weights that were measured, not the ones trained since
+                eval_w = eval_weights.pop(eval_round)
+                if round_accs[5] > best_acc:
+                    save_best_model(args, eval_w, strip_grad_sample_prefix(nets[0].state_dict()), accountant)
+            cost.lap('server', 'eval')
+
+            profiler.step('client_training')
+            local_train_net_few_shot(nets_this_round, args, net_dataidx_map, X_train, y_train, X_test, y_test, device=device,
+                                     test_bank=test_bank, accountant=accountant, cost=cost)
+
+            profiler.step('upload')
+            uploads = {}
+            row_uploads = {}
             for nid, net in nets_this_round.items():
-                local_params = net.state_dict()
-                noisy_delta, delta_before = compute_noisy_delta(global_w, local_params, args.clip_norm, args.noise_multiplier)
-                sample_before = next(iter(delta_before.values())).view(-1)[:3].cpu()
-                sample_after = next(iter(noisy_delta.values())).view(-1)[:3].cpu()
-                print(f"Delta sample client {nid}: {sample_before.tolist()} -> {sample_after.tolist()}")
-                deltas[nid] = noisy_delta
-            # Each client's update is noised once per round, so count the number
-            # of participating clients rather than local epochs
-            dp_steps += len(nets_this_round)
-            eps = compute_epsilon(
-                dp_steps,
-                args.noise_multiplier,
-                args.dp_delta,
-                accountant="rdp",
-                sampling_rate=args.sample_fraction,
-            )
-            print(f"Approx DP epsilon after {round+1} rounds: {eps:.4f}")
-
-            # Aggregate only shared parameters; classifier weights stay private
-            global_update = {
-                k: torch.zeros_like(v)
-                for k, v in global_w.items()
-                if (
-                    torch.is_floating_point(v)
-                    and not k.startswith("transform_layer.")
-                    and k != "few_classify.weight"
-                    and k != "few_classify.bias"
-                )
-            }
-            for nid, delta in deltas.items():
-                weight = fed_avg_freqs[nid]
-                for key in delta:
-                    global_update[key] += delta[key] * weight
-
-            for key in global_update:
-                global_w[key] += global_update[key]
+                cost.lap(nid)
+                if lora_server is not None:
+                    # only the adapter factors and the running statistics of the frozen layers leave the client
+                    local_params = {**lora_factors(net), **lora_buffers(net)}
+                    start_params = {key: lora_start[key] if key in lora_start else start_w.get(nid, global_w)[key]
+                                    for key in local_params}
+                else:
+                    start_params, local_params = start_w.get(nid, global_w), strip_grad_sample_prefix(net.state_dict())
+                rows = net.ebd.pop_touched_rows() if args.sparse_ebd and hasattr(net, 'ebd') else None
+                if sparse_ebd_key is not None and lora_server is None:
+                    # the sparse optimizer left every other row unchanged
+                    start_params = {**start_params, sparse_ebd_key: start_params[sparse_ebd_key][rows]}
+                    local_params = {**local_params, sparse_ebd_key: local_params[sparse_ebd_key][rows]}
+                else:
+                    rows = None
+                show_stats = args.dp_stats_prob > 0 and np.random.rand() < args.dp_stats_prob
+                noisy_delta, stats = compute_noisy_delta(start_params, local_params, args.clip_norm, args.noise_multiplier,
+                                                         return_stats=show_stats)
+                if stats is not None:
+                    sample_after = next(iter(noisy_delta.values())).view(-1)[:3]
+                    print(f"Delta client {nid}: norm {stats['norm'].item():.4f} -> {stats['clipped_norm'].item():.4f}, "
+                          f"sample {stats['sample_before_noise'].tolist()} -> {sample_after.tolist()}")
+                # compressing the already noised delta is post-processing and costs no privacy
+                if rows is not None:
+                    row_uploads[nid] = (rows, noisy_delta.pop(sparse_ebd_key))
+                uploads[nid] = compressor.compress(nid, noisy_delta)
+                cost.add_bytes(nid, upload=uploads[nid].nbytes + sum(t.numel() * t.element_size() for t in row_uploads.get(nid, ())))
+                cost.lap(nid, 'upload')
+            row_bytes = sum(t.numel() * t.element_size() for r in row_uploads.values() for t in r)
+            upload_bytes = sum(u.nbytes for u in uploads.values()) + row_bytes
+            dense_bytes = sum(u.dense_nbytes for u in uploads.values()) + row_bytes
+            print('>> Round {} upload: {:.2f} MB ({:.2f} MB uncompressed)'.format(round, upload_bytes / 2**20, dense_bytes / 2**20))
+            logger.info('>> Round {} upload: {:.2f} MB ({:.2f} MB uncompressed)'.format(round, upload_bytes / 2**20, dense_bytes / 2**20))
+            # From a client's point of view every round is one Gaussian mechanism
+            # on its clipped update, applied with probability sample_fraction
+            accountant.step('client_delta', args.noise_multiplier, args.sample_fraction)
+            eps = accountant.get_epsilon(args.dp_delta, 'client_delta')
+            eps_sgd = accountant.get_max_epsilon(args.dp_delta, 'dp_sgd/')
+            print(f"Approx DP epsilon after {round+1} rounds: {eps:.4f} (client level), {eps_sgd:.4f} (DP-SGD, worst client)")
+            logger.info(f"DP epsilon after {round+1} rounds: {eps:.4f} (client level), {eps_sgd:.4f} (DP-SGD, worst client)")
+
+            # Aggregate only shared parameters; classifier weights stay private.
+            # The uploads are decoded straight into one buffer.
+            cost.lap('server')
+            profiler.step('aggregation')
+            global_update = aggregate_updates(uploads.values(), [fed_avg_freqs[nid] for nid in uploads])
+            if lora_server is not None:
+                factors = lora_factors(lora_server)
+                for key in global_update:
+                    if key in factors:
+                        factors[key] += global_update[key]
+                    else:
+                        global_w[key] += global_update[key]
+                merge_lora_adapters(lora_server, global_w)
+            else:
+                for key in global_update:
+                    global_w[key] += global_update[key]
+            for nid, (rows, values) in row_uploads.items():
+                global_w[sparse_ebd_key].index_add_(0, rows, values, alpha=fed_avg_freqs[nid])
 
             if args.server_momentum:
                 delta_w = copy.deepcopy(global_w)
@@ -950,6 +1259,8 @@ if __name__ == '__main__':
                     global_w[key] = old_w[key] - moment_v[key]
 
             global_model.load_state_dict(global_w)
+            cost.lap('server', 'aggregation')
+            profiler.step('checkpoint')
 
 
             #global_model.cuda()
@@ -957,8 +1268,26 @@ if __name__ == '__main__':
             print('>> Current Round: {}'.format(round))
             logger.info('>> Current Round: {}'.format(round))
             
-            mkdirs(args.modeldir+'fedavg/')
-
-            if global_acc > best_acc:
-                torch.save(global_model.state_dict(), args.modeldir+'fedavg/'+'globalmodel'+args.log_file_name+'.pth')
-                torch.save(nets[0].state_dict(), args.modeldir+'fedavg/'+'localmodel0'+args.log_file_name+'.pth')
+            cost.end_round()
+            logger.info('>> Round {} profile:\n{}'.format(round, profiler.end_round()))
+            if sync_counter.enabled:
+                logger.info('>> Round {} host syncs:\n{}'.format(round, sync_counter.summary()))
+
+        if args.eval_final:
+            # final pass on the model produced by the last round
+            for net in nets_this_round.values():
+                load_global_weights(net, global_model.state_dict())
+                if lora_server is not None:
+                    reset_lora_adapters(net, 0)
+            eval_weights[n_comm_rounds] = global_model.state_dict()
+            eval_scheduler.submit(n_comm_rounds, evaluate_global_model, nets_this_round, args, net_dataidx_map,
+                                  X_train, y_train, X_test, y_test, device=device, test_bank=test_bank)
+        for eval_round, round_accs in eval_scheduler.collect(wait=True):
+            best_acc, best_acc_5 = report_global_accuracy(eval_round, round_accs, best_acc, best_acc_5)
+            eval_w = eval_weights.pop(eval_round)
+            if round_accs[5] > best_acc:
+                save_best_model(args, eval_w, strip_grad_sample_prefix(nets[0].state_dict()), accountant)
+        eval_scheduler.shutdown()
+        trace_path = profiler.close()
+        if trace_path:
+            logger.info('Chrome trace written to {}'.format(trace_path))
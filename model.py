@@ -2,12 +2,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import numpy as np
 import torchvision.models as models
 from resnetcifar import ResNet18_cifar10, ResNet50_cifar10
-from torch.distributions import Bernoulli
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torchtext.vocab import GloVe
-from embedding.meta import RNN
+from torch.func import functional_call
+from opacus.layers import DPLSTM
+from profiling import host_side_only
 from embedding.auxiliary.factory import get_embedding
 
 
@@ -47,52 +49,24 @@ class DropBlock(nn.Module):
         if self.training:
             batch_size, channels, height, width = x.shape
 
-            bernoulli = Bernoulli(gamma)
-            mask = bernoulli.sample(
-                (batch_size, channels, height - (self.block_size - 1), width - (self.block_size - 1))).cuda()
-            # print((x.sample[-2], x.sample[-1]))
+            # block seeds, one Bernoulli draw per valid top-left corner
+            mask = torch.bernoulli(x.new_full(
+                (batch_size, channels, height - (self.block_size - 1), width - (self.block_size - 1)), gamma))
             block_mask = self._compute_block_mask(mask)
-            # print (block_mask.size())
-            # print (x.size())
-            countM = block_mask.size()[0] * block_mask.size()[1] * block_mask.size()[2] * block_mask.size()[3]
-            count_ones = block_mask.sum()
 
-            return block_mask * x * (countM / count_ones)
+            # rescale on the device so the layer never waits for the host
+            count_ones = block_mask.sum().clamp(min=1.0)
+            return block_mask * x * (block_mask.numel() / count_ones)
         else:
             return x
 
-
     def _compute_block_mask(self, mask):
-        left_padding = int((self.block_size - 1) / 2)
-        right_padding = int(self.block_size / 2)
-
-        batch_size, channels, height, width = mask.shape
-        # print ("mask", mask[0][0])
-        non_zero_idxs = mask.nonzero()
-        nr_blocks = non_zero_idxs.shape[0]
-
-        offsets = torch.stack(
-            [
-                torch.arange(self.block_size).view(-1, 1).expand(self.block_size, self.block_size).reshape(-1),
-                # - left_padding,
-                torch.arange(self.block_size).repeat(self.block_size),  # - left_padding
-            ]
-        ).t().cuda()
-        offsets = torch.cat((torch.zeros(self.block_size ** 2, 2).cuda().long(), offsets.long()), 1)
-
-        if nr_blocks > 0:
-            non_zero_idxs = non_zero_idxs.repeat(self.block_size ** 2, 1)
-            offsets = offsets.repeat(nr_blocks, 1).view(-1, 4)
-            offsets = offsets.long()
-
-            block_idxs = non_zero_idxs + offsets
-            # block_idxs += left_padding
-            padded_mask = F.pad(mask, (left_padding, right_padding, left_padding, right_padding))
-            padded_mask[block_idxs[:, 0], block_idxs[:, 1], block_idxs[:, 2], block_idxs[:, 3]] = 1.
-        else:
-            padded_mask = F.pad(mask, (left_padding, right_padding, left_padding, right_padding))
-
-        block_mask = 1 - padded_mask  # [:height, :width]
+        # Position (i, j) is dropped iff a seed lies in [i - block_size + 1, i] x [j - block_size + 1, j],
+        # i.e. every seed drops the block_size x block_size block to its bottom right. Padding the seeds
+        # by block_size - 1 and max-pooling with a block_size kernel marks exactly those positions.
+        padding = self.block_size - 1
+        padded_mask = F.pad(mask, (padding, padding, padding, padding))
+        block_mask = 1 - F.max_pool2d(padded_mask, kernel_size=self.block_size, stride=1)
         return block_mask
 # import pytorch_lightning as pl
 
@@ -165,7 +139,7 @@ class BasicBlock(nn.Module):
 
         if self.downsample is not None:
             residual = self.downsample(x)
-        out += residual
+        out = out + residual
         out = self.relu(out)
         out = self.maxpool(out)
 
@@ -904,15 +878,20 @@ class ModelFed_Adp(nn.Module):
             features = MLP_header()
             num_ftrs = 512
         elif base_model == 'simple-cnn':
-            features = SimpleCNN_header(input_dim=(16 * 18 * 18 if args.dataset == 'miniImageNet' else 16 * 5 * 5),
-                                             hidden_dims=[120, 84], output_dim=n_classes)
+            if args.dataset == 'synthetic':
+                # two 5x5 convs, each followed by 2x2 pooling
+                side = ((args.syn_image_size - 4) // 2 - 4) // 2
+                input_dim = 16 * side * side
+            else:
+                input_dim = 16 * 18 * 18 if args.dataset == 'miniImageNet' else 16 * 5 * 5
+            features = SimpleCNN_header(input_dim=input_dim, hidden_dims=[120, 84], output_dim=n_classes)
             num_ftrs = 84
         elif base_model == 'simple-cnn-mnist':
             features = SimpleCNNMNIST_header(input_dim=(16 * 4 * 4), hidden_dims=[120, 84], output_dim=n_classes)
             num_ftrs = 84
         elif base_model == 'resnet12':
 
-            if args.dataset=='FC100':
+            if args.dataset=='FC100' or (args.dataset == 'synthetic' and args.syn_image_size < 64):
                 features = resnet12(avg_pool=True, drop_rate=0.1, dropblock_size=2)
                 #num_ftrs=2560
                 num_ftrs=640
@@ -928,7 +907,8 @@ class ModelFed_Adp(nn.Module):
         # classifier for shared representation
         all_classify = nn.Linear(out_dim, total_classes)
 
-        encoder_layer = nn.TransformerEncoderLayer(d_model=num_ftrs, nhead=4)
+        # attends over the examples of a batch, which it sees as one sequence
+        encoder_layer = nn.TransformerEncoderLayer(d_model=num_ftrs, nhead=4, batch_first=True)
         transformer = nn.TransformerEncoder(encoder_layer=encoder_layer, num_layers=1)
 
         # modules optimized with DP-SGD
@@ -960,7 +940,10 @@ class ModelFed_Adp(nn.Module):
         ebd = h.squeeze()
 
         if not all_classify:
-            x = self.shared[4](ebd)
+            # a batch of one sequence rather than an unbatched input, so that a
+            # GradSampleModule sees the batch dimension and the cached
+            # attention grad sampler applies
+            x = self.shared[4](ebd.unsqueeze(0)).squeeze(0)
             y = self.few_classify(x)
         else:
             x = self.shared[1](ebd)
@@ -969,6 +952,14 @@ class ModelFed_Adp(nn.Module):
             y = self.shared[3](x)
         return ebd, x, y
 
+    def dp_shared_indices(self, all_classify=False):
+        """Children of ``self.shared`` used by ``forward(x, all_classify)``.
+
+        Only these can contribute to a loss built on that forward, so only they
+        need per-sample gradients, clipping and noise.
+        """
+        return (0, 1, 2, 3) if all_classify else (0, 4)
+
 
 class WORDEBD(nn.Module):
     '''
@@ -976,17 +967,24 @@ class WORDEBD(nn.Module):
         embeddings. The word embeddings are kept as fixed once initialized.
     '''
 
-    def __init__(self, finetune_ebd):
+    def __init__(self, finetune_ebd, vocab_size=None, sparse=False):
         super(WORDEBD, self).__init__()
-        #vectors = Vectors('wiki.en.vec', cache='./')
-        vectors = GloVe(name='42B', dim=300)
+        if vocab_size is None:
+            #vectors = Vectors('wiki.en.vec', cache='./')
+            vectors = GloVe(name='42B', dim=300).vectors
+        else:
+            # random vectors for a made-up vocabulary (synthetic_text), seeded
+            # so that every client starts from the same embeddings
+            vectors = torch.randn(vocab_size, 300, generator=torch.Generator().manual_seed(0))
 
-        self.vocab_size, self.embedding_dim = vectors.vectors.size()
+        self.vocab_size, self.embedding_dim = vectors.size()
+        # sparse: gradients only hold the rows of the looked-up words
         self.embedding_layer = nn.Embedding(
-            self.vocab_size, self.embedding_dim)
-        self.embedding_layer.weight.data = vectors.vectors
+            self.vocab_size, self.embedding_dim, sparse=sparse)
+        self.embedding_layer.weight.data = vectors
 
         self.finetune_ebd = finetune_ebd
+        self._touched = []
 
         if self.finetune_ebd:
             self.embedding_layer.weight.requires_grad = True
@@ -999,12 +997,149 @@ class WORDEBD(nn.Module):
             @return output: batch_size * max_text_len * embedding_dim
         '''
         if (weights is None) or (self.finetune_ebd == False):
+            if self.embedding_layer.sparse and self.embedding_layer.weight.requires_grad and torch.is_grad_enabled():
+                self._touched.append(torch.unique(data))
             return self.embedding_layer(data)
 
         else:
             return F.embedding(data['text'],
                                weights['ebd.embedding_layer.weight'])
 
+    def pop_touched_rows(self):
+        '''
+            Rows looked up with gradients since the last call, the only rows a
+            sparse optimizer can have changed (sparse mode only).
+            @return sorted LongTensor of row ids
+        '''
+        touched, self._touched = self._touched, []
+        if not touched:
+            return torch.zeros(0, dtype=torch.long, device=self.embedding_layer.weight.device)
+        return torch.unique(torch.cat(touched))
+
+
+class LSTMAttEncoder(nn.Module):
+    '''
+        Bidirectional LSTM over the word embeddings followed by attention
+        pooling. The LSTM is Opacus' DPLSTM so that the encoder gets
+        per-sample gradients. The batch comes sorted by decreasing length.
+    '''
+
+    def __init__(self, input_dim, u, da):
+        super(LSTMAttEncoder, self).__init__()
+        # nn.LSTM ignored the dropout of its single layer, DPLSTM would apply it
+        self.rnn = DPLSTM(input_dim, u, 1, batch_first=True, bidirectional=True, dropout=0.0)
+        # the same LSTM as one fused kernel, run with the parameters of
+        # self.rnn when no per-sample gradients are needed; not a child, it
+        # holds no state of its own
+        self.fused_rnn = (nn.LSTM(input_dim, u, 1, batch_first=True, bidirectional=True),)
+
+        # Attention
+        self.head = nn.Linear(da, 1, bias=False)
+        nn.init.uniform_(self.head.weight, -0.1, 0.1)
+        self.proj = nn.Linear(u * 2, da)
+
+        self._register_state_dict_hook(LSTMAttEncoder._drop_rnn_aliases)
+        self._register_load_state_dict_pre_hook(self._add_rnn_aliases)
+
+    @staticmethod
+    def _drop_rnn_aliases(module, state_dict, prefix, local_metadata):
+        # DPLSTM keys its parameters like nn.LSTM, but within a parent module
+        # its state dict also holds them under their internal names
+        for old in module.rnn.old_to_new:
+            state_dict.pop(prefix + 'rnn.' + old, None)
+        return state_dict
+
+    def _add_rnn_aliases(self, state_dict, prefix, *args):
+        for old, new in self.rnn.old_to_new.items():
+            if prefix + 'rnn.' + new in state_dict:
+                state_dict.setdefault(prefix + 'rnn.' + old, state_dict[prefix + 'rnn.' + new])
+
+    def _attention(self, x, text_len):
+        '''
+            text:     batch, max_text_len, input_dim
+            text_len: batch, max_text_len
+        '''
+        max_text_len = x.shape[1]
+
+        # on the batch_size * max_text_len * 2u input rather than flattened
+        # positions, so that the per-sample gradients have a row per document
+        att = self.head(torch.tanh(self.proj(x)))  # unnormalized
+
+        # create mask, masked_fill does not read the mask back to the host
+        idxes = torch.arange(max_text_len, device=x.device).unsqueeze(0)
+        # empty documents attend to their zeroed first position instead of nothing
+        mask = idxes < text_len.clamp(min=1).to(x.device).unsqueeze(1)
+        att = att.masked_fill(~mask.unsqueeze(2), float('-inf'))
+
+        # apply softmax
+        att = F.softmax(att, dim=1).squeeze(2)  # batch, max_text_len
+
+        return att
+
+    def _rnn(self, ebd, text_len, per_sample):
+        '''
+            @param ebd: batch_size * width * input_dim, by decreasing length
+            @param text_len: batch_size, on the host
+            @param per_sample: run DPLSTM, whose per-sample gradient hooks
+                loop over the time steps in Python, rather than the fused LSTM
+            @return output: batch_size * longest document * 2u, zero for
+                documents of length 0
+        '''
+        # packing rejects empty documents, run them as one token and zero them below
+        empty = text_len == 0
+        packed = pack_padded_sequence(ebd, text_len.clamp(min=1), batch_first=True)
+        if per_sample:
+            # DPLSTM reads the batch sizes of the packed batch at every time
+            # step, they stay on the host
+            with host_side_only():
+                out, _ = self.rnn(packed)
+        else:
+            out, _ = functional_call(self.fused_rnn[0], dict(self.rnn.named_parameters()), (packed,))
+        out = pad_packed_sequence(out, batch_first=True)[0]
+        if empty.numpy().any():
+            out = out.masked_fill(empty.to(out.device).view(-1, 1, 1), 0)
+        return out
+
+    def forward(self, ebd, text_len, per_sample=True):
+        '''
+            @param ebd: batch_size * width * input_dim, by decreasing length
+            @param text_len: batch_size, on the host
+            @param per_sample: see _rnn
+            @return output: batch_size * 2u
+        '''
+        # apply rnn
+        ebd = self._rnn(ebd, text_len, per_sample)
+        # result: batch_size, longest document, 2*rnn_dim
+
+        #ebd=F.dropout(ebd,p=0.8, training=self.training)
+
+        # apply attention
+        alpha = self._attention(ebd, text_len)
+
+        # aggregate
+        return torch.sum(ebd * alpha.unsqueeze(-1), dim=1)
+
+
+class ChildList(object):
+    '''
+        Indexable view of some children of a module, in the role of the
+        ``shared`` Sequential of ModelFed_Adp for a model whose state dict
+        keys predate it. Setting an item replaces the child on the module.
+    '''
+
+    def __init__(self, module, names):
+        self.module = module
+        self.names = names
+
+    def __getitem__(self, i):
+        return getattr(self.module, self.names[i])
+
+    def __setitem__(self, i, child):
+        setattr(self.module, self.names[i], child)
+
+    def __len__(self):
+        return len(self.names)
+
 
 class LSTMAtt(nn.Module):
 
@@ -1020,9 +1155,20 @@ class LSTMAtt(nn.Module):
             self.max_text_len=38
         elif args.dataset=='huffpost':
             self.max_text_len=44
+        elif args.dataset=='synthetic_text':
+            self.max_text_len=args.syn_seq_len
+        else:
+            self.max_text_len=None
+
+        # >1: encode documents in this many groups of similar length, each
+        # truncated to its longest document
+        self.length_buckets = getattr(args, 'length_buckets', 1)
 
         self.ebd = ebd
         # self.aux = get_embedding(args)
+        # contextual embeddings (CXTEBD) take the document ids and lengths
+        # along with the token ids; their rows carry the id before the length
+        self.doc_ids = hasattr(ebd, 'get_bert')
 
         if getattr(args, 'use_transform_layer', 1):
             self.transform_layer = TransformLayer(self.ebd.embedding_dim)
@@ -1035,11 +1181,7 @@ class LSTMAtt(nn.Module):
         u = args.induct_rnn_dim
         da = args.induct_att_dim
 
-        self.rnn = RNN(self.input_dim, u, 1, True, 0.5)
-
-        # Attention
-        self.head = nn.Parameter(torch.Tensor(da, 1).uniform_(-0.1, 0.1))
-        self.proj = nn.Linear(u * 2, da)
+        self.encoder = LSTMAttEncoder(self.input_dim, u, da)
 
         self.ebd_dim = u * 2
 
@@ -1051,45 +1193,44 @@ class LSTMAtt(nn.Module):
 
         self.all_classify = nn.Linear(out_dim, total_classes)
 
-        encoder_layer = nn.TransformerEncoderLayer(d_model=self.ebd_dim, nhead=4)
+        # attends over the documents of a batch, which it sees as one sequence
+        encoder_layer = nn.TransformerEncoderLayer(d_model=self.ebd_dim, nhead=4, batch_first=True)
         self.transformer= nn.TransformerEncoder(encoder_layer=encoder_layer, num_layers=1)
 
         print(self.state_dict().keys())
 
-
-
-    def _attention(self, x, text_len):
-        '''
-            text:     batch, max_text_len, input_dim
-            text_len: batch, max_text_len
-        '''
-        batch_size, max_text_len, _ = x.size()
-
-        proj_x = torch.tanh(self.proj(x.view(batch_size * max_text_len, -1)))
-        att = torch.mm(proj_x, self.head)
-        att = att.view(batch_size, max_text_len, 1)  # unnormalized
-
-        # create mask
-        idxes = torch.arange(max_text_len, out=torch.cuda.LongTensor(max_text_len,
-                                                                     device=text_len.device)).unsqueeze(0)
-        mask = (idxes < text_len.unsqueeze(1)).bool()
-        att[~mask] = float('-inf')
-
-        # apply softmax
-        att = F.softmax(att, dim=1).squeeze(2)  # batch, max_text_len
-
-        return att
-
-    def forward(self, data, all_classify=False):
+        self._register_load_state_dict_pre_hook(self._migrate_encoder_keys)
+
+    def _migrate_encoder_keys(self, state_dict, prefix, *args):
+        # checkpoints from before the encoder: rnn.rnn.*, proj.* and the
+        # da * 1 head Parameter, which is the transposed weight of encoder.head
+        for key in list(state_dict):
+            if key.startswith(prefix + 'rnn.rnn.'):
+                state_dict[prefix + 'encoder.rnn.' + key[len(prefix + 'rnn.rnn.'):]] = state_dict.pop(key)
+            elif key.startswith(prefix + 'proj.'):
+                state_dict[prefix + 'encoder.' + key[len(prefix):]] = state_dict.pop(key)
+            elif key == prefix + 'head':
+                state_dict[prefix + 'encoder.head.weight'] = state_dict.pop(key).t()
+
+    @property
+    def shared(self):
+        """Children optimized with DP-SGD, indexed like ``ModelFed_Adp.shared``."""
+        return ChildList(self, ('encoder', 'l1', 'l2', 'all_classify', 'transformer'))
+
+    def _encode(self, text, text_len, doc_id=None, per_sample=True):
         """
-            @param data dictionary
-                @key text: batch_size * max_text_len
-            @param weights placeholder used for maml
-            @return output: batch_size * embedding_dim
+            @param text: batch_size * width, width >= longest document, by
+                decreasing length
+            @param text_len: batch_size
+            @param doc_id: batch_size, on the host, for contextual embeddings
+            @param per_sample: see LSTMAttEncoder._rnn
+            @return output: batch_size * ebd_dim
         """
-
         # Apply the word embedding then personalize via transform layer
-        ebd = self.ebd(data[:, :self.max_text_len])
+        if self.doc_ids:
+            ebd = self.ebd({'doc_id': doc_id, 'text': text, 'text_len': text_len.to(text.device)})
+        else:
+            ebd = self.ebd(text)
         ebd = self.transform_layer(ebd)
 
 
@@ -1100,17 +1241,48 @@ class LSTMAtt(nn.Module):
 
         # result: batch_size, max_text_len, embedding_dim
 
-        # apply rnn
-        ebd = self.rnn(ebd, data[:, self.max_text_len])
-        # result: batch_size, max_text_len, 2*rnn_dim
+        return self.shared[0](ebd, text_len, per_sample=per_sample)
 
-        #ebd=F.dropout(ebd,p=0.8, training=self.training)
-
-        # apply attention
-        alpha = self._attention(ebd, data[:, self.max_text_len])
-
-        # aggregate
-        ebd = torch.sum(ebd * alpha.unsqueeze(-1), dim=1)
+    def forward(self, data, all_classify=False):
+        """
+            @param data: batch_size * (width + 1), token ids padded to any
+                width >= the longest document, followed by the length (and
+                with a contextual embedding, by the document id and the
+                length). Documents longer than max_text_len are cut. Best
+                left on the host: the token ids are moved to the device here
+                and the lengths, which packing needs on the host, stay there.
+            @return output: batch_size * embedding_dim
+        """
+        text_len = data[:, -1]
+        if text_len.device.type != 'cpu':
+            text_len = text_len.cpu()
+        doc_id = data[:, -2].cpu() if self.doc_ids else None
+        text = data[:, :-2 if self.doc_ids else -1]
+        if self.max_text_len is not None and text.shape[1] > self.max_text_len:
+            # longer documents are cut to the dataset's maximum length
+            text = text[:, :self.max_text_len]
+            text_len = text_len.clamp(max=self.max_text_len)
+        text = text.to(self.few_classify.weight.device, non_blocking=True)
+        # DPLSTM returns the per-sample gradients of a packed batch in the
+        # order of decreasing length, so the DP modules run the batch in that
+        # order and their rows line up; the outputs are put back below
+        order = np.argsort(-text_len.numpy(), kind='stable')
+        # per-sample gradients need each DP module to run once per forward;
+        # without them, e.g. in the inner-loop copy, the fused LSTM runs
+        per_sample = (self.training and torch.is_grad_enabled()
+                      and getattr(self.shared[0], 'hooks_enabled', False))
+        if self.length_buckets > 1 and data.shape[0] > self.length_buckets and not per_sample:
+            ebd = []
+            for idx in np.array_split(order, self.length_buckets):
+                width = max(text_len.numpy()[idx].max(), 1)
+                idx = torch.from_numpy(idx)
+                ebd.append(self._encode(text[idx.to(text.device), :width], text_len[idx],
+                                        None if doc_id is None else doc_id[idx], per_sample=False))
+            ebd = torch.cat(ebd, 0)
+        else:
+            idx = torch.from_numpy(order)
+            ebd = self._encode(text[idx.to(text.device)], text_len[idx], None if doc_id is None else doc_id[idx],
+                               per_sample=per_sample)
         #ebd = ebd.mean(1)
 
         #x=F.dropout(ebd, p=0.5,training=self.training)
@@ -1122,13 +1294,17 @@ class LSTMAtt(nn.Module):
 
 
         if not all_classify:
-            x=self.transformer(ebd)
+            # a batch of one sequence, as in ModelFed_Adp
+            x = self.transformer(ebd.unsqueeze(0)).squeeze(0)
             y = self.few_classify(x)
         else:
             x = self.l1(ebd)
             x = F.relu(x)
             x = self.l2(x)
             y = self.all_classify(x)
-        return ebd, x, y
-
+        restore = torch.from_numpy(np.argsort(order)).to(ebd.device)
+        return ebd[restore], x[restore], y[restore]
 
+    def dp_shared_indices(self, all_classify=False):
+        """Children of ``self.shared`` used by ``forward(x, all_classify)``."""
+        return (0, 1, 2, 3) if all_classify else (0, 4)
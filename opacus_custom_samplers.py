@@ -19,14 +19,12 @@ def multiheadattention_grad_sampler(module, activations, backprops):
     Computes gradients for ``in_proj_weight`` & ``in_proj_bias`` as well as
     ``out_proj.weight`` and ``out_proj.bias``.
     """
+    # Opacus already moves the batch dimension of activations and backprops
+    # to the front (``GradSampleModule(batch_first=...)``), so a sequence-first
+    # module must not be transposed a second time here.
     query, key, value = activations[:3]
     grad_output = backprops
 
-    # Move batch dimension to front for simpler indexing
-    if not module.batch_first:
-        query, key, value = query.transpose(0, 1), key.transpose(0, 1), value.transpose(0, 1)
-        grad_output = grad_output.transpose(0, 1)
-
     batch_size, seq_len, embed_dim = query.shape
     num_heads = module.num_heads
     head_dim = embed_dim // num_heads
@@ -43,8 +41,8 @@ def multiheadattention_grad_sampler(module, activations, backprops):
         v = F.linear(value, w_v, b_v)
 
         q = q.view(batch_size, seq_len, num_heads, head_dim).transpose(1, 2)
-        k = k.view(batch_size, seq_len, num_heads, head_dim).transpose(1, 2)
-        v = v.view(batch_size, seq_len, num_heads, head_dim).transpose(1, 2)
+        k = k.view(batch_size, -1, num_heads, head_dim).transpose(1, 2)
+        v = v.view(batch_size, -1, num_heads, head_dim).transpose(1, 2)
 
         scale = head_dim ** -0.5
         attn_scores = torch.matmul(q, k.transpose(-2, -1)) * scale
@@ -52,37 +50,60 @@ def multiheadattention_grad_sampler(module, activations, backprops):
         context = torch.matmul(attn, v)
         context_reshape = context.transpose(1, 2).contiguous().view(batch_size, seq_len, embed_dim)
 
+        return _mha_grad_samples(module, query, key, value, q, k, v, attn, None, context_reshape, grad_output)
+
+
+def _mha_grad_samples(module, query, key, value, q, k, v, attn, drop_mask, context, grad_output):
+    """Per-sample parameter gradients of one attention call.
+
+    ``query``/``key``/``value`` are the batch-first inputs, ``q``/``k``/``v``
+    the projected heads of shape ``(B, H, L, D)``, ``attn`` the softmax
+    probabilities before dropout, ``drop_mask`` the scaled dropout mask (or
+    ``None``) and ``context`` the concatenated heads fed to ``out_proj``.
+    """
+    batch_size, seq_len, embed_dim = query.shape
+    num_heads = module.num_heads
+    head_dim = embed_dim // num_heads
+    scale = head_dim ** -0.5
+    attn_drop = attn if drop_mask is None else attn * drop_mask
+
+    with torch.no_grad():
         # Gradients for out projection parameters
-        gs_out_w = torch.einsum("ble,blf->bef", grad_output, context_reshape)
+        gs_out_w = torch.einsum("ble,blf->bef", grad_output, context)
         gs_out_b = grad_output.sum(dim=1)
 
-        grad_context = torch.einsum("ble,ef->blf", grad_output, module.out_proj.weight)
+        grad_context = torch.matmul(grad_output, module.out_proj.weight)
         grad_context = grad_context.view(batch_size, seq_len, num_heads, head_dim).transpose(1, 2)
 
-        grad_attn = torch.matmul(grad_context, v.transpose(-2, -1))
-        grad_v = torch.matmul(attn.transpose(-2, -1), grad_context)
+        grad_attn = torch.einsum("bhld,bhsd->bhls", grad_context, v)
+        grad_v = torch.einsum("bhls,bhld->bhsd", attn_drop, grad_context)
+        if drop_mask is not None:
+            grad_attn = grad_attn * drop_mask
 
         tmp = grad_attn * attn
         grad_scores = tmp - attn * tmp.sum(dim=-1, keepdim=True)
 
-        grad_q = torch.matmul(grad_scores, k) * scale
-        grad_k = torch.matmul(grad_scores.transpose(-2, -1), q) * scale
+        grad_q = torch.einsum("bhls,bhsd->bhld", grad_scores, k) * scale
+        grad_k = torch.einsum("bhls,bhld->bhsd", grad_scores, q) * scale
 
-        grad_q = grad_q.transpose(1, 2).contiguous().view(batch_size, seq_len, embed_dim)
-        grad_k = grad_k.transpose(1, 2).contiguous().view(batch_size, seq_len, embed_dim)
-        grad_v = grad_v.transpose(1, 2).contiguous().view(batch_size, seq_len, embed_dim)
+        grad_q = _merge_heads(grad_q)
+        grad_k = _merge_heads(grad_k)
+        grad_v = _merge_heads(grad_v)
 
-        gs_w_q = torch.einsum("ble,blf->bef", grad_q, query)
-        gs_w_k = torch.einsum("ble,blf->bef", grad_k, key)
-        gs_w_v = torch.einsum("ble,blf->bef", grad_v, value)
-        gs_in_w = torch.cat([gs_w_q, gs_w_k, gs_w_v], dim=1)
-
-        if module.in_proj_bias is not None:
-            gs_b_q = grad_q.sum(dim=1)
-            gs_b_k = grad_k.sum(dim=1)
-            gs_b_v = grad_v.sum(dim=1)
-            gs_in_b = torch.cat([gs_b_q, gs_b_k, gs_b_v], dim=1)
+        if _same_tensor(query, key) and _same_tensor(query, value):
+            # Self-attention: a single einsum covers the whole in_proj weight.
+            grad_qkv = torch.cat([grad_q, grad_k, grad_v], dim=-1)
+            gs_in_w = torch.einsum("blf,ble->bfe", grad_qkv, query)
+            gs_in_b = grad_qkv.sum(dim=1)
         else:
+            gs_in_w = torch.cat([
+                torch.einsum("ble,blf->bef", grad_q, query),
+                torch.einsum("ble,blf->bef", grad_k, key),
+                torch.einsum("ble,blf->bef", grad_v, value),
+            ], dim=1)
+            gs_in_b = torch.cat([grad_q.sum(dim=1), grad_k.sum(dim=1), grad_v.sum(dim=1)], dim=1)
+
+        if module.in_proj_bias is None:
             gs_in_b = None
 
     ret = {
@@ -93,3 +114,161 @@ def multiheadattention_grad_sampler(module, activations, backprops):
     if gs_in_b is not None:
         ret[module.in_proj_bias] = gs_in_b
     return ret
+
+
+def _merge_heads(x):
+    """``(B, H, L, D)`` -> ``(B, L, H * D)``."""
+    batch_size, num_heads, seq_len, head_dim = x.shape
+    return x.transpose(1, 2).reshape(batch_size, seq_len, num_heads * head_dim)
+
+
+def _same_tensor(a, b):
+    return a.data_ptr() == b.data_ptr() and a.shape == b.shape and a.stride() == b.stride()
+
+
+class CachedMultiheadAttention(nn.MultiheadAttention):
+    """``nn.MultiheadAttention`` that keeps its intermediates for Opacus.
+
+    The forward pass is computed explicitly and, whenever Opacus would record
+    the inputs (training mode with gradients enabled), the projected q/k/v, the
+    attention probabilities, the dropout mask and the context are pushed onto a
+    per-module cache. :func:`cached_multiheadattention_grad_sampler` pops them
+    in the same LIFO order Opacus uses for activations, so the backward hook
+    does not have to recompute the attention, and the entry is released as
+    soon as the per-sample gradients are formed. These tensors are saved by
+    autograd for the backward pass anyway, so the cache costs no extra memory.
+
+    Unbatched inputs, separate q/k/v projection weights, ``add_bias_kv`` and
+    ``add_zero_attn`` are delegated to ``nn.MultiheadAttention`` and do not
+    use the cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedMultiheadAttention, self).__init__(*args, **kwargs)
+        self._grad_sample_cache = []
+
+    def _cache_supported(self, query):
+        return (query.dim() == 3 and self._qkv_same_embed_dim and self.bias_k is None
+                and not self.add_zero_attn)
+
+    def forward(self, query, key, value, key_padding_mask=None, need_weights=True, attn_mask=None,
+                average_attn_weights=True, is_causal=False):
+        if not self._cache_supported(query):
+            return super(CachedMultiheadAttention, self).forward(
+                query, key, value, key_padding_mask=key_padding_mask, need_weights=need_weights,
+                attn_mask=attn_mask, average_attn_weights=average_attn_weights, is_causal=is_causal)
+
+        if not self.batch_first:
+            query, key, value = query.transpose(0, 1), key.transpose(0, 1), value.transpose(0, 1)
+        inputs = (query, key, value)
+        batch_size, tgt_len, embed_dim = query.shape
+        src_len = key.shape[1]
+        head_dim = embed_dim // self.num_heads
+
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3, dim=0)
+        if self.in_proj_bias is not None:
+            b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        else:
+            b_q = b_k = b_v = None
+        q = F.linear(query, w_q, b_q).view(batch_size, tgt_len, self.num_heads, head_dim).transpose(1, 2)
+        k = F.linear(key, w_k, b_k).view(batch_size, src_len, self.num_heads, head_dim).transpose(1, 2)
+        v = F.linear(value, w_v, b_v).view(batch_size, src_len, self.num_heads, head_dim).transpose(1, 2)
+
+        scores = torch.matmul(q, k.transpose(-2, -1)) * head_dim ** -0.5
+        if is_causal and attn_mask is None:
+            attn_mask = torch.ones(tgt_len, src_len, dtype=torch.bool, device=q.device).triu(1)
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                attn_mask = attn_mask.view(batch_size, self.num_heads, tgt_len, src_len)
+            scores = _apply_mask(scores, attn_mask)
+        if key_padding_mask is not None:
+            scores = _apply_mask(scores, key_padding_mask.view(batch_size, 1, 1, src_len))
+        attn = torch.softmax(scores, dim=-1)
+
+        drop_mask = None
+        attn_drop = attn
+        if self.training and self.dropout > 0.0:
+            drop_mask = torch.empty_like(attn).bernoulli_(1 - self.dropout).div_(1 - self.dropout)
+            attn_drop = attn * drop_mask
+
+        context = _merge_heads(torch.matmul(attn_drop, v))
+        output = F.linear(context, self.out_proj.weight, self.out_proj.bias)
+
+        if self.training and torch.is_grad_enabled() and self.in_proj_weight.requires_grad:
+            self._grad_sample_cache.append({
+                'inputs': tuple(t.detach() for t in inputs),
+                'q': q.detach(), 'k': k.detach(), 'v': v.detach(), 'attn': attn.detach(),
+                'drop_mask': drop_mask, 'context': context.detach(),
+            })
+
+        if not self.batch_first:
+            output = output.transpose(0, 1)
+        if not need_weights:
+            return output, None
+        weights = attn_drop.mean(dim=1) if average_attn_weights else attn_drop
+        return output, weights
+
+    def pop_cached(self, activations):
+        """Return the cache entry recorded with ``activations``, or ``None``.
+
+        Entries store batch-first views of the inputs, which is how Opacus
+        hands activations to grad samplers. If the top of the cache was not
+        produced by these inputs (e.g. a forward that Opacus did not record),
+        the cache is out of step with the activations and is dropped so the
+        sampler falls back to recomputing.
+        """
+        if self._grad_sample_cache:
+            entry = self._grad_sample_cache.pop()
+            if all(_same_tensor(a, b) for a, b in zip(entry['inputs'], activations[:3])):
+                return entry
+        self._grad_sample_cache.clear()
+        return None
+
+    def clear_cache(self):
+        self._grad_sample_cache.clear()
+
+
+def _apply_mask(scores, mask):
+    if mask.dtype == torch.bool:
+        return scores.masked_fill(mask, float('-inf'))
+    return scores + mask
+
+
+@register_grad_sampler(CachedMultiheadAttention)
+def cached_multiheadattention_grad_sampler(module, activations, backprops):
+    """Per-sample gradients for :class:`CachedMultiheadAttention`.
+
+    Uses the intermediates stored during the forward pass and falls back to
+    :func:`multiheadattention_grad_sampler` when no matching entry is cached.
+    """
+    entry = module.pop_cached(activations)
+    if entry is None:
+        return multiheadattention_grad_sampler(module, activations, backprops)
+
+    query, key, value = activations[:3]
+    return _mha_grad_samples(module, query, key, value, entry['q'], entry['k'], entry['v'],
+                             entry['attn'], entry['drop_mask'], entry['context'], backprops)
+
+
+def convert_mha_to_cached(module):
+    """Replace every ``nn.MultiheadAttention`` below ``module`` in place.
+
+    Parameters are carried over unchanged, so state-dict keys stay the same and
+    converted models still load weights saved from plain ones. Must be called
+    before wrapping the module in ``GradSampleModule``.
+    """
+    for name, child in module.named_children():
+        if type(child) is nn.MultiheadAttention:
+            cached = CachedMultiheadAttention(
+                child.embed_dim, child.num_heads, dropout=child.dropout,
+                bias=child.in_proj_bias is not None, add_bias_kv=child.bias_k is not None,
+                add_zero_attn=child.add_zero_attn, kdim=child.kdim, vdim=child.vdim,
+                batch_first=child.batch_first,
+                device=child.out_proj.weight.device, dtype=child.out_proj.weight.dtype,
+            )
+            cached.load_state_dict(child.state_dict())
+            cached.train(child.training)
+            setattr(module, name, cached)
+        else:
+            convert_mha_to_cached(child)
+    return module
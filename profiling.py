@@ -0,0 +1,290 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from torch.autograd.profiler import record_function
+
+
+class _Node(object):
+    __slots__ = ('total', 'calls', 'children')
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+        self.children = OrderedDict()
+
+
+class _Frame(object):
+    __slots__ = ('node', 'start', 'rf', 'is_step')
+
+    def __init__(self, node, rf, is_step):
+        self.node = node
+        self.rf = rf
+        self.is_step = is_step
+        self.start = time.perf_counter()
+
+
+class PhaseProfiler(object):
+    """Named ``record_function`` ranges with a timer tree and an optional trace window.
+
+    Every range shows up in ``torch.profiler`` traces and is timed into a tree
+    that :meth:`end_round` summarises. Scopes are opened with :meth:`range`;
+    within a scope, :meth:`step` ends the previous phase and starts the next,
+    so a straight sequence of phases needs a single call per phase and the
+    last one is closed with its scope.
+
+    The tree is built from the main thread only; ranges entered by other
+    threads (e.g. a background evaluation) still appear in traces. Times are
+    host wall-clock, asynchronous CUDA work is charged to where it is waited
+    for.
+
+    Parameters
+    ----------
+    trace_dir : str, optional
+        Where Chrome traces of the profiled window are written.
+    trace_rounds : tuple of int, optional
+        First and last round, inclusive, captured with ``torch.profiler``.
+    """
+
+    def __init__(self, trace_dir=None, trace_rounds=None):
+        self.trace_dir = trace_dir
+        self.trace_rounds = tuple(trace_rounds) if trace_rounds else None
+        self._thread = threading.current_thread()
+        self._root = _Node()
+        self._stack = []
+        self._profile = None
+
+    def _enter(self, name, is_step):
+        if threading.current_thread() is not self._thread:
+            return None
+        parent = self._stack[-1].node if self._stack else self._root
+        node = parent.children.get(name)
+        if node is None:
+            node = parent.children[name] = _Node()
+        rf = record_function(name)
+        rf.__enter__()
+        frame = _Frame(node, rf, is_step)
+        self._stack.append(frame)
+        return frame
+
+    def _exit(self, frame):
+        # close the phases still open inside this scope first
+        while self._stack and self._stack[-1] is not frame:
+            self._close(self._stack.pop())
+        self._close(self._stack.pop())
+
+    def _close(self, frame):
+        frame.rf.__exit__(None, None, None)
+        frame.node.total += time.perf_counter() - frame.start
+        frame.node.calls += 1
+
+    @contextmanager
+    def range(self, name):
+        """Time the enclosed block as ``name``, nested under the current range."""
+        if threading.current_thread() is not self._thread:
+            with record_function(name):
+                yield
+            return
+        frame = self._enter(name, is_step=False)
+        try:
+            yield
+        finally:
+            self._exit(frame)
+
+    def step(self, name):
+        """End the current phase of the innermost range and start phase ``name``."""
+        if threading.current_thread() is not self._thread:
+            return
+        if self._stack and self._stack[-1].is_step:
+            self._close(self._stack.pop())
+        self._enter(name, is_step=True)
+
+    def start_round(self, round):
+        """Open the ``round`` range; starts the trace window at its first round."""
+        if self.trace_rounds and round == self.trace_rounds[0] and self._profile is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profile = torch.profiler.profile(activities=activities)
+            self._profile.__enter__()
+        while self._stack:
+            self._close(self._stack.pop())
+        self._round = round
+        self._enter('round', is_step=False)
+
+    def end_round(self):
+        """Close the ``round`` range and return the summary of its timer tree."""
+        self._exit(self._stack[0])
+        summary = self.summary()
+        self._root = _Node()
+        if self.trace_rounds and self._round == self.trace_rounds[1]:
+            self.close()
+        return summary
+
+    def close(self):
+        """Stop the trace window, if open, and export its Chrome trace."""
+        if self._profile is None:
+            return None
+        self._profile.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, 'rounds_{}-{}.json'.format(*self.trace_rounds))
+        self._profile.export_chrome_trace(path)
+        self._profile = None
+        return path
+
+    def summary(self):
+        """Indented ``name  seconds  calls  share of parent`` lines of the tree."""
+        lines = []
+
+        def visit(node, depth, parent_total):
+            for name, child in node.children.items():
+                share = child.total / parent_total if parent_total > 0 else 1.0
+                lines.append('{:<40} {:>9.3f}s {:>6} {:>6.1%}'.format('  ' * depth + name, child.total, child.calls, share))
+                visit(child, depth + 1, child.total)
+
+        visit(self._root, 0, 0.0)
+        return '\n'.join(lines)
+
+
+# Tensor methods that copy a value into host memory and so wait for the device
+_HOST_READS = ('item', 'tolist', 'cpu', '__bool__', '__float__', '__int__')
+
+# depth of the host_side_only blocks entered by each thread
+_host_side = threading.local()
+
+
+@contextmanager
+def host_side_only():
+    """Do not count the enclosed block in any :class:`SyncCounter`.
+
+    For library code that reads tensors which live on the host whatever the
+    device of the model, e.g. the batch sizes of a ``PackedSequence``.
+    """
+    _host_side.depth = getattr(_host_side, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _host_side.depth -= 1
+
+
+def host_side_step(optimizer):
+    """Run ``optimizer.step`` under :func:`host_side_only` and return ``optimizer``.
+
+    Adam and SparseAdam read their step counts, which stay on the host unless
+    ``capturable``, at every step. Wrap the base optimizer only: the clipping
+    and noise of a ``DPOptimizer`` around it are still counted.
+    """
+    step = optimizer.step
+
+    def wrapper(*args, **kwargs):
+        with host_side_only():
+            return step(*args, **kwargs)
+    optimizer.step = wrapper
+    return optimizer
+
+
+class SyncCounter(object):
+    """Count host reads of tensor values per episode.
+
+    ``Tensor.item``, ``tolist`` and ``cpu`` and ``bool``, ``float`` and
+    ``int`` of a tensor block until the device has produced the value, so on
+    an accelerator each of them is a host-device synchronisation. While
+    enabled they are wrapped and counted whatever the device of the tensor,
+    so a code path has the same count on a CPU-only machine and sync
+    regressions can be caught without a GPU. Like :class:`PhaseProfiler`,
+    only calls from the thread that created the counter are counted.
+
+    ``Tensor.to`` is wrapped as well, but since it mostly copies to the
+    device, only blocking copies from an accelerator to the host count, which
+    a CPU-only run never makes. ``numpy()`` and ``__array__`` are not counted:
+    they only accept host tensors, so the sync is the copy that got the
+    tensor there. Blocks under :func:`host_side_only` are not counted.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Without it :meth:`episode` does nothing and no method is wrapped.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._thread = threading.current_thread()
+        self._originals = {}
+        self._count = None
+        self.counts = OrderedDict()
+
+    def _install(self):
+        if self._originals:
+            return
+        for name in _HOST_READS + ('to',):
+            # None for methods inherited from the C base class
+            self._originals[name] = torch.Tensor.__dict__.get(name)
+            counting = self._counting_to if name == 'to' else self._counting
+            setattr(torch.Tensor, name, counting(getattr(torch.Tensor, name)))
+
+    def _counting(self, original):
+        def wrapper(tensor, *args, **kwargs):
+            if self._counting_now():
+                self._count += 1
+            return original(tensor, *args, **kwargs)
+        return wrapper
+
+    def _counting_to(self, original):
+        def wrapper(tensor, *args, **kwargs):
+            if self._counting_now() and tensor.device.type != 'cpu':
+                device, _, non_blocking, _ = torch._C._nn._parse_to(*args, **kwargs)
+                if device is not None and device.type == 'cpu' and not non_blocking:
+                    self._count += 1
+            return original(tensor, *args, **kwargs)
+        return wrapper
+
+    def _counting_now(self):
+        return (self._count is not None and threading.current_thread() is self._thread
+                and not getattr(_host_side, 'depth', 0))
+
+    def close(self):
+        """Restore the wrapped tensor methods."""
+        for name, original in self._originals.items():
+            if original is None:
+                delattr(torch.Tensor, name)
+            else:
+                setattr(torch.Tensor, name, original)
+        self._originals = {}
+
+    @contextmanager
+    def episode(self, kind):
+        """Count the host reads of the enclosed block as one episode of ``kind``."""
+        if not self.enabled or threading.current_thread() is not self._thread:
+            yield
+            return
+        self._install()
+        outer, self._count = self._count, 0
+        try:
+            yield
+        finally:
+            self.counts.setdefault(kind, []).append(self._count)
+            # an enclosing episode also pays for this one
+            self._count = None if outer is None else outer + self._count
+
+    @contextmanager
+    def paused(self):
+        """Do not count the enclosed block, e.g. host-side data preprocessing."""
+        if self._count is None or threading.current_thread() is not self._thread:
+            yield
+            return
+        count, self._count = self._count, None
+        try:
+            yield
+        finally:
+            self._count = count
+
+    def summary(self):
+        """``kind: mean/max host syncs per episode`` of the episodes since the last call."""
+        lines = ['{}: {:.1f} mean / {} max host syncs per episode over {} episodes'.format(
+                     kind, sum(counts) / len(counts), max(counts), len(counts))
+                 for kind, counts in self.counts.items()]
+        self.counts = OrderedDict()
+        return '\n'.join(lines)
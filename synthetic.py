@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+
+
+SYNTHETIC_DATASETS = ('synthetic', 'synthetic_text')
+
+
+def synthetic_classes(num_classes, num_test_classes):
+    """Train and test class ids of the synthetic datasets.
+
+    The last ``num_test_classes`` ids are held out for meta-testing, the rest
+    are split among the clients.
+    """
+    if not 0 < num_test_classes < num_classes:
+        raise ValueError('need 0 < num_test_classes < num_classes, got {} and {}'.format(num_test_classes, num_classes))
+    n_train = num_classes - num_test_classes
+    return list(range(n_train)), list(range(n_train, num_classes))
+
+
+def _class_rng(seed, c):
+    # one stream per class, so a class looks the same however many classes
+    # or samples are generated and whichever process generates it
+    return np.random.default_rng([seed, c])
+
+
+def _image_class(c, samples_per_class, image_size, seed):
+    rng = _class_rng(seed, c)
+    # a smooth colour pattern per class: a 4x4 grid blown up to the image size
+    grid = rng.uniform(32, 224, size=(4, 4, 3))
+    cells = np.minimum(np.arange(image_size) * 4 // image_size, 3)
+    prototype = grid[cells][:, cells]
+    noise = rng.normal(0, 48, size=(samples_per_class, image_size, image_size, 3))
+    return np.clip(prototype + noise, 0, 255).astype(np.uint8)
+
+
+def _text_class(c, samples_per_class, seq_len, vocab_size, seed):
+    rng = _class_rng(seed, c)
+    # id 0 is padding; about a third of every document are the class' topic words
+    topic = rng.integers(1, vocab_size, size=min(50, vocab_size - 1))
+    words = rng.integers(1, vocab_size, size=(samples_per_class, seq_len))
+    on_topic = rng.random((samples_per_class, seq_len)) < 0.3
+    words[on_topic] = rng.choice(topic, size=int(on_topic.sum()))
+    lengths = rng.integers(max(1, seq_len // 4), seq_len + 1, size=samples_per_class)
+    words[np.arange(seq_len) >= lengths[:, None]] = 0
+    return np.concatenate([words, lengths[:, None]], -1)
+
+
+def make_synthetic_data(dataset, num_classes, samples_per_class, image_size=32, seq_len=44, vocab_size=20000,
+                        seed=0, cache_dir=None):
+    """Generate a synthetic image or text dataset, sorted by class.
+
+    Images are uint8 ``(n, image_size, image_size, 3)`` arrays of a per-class
+    colour pattern plus noise, laid out like miniImageNet. Documents are
+    ``(n, seq_len + 1)`` word ids with the length in the last column, laid out
+    like the output of ``load_text_data``. The data only depend on the
+    arguments, not on the global random state.
+
+    Parameters
+    ----------
+    dataset : {'synthetic', 'synthetic_text'}
+        Generate images or documents.
+    num_classes : int
+        Number of classes.
+    samples_per_class : int
+        Examples of every class.
+    image_size : int, optional
+        Height and width of the images.
+    seq_len : int, optional
+        Maximum document length.
+    vocab_size : int, optional
+        Number of word ids, including the padding id 0.
+    seed : int, optional
+        Seed of the generator.
+    cache_dir : str, optional
+        Write the examples class by class into a ``.npy`` file in this
+        directory and return it memory-mapped, so datasets larger than memory
+        can be used. An existing file for the same arguments is reused.
+
+    Returns
+    -------
+    X : numpy.ndarray or numpy.memmap
+    y : numpy.ndarray
+        Labels, ``samples_per_class`` of each class in order.
+    """
+    if dataset == 'synthetic':
+        shape = (image_size, image_size, 3)
+        dtype = np.uint8
+        make_class = lambda c: _image_class(c, samples_per_class, image_size, seed)
+        name = 'synthetic_c{}_n{}_s{}_seed{}.npy'.format(num_classes, samples_per_class, image_size, seed)
+    elif dataset == 'synthetic_text':
+        shape = (seq_len + 1,)
+        dtype = np.int64
+        make_class = lambda c: _text_class(c, samples_per_class, seq_len, vocab_size, seed)
+        name = 'synthetic_text_c{}_n{}_l{}_v{}_seed{}.npy'.format(num_classes, samples_per_class, seq_len, vocab_size,
+                                                                  seed)
+    else:
+        raise ValueError('unknown synthetic dataset {!r}'.format(dataset))
+
+    y = np.repeat(np.arange(num_classes), samples_per_class)
+    shape = (num_classes * samples_per_class,) + shape
+    if cache_dir is None:
+        X = np.empty(shape, dtype=dtype)
+        for c in range(num_classes):
+            X[c * samples_per_class:(c + 1) * samples_per_class] = make_class(c)
+        return X, y
+
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # write under a temporary name so that an interrupted run is not reused
+        tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+        X = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        for c in range(num_classes):
+            X[c * samples_per_class:(c + 1) * samples_per_class] = make_class(c)
+        X.flush()
+        del X
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r'), y
+
+
+def load_synthetic_data(dataset, num_classes=100, num_test_classes=20, samples_per_class=600, image_size=32,
+                        seq_len=44, vocab_size=20000, seed=0, cache_dir=None):
+    """Synthetic train and test splits, in the format of the other loaders.
+
+    The train split holds the classes returned first by
+    :func:`synthetic_classes`, the test split the held-out ones; both keep the
+    original class ids. With ``cache_dir`` both are views of one memory-mapped
+    file. See :func:`make_synthetic_data` for the other parameters.
+
+    Returns
+    -------
+    X_train, y_train, X_test, y_test
+    """
+    train_classes, _ = synthetic_classes(num_classes, num_test_classes)
+    X, y = make_synthetic_data(dataset, num_classes, samples_per_class, image_size=image_size, seq_len=seq_len,
+                               vocab_size=vocab_size, seed=seed, cache_dir=cache_dir)
+    # examples are sorted by class, so the splits are contiguous slices
+    n_train = len(train_classes) * samples_per_class
+    return X[:n_train], y[:n_train], X[n_train:], y[n_train:]
+
+
+def synthetic_config(args):
+    """Keyword arguments of :func:`load_synthetic_data` from the ``--syn_*`` options."""
+    return dict(num_classes=args.syn_classes, num_test_classes=args.syn_test_classes,
+                samples_per_class=args.syn_samples_per_class, image_size=args.syn_image_size,
+                seq_len=args.syn_seq_len, vocab_size=args.syn_vocab_size, seed=args.syn_seed,
+                cache_dir=args.syn_memmap_dir)
@@ -0,0 +1,85 @@
+import os
+import runpy
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+transformers = pytest.importorskip('transformers')
+
+from embedding.cxtebd import BertFeatureStore, CXTEBD
+
+
+@pytest.fixture
+def bert_dir(tmp_path):
+    torch.manual_seed(0)
+    config = transformers.BertConfig(vocab_size=500, hidden_size=8, num_hidden_layers=1, num_attention_heads=2,
+                                     intermediate_size=16, max_position_embeddings=32)
+    path = str(tmp_path / 'bert')
+    transformers.BertModel(config).save_pretrained(path)
+    return path
+
+
+def make_data(doc_id, width=6, seed=0):
+    rng = np.random.RandomState(seed)
+    text_len = rng.randint(2, width + 1, len(doc_id))
+    text = rng.randint(1, 50, (len(doc_id), width))
+    text[np.arange(width)[None, :] >= text_len[:, None]] = 0
+    return {'doc_id': np.asarray(doc_id), 'text': text, 'text_len': text_len}
+
+
+def test_round_trip(bert_dir, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    train, test = make_data([3, 0, 5]), make_data([7, 1], seed=1)
+    ebd = CXTEBD(bert_dir, feature_store=store_dir, return_seq=True)
+    path = ebd.build_store(train, test, batch_size=2)
+
+    for data in (train, test):
+        with torch.no_grad():
+            expected = ebd.get_bert(torch.from_numpy(data['text']), torch.from_numpy(data['text_len']))
+        assert torch.allclose(ebd.store.lookup(data['doc_id']), expected, atol=1e-5)
+        # episodes cut to their longest document
+        assert torch.allclose(ebd.store.lookup(data['doc_id'], max_len=3), expected[:, :3], atol=1e-5)
+    with pytest.raises(KeyError):
+        ebd.store.lookup(np.array([0, 2]))
+
+    # the same corpus is reused, another one with the same ids is not
+    inode = os.stat(path + '.npy').st_ino
+    assert CXTEBD(bert_dir, feature_store=store_dir, return_seq=True).build_store(test, train) == path
+    assert os.stat(path + '.npy').st_ino == inode
+    other = make_data([3, 0, 5], seed=2)
+    assert CXTEBD(bert_dir, feature_store=store_dir, return_seq=True).build_store(other, test) != path
+
+
+def test_training_reads_the_store(bert_dir, tmp_path, monkeypatch):
+    pytest.importorskip('torchtext')
+    lookups, bert_calls = [], []
+    lookup, get_bert = BertFeatureStore.lookup, CXTEBD.get_bert
+
+    def counting_lookup(self, doc_id, max_len=None):
+        lookups.append(len(doc_id))
+        return lookup(self, doc_id, max_len)
+
+    def counting_get_bert(self, bert_id, text_len):
+        bert_calls.append(self.store is None)
+        return get_bert(self, bert_id, text_len)
+
+    monkeypatch.setattr(BertFeatureStore, 'lookup', counting_lookup)
+    monkeypatch.setattr(CXTEBD, 'get_bert', counting_get_bert)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', [
+        'main_text.py', '--device', 'cpu', '--dataset', 'synthetic_text', '--syn_classes', '80',
+        '--syn_test_classes', '20', '--syn_samples_per_class', '60', '--syn_seq_len', '20', '--syn_vocab_size', '500',
+        '--n_parties', '2', '--comm_round', '1', '--num_train_tasks', '1', '--num_test_tasks', '1',
+        '--num_true_test_ratio', '2', '--epochs', '1', '--pretrained_bert', bert_dir,
+        '--bert_feature_store', str(tmp_path / 'store'), '--logdir', str(tmp_path / 'logs'),
+        '--modeldir', str(tmp_path / 'models')])
+    runpy.run_path(os.path.join(ROOT, 'main_text.py'), run_name='__main__')
+
+    # bert only ran to build the store, the episodes read it
+    assert bert_calls and all(bert_calls)
+    assert lookups
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import UpdateCompressor, aggregate_updates, flatten_update
+
+
+def make_update(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    # odd sizes so that the last block and the last int4 byte are partial
+    return {'a.weight': torch.randn(7, 37, generator=g), 'a.bias': torch.randn(5, generator=g)}
+
+
+@pytest.mark.parametrize("method, levels", [('int8', 127), ('int4', 7)])
+def test_quantisation_is_unbiased_and_bounded(method, levels):
+    torch.manual_seed(0)
+    update = make_update()
+    flat = flatten_update(update)
+    compressor = UpdateCompressor(method, error_feedback=False, block_size=32)
+
+    decoded = []
+    for _ in range(2000):
+        compressed = compressor.compress(0, update)
+        decoded.append(flatten_update(compressed.decompress()))
+    decoded = torch.stack(decoded)
+
+    # every entry is within one quantisation step of the input
+    scales = compressed.payload['scales'].repeat_interleave(32)[:flat.numel()]
+    assert ((decoded - flat).abs() <= scales + 1e-6).all()
+    # and is right on average
+    assert torch.allclose(decoded.mean(0), flat, atol=4 * scales.max().item() / 2000 ** 0.5)
+
+    values = compressed.payload['values']
+    if method == 'int8':
+        assert values.dtype == torch.int8 and values.numel() == flat.numel()
+        assert values.abs().max() <= levels
+    else:
+        assert values.dtype == torch.uint8 and values.numel() == -(-flat.numel() // 2)
+        nibbles = torch.stack([values & 0x0F, values >> 4], 1).reshape(-1).long() - 8
+        assert nibbles.min() >= -levels and nibbles.max() <= levels
+    assert compressed.nbytes < compressed.dense_nbytes
+
+
+def test_topk_keeps_the_largest_entries():
+    update = make_update()
+    flat = flatten_update(update)
+    compressed = UpdateCompressor('topk', topk_ratio=0.1, error_feedback=False).compress(0, update)
+    decoded = flatten_update(compressed.decompress())
+
+    k = int(0.1 * flat.numel())
+    kept = decoded != 0
+    assert kept.sum() == k
+    assert torch.equal(decoded[kept], flat[kept])
+    assert flat[kept].abs().min() >= flat[~kept].abs().max()
+
+
+def test_error_feedback_carries_the_residual():
+    compressor = UpdateCompressor('topk', topk_ratio=0.1)
+    first, second = make_update(0), make_update(1)
+
+    sent = flatten_update(compressor.compress(0, first).decompress())
+    residual = compressor.residuals[0]
+    assert torch.allclose(sent + residual, flatten_update(first))
+
+    # the next upload compresses the new update plus what the last one dropped
+    sent_next = flatten_update(compressor.compress(0, second).decompress())
+    assert torch.allclose(sent_next + compressor.residuals[0], flatten_update(second) + residual)
+    # the caller's tensors are left alone, other clients start without a residual
+    assert torch.equal(flatten_update(first), flatten_update(make_update(0)))
+    assert 1 not in compressor.residuals
+
+
+def test_aggregate_updates_is_the_weighted_sum():
+    updates = [make_update(seed) for seed in range(3)]
+    weights = [0.5, 0.3, 0.2]
+    compressor = UpdateCompressor('none')
+    aggregate = aggregate_updates([compressor.compress(i, u) for i, u in enumerate(updates)], weights)
+
+    assert list(aggregate) == list(updates[0])
+    for key in aggregate:
+        expected = sum(w * u[key] for w, u in zip(weights, updates))
+        assert aggregate[key].shape == expected.shape
+        assert torch.allclose(aggregate[key], expected, atol=1e-6)
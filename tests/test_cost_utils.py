@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cost_utils import CostTracker, _reset_peak_rss
+
+
+def test_peak_rss_is_reset_every_round(tmp_path):
+    if not _reset_peak_rss():
+        pytest.skip('the peak RSS cannot be reset on this system')
+    cost = CostTracker(str(tmp_path / 'costs.jsonl'))
+
+    cost.start_round(0)
+    block = np.ones(256 * 2**20 // 8)
+    del block
+    first = cost.end_round()[-1]['peak_rss_mb']
+
+    cost.start_round(1)
+    second = cost.end_round()[-1]['peak_rss_mb']
+    assert first - second > 200
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dp_planner import epsilon_curves, plan_noise_multiplier
+from dp_utils import RDPAccountant
+
+PLAN = dict(num_train_tasks=20, episode_size=40, client_data_size=500, dp_sgd_rounds=30)
+
+
+def final_eps(noise_mult, comm_round, sample_fraction):
+    return max(curve[-1] for curve in epsilon_curves(noise_mult, 1e-5, comm_round, sample_fraction, **PLAN).values())
+
+
+@pytest.mark.parametrize('target_eps, comm_round, sample_fraction', [(1.0, 100, 0.1), (8.0, 2000, 0.5), (4.0, 50, 1.0)])
+def test_planned_noise_reaches_the_target(target_eps, comm_round, sample_fraction):
+    tol = 1e-3
+    noise_mult = plan_noise_multiplier(target_eps, 1e-5, comm_round, sample_fraction, tol=tol, **PLAN)
+
+    # the accountant of the training loop agrees after the planned run
+    accountant = RDPAccountant()
+    accountant.step('client_delta', noise_mult, sample_fraction, num_steps=comm_round)
+    accountant.step('dp_sgd/0', noise_mult, PLAN['episode_size'] / PLAN['client_data_size'],
+                    num_steps=PLAN['num_train_tasks'] * min(comm_round, PLAN['dp_sgd_rounds']))
+    eps = max(accountant.get_epsilon(1e-5, 'client_delta'), accountant.get_max_epsilon(1e-5, 'dp_sgd/'))
+    assert eps <= target_eps
+    # and a noise multiplier smaller by more than the tolerance overshoots
+    less = final_eps(noise_mult * (1 - 2 * tol), comm_round, sample_fraction)
+    assert less > target_eps and eps == pytest.approx(target_eps, rel=1e-2)
+
+    assert final_eps(noise_mult, comm_round, sample_fraction) == pytest.approx(eps, rel=1e-9)
+    curves = epsilon_curves(noise_mult, 1e-5, comm_round, sample_fraction, **PLAN)
+    assert all(np.all(np.diff(curve) >= 0) for curve in curves.values())
+
+
+def test_unreachable_budget_raises():
+    with pytest.raises(ValueError):
+        plan_noise_multiplier(1e-4, 1e-5, 1000, 1.0, max_noise=10.0)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('torchtext')  # imported by model
+from model import DropBlock
+
+
+def block_expansion_mask(mask, block_size):
+    # the block expansion DropBlock used before the max-pool: every seed sets
+    # the block_size x block_size block starting at it in the padded mask
+    left_padding = int((block_size - 1) / 2)
+    right_padding = int(block_size / 2)
+    padded_mask = F.pad(mask, (left_padding, right_padding, left_padding, right_padding))
+    offsets = torch.stack([
+        torch.arange(block_size).view(-1, 1).expand(block_size, block_size).reshape(-1),
+        torch.arange(block_size).repeat(block_size),
+    ]).t()
+    offsets = torch.cat((torch.zeros(block_size ** 2, 2).long(), offsets.long()), 1)
+    seeds = mask.nonzero()
+    if seeds.shape[0] > 0:
+        # every seed with every offset (the old code tiled both lists, which
+        # skipped pairs when the number of seeds shared a factor with block_size ** 2)
+        block_idxs = (seeds[:, None, :] + offsets[None, :, :]).reshape(-1, 4)
+        padded_mask[block_idxs[:, 0], block_idxs[:, 1], block_idxs[:, 2], block_idxs[:, 3]] = 1.
+    return 1 - padded_mask
+
+
+def test_max_pool_mask_equals_block_expansion():
+    torch.manual_seed(0)
+    for block_size in (1, 2, 3, 4, 5):
+        dropblock = DropBlock(block_size)
+        for gamma in (0.0, 0.05, 0.3):
+            height, width = 9, 12
+            mask = torch.bernoulli(torch.full((2, 3, height - block_size + 1, width - block_size + 1), gamma))
+            expected = block_expansion_mask(mask, block_size)
+            block_mask = dropblock._compute_block_mask(mask)
+            assert block_mask.shape == (2, 3, height, width)
+            assert torch.equal(block_mask, expected), (block_size, gamma)
@@ -0,0 +1,89 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eval_utils import NetSnapshot, build_test_episode_bank, meta_test_features, meta_test_groups
+from synthetic import load_synthetic_data
+
+
+def test_groups_stop_at_the_same_episode():
+    rng = np.random.RandomState(0)
+    N, Q, k = 3, 2, 1
+    y = np.repeat(np.arange(6), 5)
+    episodes = build_test_episode_bank(y, N, Q, ks=(k,), num_episodes=40)[k]
+    rows = np.arange(len(y))
+    # one set separates the classes perfectly and converges at once, the other is noise
+    separable = np.eye(6)[y] + 0.01 * rng.randn(len(y), 6)
+    noise = rng.randn(len(y), 6)
+
+    results = meta_test_groups([separable, noise], rows, episodes, N, Q, ci_tol=0.05, min_tasks=5)
+    counts = [running_acc.count for _, _, _, running_acc in results]
+    assert counts[0] == counts[1] > 5
+    assert all(len(max_values) == counts[0] * N * Q for _, max_values, _, _ in results)
+
+    # a single set stops on its own
+    accs, _, _, running_acc = meta_test_features(separable, rows, episodes, N, Q, ci_tol=0.05, min_tasks=5)
+    assert running_acc.count == len(accs) == 5
+
+
+class TinyNet(nn.Module):
+    def __init__(self):
+        super(TinyNet, self).__init__()
+        self.shared = nn.Linear(3, 3)
+        self.few_classify = nn.Linear(3, 2)
+
+
+def test_snapshot_takes_the_exact_global_weights():
+    torch.manual_seed(0)
+    global_w = TinyNet().state_dict()
+    # clients after a lossy broadcast: different approximations of the backbone, own heads
+    nets = {}
+    for net_id in range(3):
+        net = TinyNet()
+        net.load_state_dict(global_w)
+        net.shared.weight.data += 0.01 * torch.randn(3, 3)
+        nets[net_id] = net
+
+    snapshot = NetSnapshot(nets, global_w)
+    for net_id, net in nets.items():
+        view = snapshot[net_id]
+        assert torch.equal(view.shared.weight, global_w['shared.weight'])
+        assert torch.equal(view.few_classify.weight, net.few_classify.weight)
+    # training moves on without touching the snapshot
+    nets[0].shared.weight.data += 1
+    assert torch.equal(snapshot[0].shared.weight, global_w['shared.weight'])
+    # the server aggregates into global_w in place, the measured weights stay
+    global_w['shared.weight'] += 1
+    assert torch.equal(snapshot.global_w['shared.weight'], snapshot[0].shared.weight)
+    assert not torch.equal(snapshot.global_w['shared.weight'], global_w['shared.weight'])
+
+
+def test_stacked_transform_layers_respect_the_chunk_size():
+    pytest.importorskip('torchtext')
+    import main_image
+
+    args = SimpleNamespace(dataset='synthetic', syn_image_size=40, use_transform_layer=1, N=2, Q=2, eval_ci_tol=0.0,
+                           eval_min_tasks=10)
+    _, _, X_test, y_test = load_synthetic_data('synthetic', num_classes=6, num_test_classes=3, samples_per_class=8,
+                                               image_size=40)
+    test_bank = build_test_episode_bank(y_test, args.N, args.Q, ks=(1,), num_episodes=4)
+    torch.manual_seed(0)
+    nets = {}
+    for net_id in range(3):
+        nets[net_id] = main_image.ModelFed_Adp('simple-cnn', 16, 8, 8, None, args)
+        nets[net_id].load_state_dict(nets[0].state_dict())
+        nets[net_id].transform_layer.alpha.data += net_id
+
+    batches = []
+    nets[0].shared[0].register_forward_hook(lambda module, inputs, output: batches.append(inputs[0].shape[0]))
+    accs, _, _ = main_image.evaluate_clients_few_shot(nets, args, X_test, test_bank, 1, chunk_size=8)
+    assert len(accs) == 3
+    # 3 transform layers stacked on chunks of 8 // 3 images
+    assert batches and max(batches) <= 8 and batches[0] == 3 * 2
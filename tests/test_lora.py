@@ -0,0 +1,118 @@
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opacus import GradSampleModule
+
+from compression import UpdateCompressor, aggregate_updates
+from dp_utils import compute_noisy_delta
+from lora import add_lora_adapters, lora_buffers, lora_factors, merge_lora_adapters, reset_lora_adapters
+
+
+def make_model():
+    torch.manual_seed(0)
+    features = nn.Sequential(nn.Conv2d(3, 6, 3, stride=2, padding=1), nn.ReLU(), nn.Flatten())
+    return nn.Sequential(features, nn.Linear(6 * 4 * 4, 5))
+
+
+def test_merged_adapters_match_adapted_forward():
+    plain = make_model()
+    adapted = add_lora_adapters(make_model(), [0, 1], rank=2, alpha=4)
+    reset_lora_adapters(adapted, seed=3)
+    with torch.no_grad():
+        for factor in lora_factors(adapted).values():
+            factor.normal_()
+    assert all(key.endswith('.up.weight') for key in lora_factors(adapted))
+
+    state = merge_lora_adapters(adapted, plain.state_dict())
+    plain.load_state_dict(state)
+    x = torch.randn(4, 3, 8, 8)
+    assert torch.allclose(plain(x), adapted(x), atol=1e-5)
+
+
+def test_only_factors_get_per_sample_gradients():
+    model = add_lora_adapters(make_model(), [0, 1], rank=2)
+    reset_lora_adapters(model, seed=0)
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    assert trainable and all('.up.' in name for name in trainable)
+
+    gs_model = GradSampleModule(model, loss_reduction="sum")
+    x = torch.randn(4, 3, 8, 8)
+    gs_model(x).pow(2).sum().backward()
+    for p in model.parameters():
+        if p.requires_grad:
+            assert p.grad_sample.shape[0] == 4
+            assert torch.allclose(p.grad_sample.sum(0), p.grad, atol=1e-5)
+        else:
+            assert p.grad is None
+
+
+def test_averaged_factors_merge_into_the_averaged_update():
+    weights = [0.5, 0.3, 0.2]
+    server = add_lora_adapters(make_model(), [0, 1], rank=2)
+    start = {k: v.clone() for k, v in lora_factors(reset_lora_adapters(server, seed=7)).items()}
+
+    # clients start from the same seed and train their own factors
+    plain = make_model().state_dict()
+    expected = {k: v.clone() for k, v in plain.items()}
+    update = {k: torch.zeros_like(v) for k, v in start.items()}
+    for w in weights:
+        client = reset_lora_adapters(add_lora_adapters(make_model(), [0, 1], rank=2), seed=7)
+        with torch.no_grad():
+            for factor in lora_factors(client).values():
+                factor.normal_()
+        for k, v in lora_factors(client).items():
+            update[k] += w * (v - start[k])
+        client_delta = merge_lora_adapters(client, make_model().state_dict())
+        for k in expected:
+            expected[k] += w * (client_delta[k] - plain[k])
+
+    factors = lora_factors(server)
+    for k in update:
+        factors[k] += update[k]
+    merged = merge_lora_adapters(server, plain)
+    for k in expected:
+        assert torch.allclose(merged[k], expected[k], atol=1e-5), k
+
+
+def test_one_round_moves_the_global_batchnorm_statistics():
+    def make_bn_model():
+        torch.manual_seed(0)
+        features = nn.Sequential(nn.Conv2d(3, 6, 3, stride=2, padding=1), nn.BatchNorm2d(6), nn.ReLU(), nn.Flatten())
+        return nn.Sequential(features, nn.Linear(6 * 4 * 4, 5))
+
+    weights = {0: 0.7, 1: 0.3}
+    global_w = make_bn_model().state_dict()
+    server = reset_lora_adapters(add_lora_adapters(make_bn_model(), [0, 1], rank=2), seed=5)
+    start = {k: v.clone() for k, v in lora_factors(server).items()}
+    compressor = UpdateCompressor('none')
+    uploads, expected = {}, torch.zeros_like(global_w['0.1.running_mean'])
+    for nid in weights:
+        # as the LoRA clients of main_image, under GradSampleModule
+        client = add_lora_adapters(make_bn_model(), [0, 1], rank=2)
+        client[0] = GradSampleModule(client[0])
+        reset_lora_adapters(client, seed=5)
+        client.train()
+        client(torch.randn(8, 3, 8, 8) + nid)
+        local = {**lora_factors(client), **lora_buffers(client)}
+        assert '0.1.running_var' in local and '0.1.num_batches_tracked' not in local
+        start_params = {key: start[key] if key in start else global_w[key] for key in local}
+        delta, _ = compute_noisy_delta(start_params, local, 1e9, 0.0)
+        uploads[nid] = compressor.compress(nid, delta)
+        expected += weights[nid] * local['0.1.running_mean']
+
+    update = aggregate_updates(uploads.values(), list(weights.values()))
+    before = global_w['0.1.running_mean'].clone()
+    factors = lora_factors(server)
+    for key in update:
+        if key in factors:
+            factors[key] += update[key]
+        else:
+            global_w[key] += update[key]
+    merge_lora_adapters(server, global_w)
+    assert not torch.allclose(global_w['0.1.running_mean'], before)
+    assert torch.allclose(global_w['0.1.running_mean'], expected, atol=1e-6)
@@ -0,0 +1,115 @@
+import copy
+import os
+import sys
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('torchtext')
+
+from dp_utils import wrap_dp_submodules
+from model import LSTMAtt, WORDEBD
+from profiling import SyncCounter
+
+
+def make_lstmatt(**kwargs):
+    torch.manual_seed(0)
+    args = dict(dataset='synthetic_text', syn_seq_len=12, length_buckets=1, use_transform_layer=1,
+                induct_rnn_dim=8, induct_att_dim=4)
+    args.update(kwargs)
+    return LSTMAtt(WORDEBD(False, vocab_size=50), 16, 5, 7, SimpleNamespace(**args))
+
+
+def make_batch(lengths, width=12):
+    data = torch.randint(1, 50, (len(lengths), width + 1))
+    data[:, width] = torch.tensor(lengths)
+    return data
+
+
+def test_per_sample_gradients_line_up_across_dp_modules():
+    net = make_lstmatt()
+    ref = copy.deepcopy(net)
+    wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=True))
+    lengths = [3, 12, 0, 7, 7, 1]
+    data, labels = make_batch(lengths), torch.randint(0, 7, (len(lengths),))
+
+    _, _, out = net(data, all_classify=True)
+    # the default 'mean' reduction of GradSampleModule undoes the mean of the loss
+    F.cross_entropy(out, labels).backward()
+
+    # every DP module holds the rows in the order of decreasing length; the
+    # reference runs one document at a time through the fused LSTM
+    rows = np.argsort(np.argsort(-np.array(lengths), kind='stable'))
+    ref_params = dict(ref.named_parameters())
+    for i in range(len(lengths)):
+        ref.zero_grad()
+        F.cross_entropy(ref(data[i:i + 1], all_classify=True)[2], labels[i:i + 1]).backward()
+        for index in net.dp_shared_indices(all_classify=True):
+            for name, p in net.shared[index]._module.named_parameters():
+                expected = ref_params['{}.{}'.format(net.shared.names[index], name)].grad
+                assert torch.allclose(p.grad_sample[rows[i]], expected, atol=1e-5), (i, index, name)
+
+
+def test_checkpoints_from_before_the_encoder_load():
+    net = make_lstmatt().eval()
+    # the keys of the nn.LSTM layout, with the head a da * 1 Parameter
+    old = OrderedDict()
+    for key, value in net.state_dict().items():
+        if key.startswith('encoder.rnn.'):
+            key = 'rnn.rnn.' + key[len('encoder.rnn.'):]
+        elif key == 'encoder.head.weight':
+            key, value = 'head', value.t()
+        elif key.startswith('encoder.proj.'):
+            key = key[len('encoder.'):]
+        old[key] = value
+    assert not any('.l0' in key for key in old)
+    assert old['head'].shape == (4, 1)
+
+    torch.manual_seed(1)
+    other = LSTMAtt(WORDEBD(False, vocab_size=50), 16, 5, 7, net.args).eval()
+    other.load_state_dict(old)
+    data = make_batch([3, 12, 0, 7])
+    with torch.no_grad():
+        for a, b in zip(net(data), other(data)):
+            assert torch.allclose(a, b)
+
+
+@pytest.mark.parametrize('length_buckets', [1, 2])
+def test_outputs_keep_the_input_order(length_buckets):
+    net = make_lstmatt(length_buckets=length_buckets).eval()
+    data = make_batch([3, 12, 0, 7, 7, 1])
+    with torch.no_grad():
+        batch = net(data, all_classify=True)
+        single = [torch.cat(outs) for outs in zip(*(net(data[i:i + 1], all_classify=True) for i in range(len(data))))]
+    for a, b in zip(batch, single):
+        assert torch.allclose(a, b, atol=1e-5)
+
+
+def test_longer_documents_are_cut_to_max_text_len():
+    net = make_lstmatt().eval()
+    lengths = [15, 3, 20, 12]
+    data = make_batch(lengths, width=20)
+    cut = torch.cat([data[:, :12], torch.tensor(lengths).clamp(max=12)[:, None]], 1)
+    with torch.no_grad():
+        for a, b in zip(net(data, all_classify=True), net(cut, all_classify=True)):
+            assert torch.allclose(a, b)
+
+
+def test_train_step_does_not_sync():
+    net = make_lstmatt(length_buckets=2)
+    wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=True))
+    data, labels = make_batch([3, 12, 0, 7, 7, 1]), torch.randint(0, 7, (6,))
+    counter = SyncCounter(enabled=True)
+    try:
+        with counter.episode('train'):
+            F.cross_entropy(net(data, all_classify=True)[2], labels).backward()
+            net(data)[2].sum().backward()
+    finally:
+        counter.close()
+    assert counter.counts['train'] == [0]
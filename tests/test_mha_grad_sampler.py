@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opacus import GradSampleModule
+
+from opacus_custom_samplers import CachedMultiheadAttention, convert_mha_to_cached
+
+
+class SelfAttention(nn.Module):
+    def __init__(self, embed_dim=8, num_heads=2, dropout=0.0, batch_first=True, key_padding_mask=None):
+        super(SelfAttention, self).__init__()
+        self.attn = nn.MultiheadAttention(embed_dim, num_heads, dropout=dropout, batch_first=batch_first)
+        self.key_padding_mask = key_padding_mask
+
+    def forward(self, x):
+        return self.attn(x, x, x, key_padding_mask=self.key_padding_mask, need_weights=False)[0]
+
+
+def per_sample_autograd(model, x, batch_first):
+    """Reference per-sample gradients, one backward per sample."""
+    grads = {name: [] for name, _ in model.named_parameters()}
+    for i in range(x.shape[0] if batch_first else x.shape[1]):
+        xi = x[i:i + 1] if batch_first else x[:, i:i + 1]
+        if model.key_padding_mask is not None:
+            mask, model.key_padding_mask = model.key_padding_mask, model.key_padding_mask[i:i + 1]
+        model.zero_grad()
+        model(xi).pow(2).sum().backward()
+        if model.key_padding_mask is not None:
+            model.key_padding_mask = mask
+        for name, p in model.named_parameters():
+            grads[name].append(p.grad.detach().clone())
+    return {name: torch.stack(g) for name, g in grads.items()}
+
+
+@pytest.mark.parametrize("batch_first", [True, False])
+@pytest.mark.parametrize("masked", [False, True])
+def test_cached_grad_sampler_matches_autograd(batch_first, masked):
+    torch.manual_seed(0)
+    batch_size, seq_len = 4, 5
+    mask = None
+    if masked:
+        mask = torch.zeros(batch_size, seq_len, dtype=torch.bool)
+        mask[1, -2:] = True
+        mask[3, -1] = True
+    model = SelfAttention(batch_first=batch_first, key_padding_mask=mask)
+    x = torch.randn(batch_size, seq_len, 8) if batch_first else torch.randn(seq_len, batch_size, 8)
+    expected = per_sample_autograd(model, x, batch_first)
+
+    convert_mha_to_cached(model)
+    assert isinstance(model.attn, CachedMultiheadAttention)
+    gs_model = GradSampleModule(model, batch_first=batch_first, loss_reduction="sum")
+    gs_model(x).pow(2).sum().backward()
+
+    assert model.attn._grad_sample_cache == []
+    for name, p in model.named_parameters():
+        assert torch.allclose(p.grad_sample, expected[name], atol=1e-5), name
+
+
+def test_cached_forward_matches_multihead_attention():
+    torch.manual_seed(0)
+    reference = nn.TransformerEncoderLayer(d_model=8, nhead=2, dropout=0.0)
+    converted = convert_mha_to_cached(nn.TransformerEncoderLayer(d_model=8, nhead=2, dropout=0.0))
+    converted.load_state_dict(reference.state_dict())
+    x = torch.randn(5, 3, 8)
+    assert torch.allclose(reference(x), converted(x), atol=1e-6)
+
+
+def test_dropout_grad_samples_sum_to_batch_gradient():
+    torch.manual_seed(0)
+    model = convert_mha_to_cached(SelfAttention(dropout=0.5))
+    gs_model = GradSampleModule(model, loss_reduction="sum")
+    gs_model(torch.randn(4, 5, 8)).pow(2).sum().backward()
+    for name, p in model.named_parameters():
+        assert torch.allclose(p.grad_sample.sum(0), p.grad, atol=1e-5), name
+
+
+def test_model_fed_adp_transformer_uses_cached_sampler(monkeypatch):
+    pytest.importorskip('torchtext')  # imported by model
+    from types import SimpleNamespace
+    import opacus_custom_samplers
+    from dp_utils import wrap_dp_submodules
+    from model import ModelFed_Adp
+
+    torch.manual_seed(0)
+    net = ModelFed_Adp('simple-cnn', 16, 5, 20, None, SimpleNamespace(dataset='FC100', use_transform_layer=1))
+    convert_mha_to_cached(net.shared[4])
+    x = torch.randn(6, 3, 32, 32)
+
+    # the transformer sees the batch as one sequence, so its only per-sample
+    # gradient is the gradient of the whole batch
+    torch.manual_seed(1)
+    net(x)[2].pow(2).sum().backward()
+    expected = {name: p.grad.clone() for name, p in net.shared[4].named_parameters()}
+
+    def recompute(*args):
+        raise AssertionError('the cached grad sampler fell back to recomputing')
+    monkeypatch.setattr(opacus_custom_samplers, 'multiheadattention_grad_sampler', recompute)
+
+    wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=False))
+    net.zero_grad()
+    torch.manual_seed(1)
+    net(x)[2].pow(2).sum().backward()
+    for name, p in net.shared[4].named_parameters():
+        assert p.grad_sample.shape[0] == 1, name
+        assert torch.allclose(p.grad_sample[0], expected[name.replace('_module.', '')], atol=1e-5), name
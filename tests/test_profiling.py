@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiling import SyncCounter, host_side_only, host_side_step
+
+
+def test_counts_host_reads_per_episode():
+    counter = SyncCounter(enabled=True)
+    x = torch.ones(3)
+    try:
+        with counter.episode('train'):
+            x.sum().item()
+            float(x[0])
+            x.tolist()
+            # host tensors only, the copy that got them there is what syncs
+            x.numpy()
+            np.asarray(x)
+            # copies to the device or within the host
+            x.to(torch.float64)
+            x.to('cpu')
+            with host_side_only():
+                x.sum().item()
+        with counter.episode('train'), pytest.raises((NotImplementedError, RuntimeError)):
+            # a blocking copy from another device to the host
+            torch.ones(2, device='meta').to('cpu')
+    finally:
+        counter.close()
+    assert counter.counts['train'] == [3, 1]
+    assert 'to' not in torch.Tensor.__dict__ and 'item' not in torch.Tensor.__dict__
+
+
+def test_disabled_counter_wraps_nothing():
+    counter = SyncCounter()
+    with counter.episode('train'):
+        torch.ones(1).item()
+    assert not counter.counts and 'item' not in torch.Tensor.__dict__
+
+
+def test_host_side_step_leaves_the_dp_step_counted():
+    from opacus.optimizers import DPOptimizer
+
+    weight = torch.nn.Parameter(torch.ones(3))
+    weight.grad_sample = torch.ones(2, 3)
+    optimizer = DPOptimizer(host_side_step(torch.optim.Adam([weight], lr=0.1)), expected_batch_size=2,
+                            noise_multiplier=1.0, max_grad_norm=1.0)
+    # a read in the DP part of the step, e.g. of the clipped norms
+    optimizer.attach_step_hook(lambda opt: opt.params[0].summed_grad.sum().item())
+    counter = SyncCounter(enabled=True)
+    try:
+        with counter.episode('train'):
+            optimizer.step()
+    finally:
+        counter.close()
+    # the step counts Adam reads are not counted, the hook is
+    assert counter.counts['train'] == [1]
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opacus.accountants.analysis.rdp import compute_rdp, get_privacy_spent
+
+from dp_utils import DEFAULT_RDP_ORDERS, RDPAccountant, subsampled_gaussian_rdp
+
+
+@pytest.mark.parametrize("sample_rate, noise_mult, steps", [
+    (0.01, 1.0, 1000), (0.1, 0.6, 50), (0.05, 0.5, 300), (1.0, 2.0, 10),
+])
+def test_accountant_matches_reference(sample_rate, noise_mult, steps):
+    orders = list(DEFAULT_RDP_ORDERS)
+    reference = compute_rdp(q=sample_rate, noise_multiplier=noise_mult, steps=steps, orders=orders)
+    rdp = steps * subsampled_gaussian_rdp(sample_rate, noise_mult, DEFAULT_RDP_ORDERS)
+    assert np.allclose(rdp, reference, rtol=1e-6)
+
+    accountant = RDPAccountant()
+    accountant.step('client_delta', noise_mult, sample_rate, num_steps=steps)
+    eps, _ = get_privacy_spent(orders=orders, rdp=reference, delta=1e-5)
+    assert accountant.get_epsilon(1e-5, 'client_delta') == pytest.approx(eps, rel=1e-6)
+
+    restored = RDPAccountant()
+    restored.load_state_dict(accountant.state_dict())
+    assert restored.get_epsilon(1e-5, 'client_delta') == pytest.approx(eps, rel=1e-12)
+
+
+def test_fractional_orders_tighten_large_epsilon():
+    integer_only = RDPAccountant(orders=np.arange(2, 257))
+    default = RDPAccountant()
+    for accountant in (integer_only, default):
+        accountant.step('client_delta', 0.5, 0.05, num_steps=300)
+    assert default.get_epsilon(1e-5, 'client_delta') < integer_only.get_epsilon(1e-5, 'client_delta')
@@ -0,0 +1,95 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('torchtext')
+
+from compression import UpdateCompressor, aggregate_updates
+from dp_utils import compute_noisy_delta, inner_loop_copy, wrap_dp_submodules
+from model import LSTMAtt, WORDEBD
+
+KEY = 'ebd.embedding_layer.weight'
+
+
+def make_net():
+    torch.manual_seed(0)
+    args = SimpleNamespace(dataset='synthetic_text', syn_seq_len=12, length_buckets=1, use_transform_layer=0,
+                           induct_rnn_dim=8, induct_att_dim=4)
+    return LSTMAtt(WORDEBD(True, vocab_size=200, sparse=True), 16, 5, 7, args)
+
+
+def train_client(net, seed):
+    """One SparseAdam step on the embeddings and an SGD step on the rest."""
+    torch.manual_seed(seed)
+    data = torch.randint(1, 100, (6, 13))
+    data[:, 12] = torch.randint(1, 13, (6,))
+    dense = [p for name, p in net.named_parameters() if p.requires_grad and not name.startswith('ebd.')]
+    net(data, all_classify=True)[2].pow(2).sum().backward()
+    optim.SparseAdam([net.ebd.embedding_layer.weight], lr=0.1).step()
+    optim.SGD(dense, lr=0.1).step()
+    return data
+
+
+def test_only_looked_up_rows_change():
+    net = make_net()
+    start = net.ebd.embedding_layer.weight.detach().clone()
+    data = train_client(net, seed=1)
+
+    rows = net.ebd.pop_touched_rows()
+    looked_up = torch.unique(torch.cat([d[:l] for d, l in zip(data[:, :-1], data[:, -1])]))
+    assert set(looked_up.tolist()) <= set(rows.tolist())
+    changed = (net.ebd.embedding_layer.weight.detach() != start).any(1).nonzero().flatten()
+    assert changed.numel() and set(changed.tolist()) <= set(rows.tolist())
+    assert net.ebd.pop_touched_rows().numel() == 0
+
+
+def test_sparse_aggregate_equals_dense():
+    global_w = make_net().state_dict()
+    weights = {0: 0.6, 1: 0.4}
+    compressor = UpdateCompressor('none')
+    dense_uploads, sparse_uploads, row_uploads = {}, {}, {}
+    for nid in weights:
+        net = make_net()
+        train_client(net, seed=nid + 1)
+        local_w = net.state_dict()
+        delta, _ = compute_noisy_delta(global_w, local_w, 1e9, 0.0)
+        dense_uploads[nid] = compressor.compress(nid, delta)
+
+        # as the clients of main_text upload with --sparse_ebd
+        rows = net.ebd.pop_touched_rows()
+        delta, _ = compute_noisy_delta({**global_w, KEY: global_w[KEY][rows]}, {**local_w, KEY: local_w[KEY][rows]},
+                                       1e9, 0.0)
+        row_uploads[nid] = (rows, delta.pop(KEY))
+        sparse_uploads[nid] = compressor.compress(nid, delta)
+
+    dense_w = {k: v.clone() for k, v in global_w.items()}
+    update = aggregate_updates(dense_uploads.values(), [weights[nid] for nid in dense_uploads])
+    for key in update:
+        dense_w[key] += update[key]
+
+    sparse_w = {k: v.clone() for k, v in global_w.items()}
+    update = aggregate_updates(sparse_uploads.values(), [weights[nid] for nid in sparse_uploads])
+    for key in update:
+        sparse_w[key] += update[key]
+    for nid, (rows, values) in row_uploads.items():
+        sparse_w[KEY].index_add_(0, rows, values, alpha=weights[nid])
+
+    assert not torch.equal(dense_w[KEY], global_w[KEY])
+    for key in dense_w:
+        assert torch.allclose(dense_w[key], sparse_w[key], atol=1e-6), key
+
+
+def test_inner_loop_copy_shares_the_embeddings():
+    net = make_net()
+    wrap_dp_submodules(net.shared, net.dp_shared_indices(all_classify=True))
+    net_new = inner_loop_copy(net)
+    weight, copied = net.ebd.embedding_layer.weight, net_new.ebd.embedding_layer.weight
+    assert copied.data_ptr() == weight.data_ptr() and not copied.requires_grad and weight.requires_grad
+    assert net_new.few_classify.weight.data_ptr() != net.few_classify.weight.data_ptr()
+    assert torch.equal(net_new.few_classify.weight, net.few_classify.weight)
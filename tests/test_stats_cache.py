@@ -0,0 +1,116 @@
+import os
+import sys
+from collections import defaultdict
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('tqdm')
+pytest.importorskip('termcolor')
+pytest.importorskip('transformers')
+
+import data.stats as stats
+from data.parallel_sampler import ParallelSampler, SharedStatsCache
+
+
+def make_data(num_classes=6, per_class=10, width=8, vocab_size=30, seed=0):
+    rng = np.random.RandomState(seed)
+    label = np.repeat(np.arange(num_classes), per_class)
+    text_len = rng.randint(1, width + 1, len(label))
+    text = rng.randint(1, vocab_size, (len(label), width))
+    text[np.arange(width)[None, :] >= text_len[:, None]] = 0
+    return {'text': text, 'text_len': text_len, 'label': label, 'raw': np.array([''] * len(label), dtype=object),
+            'vocab_size': vocab_size, 'is_train': True}
+
+
+def old_idf(data, classes):
+    # the per-document loops replaced by the doc-term matrix
+    unique_text = defaultdict(list)
+    for i in range(len(data['label'])):
+        unique_text[data['label'][i]].append(np.unique(data['text'][i, :]))
+    n_t = np.zeros(data['vocab_size'], dtype=np.float32)
+    for key in classes:
+        idx, counts = np.unique(np.concatenate(unique_text[key]), return_counts=True)
+        n_t[idx] += counts
+    idf = np.log(len(data['label']) / (1.0 + n_t))
+    idf[idf < 0] = 0
+    return np.expand_dims(idf, axis=1)
+
+
+def old_iwf(data, classes):
+    n_t = {}
+    for i in range(len(data['label'])):
+        idx, counts = np.unique(data['text'][i, :], return_counts=True)
+        n_t.setdefault(data['label'][i], np.zeros(data['vocab_size'], dtype=np.float32))[idx] += counts
+    n_tokens_sum = np.sum([n_t[key] for key in classes], axis=0, keepdims=True)
+    return np.transpose(1e-5 / (1e-5 + n_tokens_sum / np.sum(n_tokens_sum)))
+
+
+@pytest.mark.parametrize('classes', [None, [0, 2, 3], [5]])
+def test_csr_stats_match_the_per_document_counts(classes):
+    data = make_data()
+    expected = list(range(6)) if classes is None else classes
+    assert np.allclose(stats._compute_idf(data, classes), old_idf(data, expected), atol=1e-6)
+    assert np.allclose(stats._compute_iwf(data, classes), old_iwf(data, expected), rtol=1e-5)
+
+
+def mask(*classes):
+    m = np.zeros(4, dtype=np.int8)
+    m[list(classes)] = 1
+    return m
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SharedStatsCache(2, 4, 3, ['idf'])
+    computed = []
+
+    def get(m):
+        def compute():
+            computed.append(tuple(m))
+            return {'idf': np.full((3, 1), float(m @ np.arange(1, 5)))}
+        return cache.get(m, compute)['idf']
+
+    a, b, c = mask(0, 1), mask(1, 2), mask(2, 3)
+    get(a), get(b), get(a)
+    get(c)  # evicts b, a was used more recently
+    assert get(a)[0, 0] == a @ np.arange(1, 5)
+    get(b)
+    assert computed == [tuple(a), tuple(b), tuple(c), tuple(b)]
+    assert cache.counts() == (2, 4)
+
+
+def _fill(cache, m):
+    cache.get(m, lambda: {'idf': np.ones((3, 1)), 'iwf': np.zeros((3, 1))})
+
+
+def test_workers_share_the_entries():
+    cache = SharedStatsCache(4, 4, 3, ['idf', 'iwf'])
+    worker = get_context('fork').Process(target=_fill, args=(cache, mask(0, 3)))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    values = cache.get(mask(0, 3), lambda: pytest.fail('computed again'))
+    assert np.array_equal(values['idf'], np.ones((3, 1))) and np.array_equal(values['iwf'], np.zeros((3, 1)))
+    assert cache.counts() == (1, 1)
+
+
+def test_sampler_workers_compute_each_source_set_once():
+    data = make_data()
+    args = SimpleNamespace(way=5, shot=2, query=2, embedding='meta', n_workers=2, mode='train', auxiliary=[],
+                           meta_w_target=False, cuda=-1, stats_cache_size=100)
+    sampler = ParallelSampler(data, args, num_episodes=40)
+    try:
+        assert sampler.stats_cache.capacity == 6  # C(6, 5) sets of source classes
+        for support, _ in sampler.get_epoch():
+            source = sorted(set(range(6)) - set(support['label'].tolist()))
+            assert np.allclose(support['idf'], old_idf(data, source), atol=1e-6)
+        hits, misses = sampler.stats_cache.counts()
+    finally:
+        del sampler
+    # a set missed by both workers at once is computed twice
+    assert misses <= 2 * 6 and hits + misses >= 40
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import load_synthetic_data, make_synthetic_data
+
+
+def test_memmap_matches_in_memory_and_splits_by_class(tmp_path):
+    for dataset in ('synthetic', 'synthetic_text'):
+        kwargs = dict(num_classes=5, num_test_classes=2, samples_per_class=4, image_size=8, seq_len=6,
+                      vocab_size=50, seed=1)
+        X_train, y_train, X_test, y_test = load_synthetic_data(dataset, **kwargs)
+        cached = load_synthetic_data(dataset, cache_dir=str(tmp_path), **kwargs)
+        for a, b in zip((X_train, y_train, X_test, y_test), cached):
+            assert np.array_equal(a, b)
+        assert isinstance(cached[0], np.memmap)
+        assert set(y_train) == {0, 1, 2} and set(y_test) == {3, 4}
+
+    # a class does not depend on how many others are generated
+    X_small, _ = make_synthetic_data('synthetic_text', 2, 4, seq_len=6, vocab_size=50, seed=1)
+    assert np.array_equal(X_small, X_train[:8])
+    lengths = X_train[:, -1]
+    assert ((lengths >= 1) & (lengths <= 6)).all()
+    assert all((row[l:-1] == 0).all() and (row[:l] > 0).all() for row, l in zip(X_train, lengths))
+
+
+@pytest.mark.parametrize('main, dataset, extra', [
+    ('main_image.py', 'synthetic', ['--model', 'simple-cnn', '--syn_image_size', '40']),
+    ('main_text.py', 'synthetic_text', ['--syn_seq_len', '20', '--syn_vocab_size', '500']),
+])
+def test_one_federated_round(tmp_path, main, dataset, extra):
+    pytest.importorskip('torchtext')
+    # enough training classes that both non-IID clients can sample N classes of K + Q examples
+    args = ['--device', 'cpu', '--dataset', dataset, '--syn_classes', '80', '--syn_test_classes', '20',
+            '--syn_samples_per_class', '60', '--n_parties', '2', '--comm_round', '1', '--num_train_tasks', '1',
+            '--num_test_tasks', '1', '--num_true_test_ratio', '2', '--epochs', '1', '--noise_multiplier', '1.0',
+            '--sync_free', '1', '--sync_debug', '1',
+            '--logdir', str(tmp_path / 'logs'), '--modeldir', str(tmp_path / 'models')] + extra
+    result = subprocess.run([sys.executable, os.path.join(ROOT, main)] + args, cwd=str(tmp_path),
+                            capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert '>> Round 0 upload' in result.stdout
+    log, = [f for f in os.listdir(str(tmp_path / 'logs')) if f.endswith('.log')]
+    with open(str(tmp_path / 'logs' / log)) as f:
+        assert 'train: 0.0 mean / 0 max host syncs' in f.read()
@@ -12,6 +12,7 @@ from sklearn.metrics import confusion_matrix
 import pickle as pkl
 #from model import *
 from datasets import CIFAR10_truncated, CIFAR100_truncated, ImageFolder_custom
+from synthetic import SYNTHETIC_DATASETS, load_synthetic_data
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -25,6 +26,34 @@ def mkdirs(dirpath):
         pass
 
 
+def setup_device(args):
+    """Resolve ``args.device`` and size the CPU thread pools of this process.
+
+    With ``--num_threads 0`` the intra-op pool is sized to the CPUs in the
+    process affinity mask (``taskset``/cgroups), so several training processes
+    pinned to disjoint cores on one host do not oversubscribe it.
+    """
+    device = torch.device(args.device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError("--device {} requested but CUDA is not available, use --device cpu".format(args.device))
+
+    num_threads = args.num_threads
+    if num_threads <= 0 and device.type == 'cpu' and hasattr(os, 'sched_getaffinity'):
+        num_threads = len(os.sched_getaffinity(0))
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if args.num_interop_threads > 0:
+        # only allowed before any inter-op parallel work has started
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+    if device.type == 'cuda':
+        print("Running on GPU {}: {}".format(device, torch.cuda.get_device_name(device)))
+    else:
+        print("Running on CPU with {} intra-op / {} inter-op threads".format(
+            torch.get_num_threads(), torch.get_num_interop_threads()))
+    return device
+
+
 def load_cifar10_data(datadir):
     transform = transforms.Compose([transforms.ToTensor()])
 
@@ -81,6 +110,31 @@ def load_text_data(datadir, dataset):
             np.concatenate([test_data['text'], test_data['text_len'].reshape(-1, 1)], -1), test_data['label'])
 
 
+def trim_text_batch(*batches, tail=1):
+    """Cut text batches to the longest document among them.
+
+    Rows are token ids padded to the dataset's maximum length followed by
+    ``tail`` columns that end with the length, as returned by
+    ``load_text_data`` (``tail=1``) or ``add_doc_ids`` (``tail=2``). The
+    padding columns that no document uses are dropped, and all batches keep
+    the same width so that they can still be concatenated.
+    """
+    width = max([1] + [int(X[:, -1].max()) for X in batches if len(X)])
+    return [np.concatenate([X[:, :width], X[:, -tail:]], 1) for X in batches]
+
+
+def add_doc_ids(*batches):
+    """Insert a document id column before the length of text batches.
+
+    The ids number the rows of all batches consecutively, e.g. the train and
+    then the test split, and key the documents of a feature store (see
+    ``embedding.cxtebd.CXTEBD.build_store``).
+    """
+    offsets = np.cumsum([0] + [len(X) for X in batches])
+    return [np.concatenate([X[:, :-1], np.arange(start, start + len(X)).reshape(-1, 1), X[:, -1:]], 1)
+            for start, X in zip(offsets, batches)]
+
+
 def load_tinyimagenet_data(datadir):
     transform = transforms.Compose([transforms.ToTensor()])
     xray_train_ds = ImageFolder_custom(datadir + './train/', transform=transform)
@@ -114,7 +168,7 @@ def record_net_data_stats(y_train, net_dataidx_map, logdir):
     return net_cls_counts
 
 
-def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
+def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4, synthetic=None):
     if dataset == 'cifar10':
         X_train, y_train, X_test, y_test = load_cifar10_data(datadir)
     elif dataset == 'cifar100' or dataset == 'FC100':
@@ -147,6 +201,8 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
 
     elif dataset == 'tinyimagenet':
         X_train, y_train, X_test, y_test = load_tinyimagenet_data(datadir)
+    elif dataset in SYNTHETIC_DATASETS:
+        X_train, y_train, X_test, y_test = load_synthetic_data(dataset, **(synthetic or {}))
 
     if dataset == 'FC100':
         X_total = np.concatenate([X_train, X_test], 0)
@@ -207,6 +263,8 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
                                  76, 77, 78]
             elif dataset=='huffpost':
                 train_classes=list(range(20))
+            elif dataset in SYNTHETIC_DATASETS:
+                train_classes = np.unique(y_train).tolist()
 
             for k in train_classes:
                 idx_k = np.where(y_train == k)[0]